@@ -0,0 +1,132 @@
+'''
+Batch export: renders many census rows to files in parallel, e.g.
+
+    python batch.py --rows 2-2604 --charts map,bar --formats pdf,png --out exports
+
+Each worker process loads the data and starts kaleido once, then renders rows until the queue is empty. Outputs whose figure, format and size have not changed since the last run (per the manifest) are skipped.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+chartSettings = {
+    "map": {"width": 2000, "height": 1250},
+    "bar": {"width": 3000, "height": None},
+}
+mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+
+def _startWorker ():
+    #Runs once per worker: loads the data and starts kaleido so every row after the first only pays for its own render
+    import map
+    import plotly.io as pio
+    pio.kaleido.scope.mathjax = None
+    pio.to_image({"data": [], "layout": {}}, format="png", engine="kaleido", width=10, height=10)
+
+def _figureJSON (chart, row):
+    import plotly.io as pio
+    from map import censusMapFigure, censusBar, neighbourhoodFilePath, censusFilePath
+    if chart == "map":
+        figure = censusMapFigure(neighbourhoodFilePath, censusFilePath, row, "Value", mapZoomSettings, exportMode=True)
+    else:
+        figure = censusBar(censusFilePath, row)
+    return pio.to_json(figure, validate=False).encode()
+
+def renderRow (chart, row, formats, outFolder, previousHashes):
+    '''
+    A function to render one chart of one row in every format, skipping formats whose output is up to date.
+    ----
+    Parameters:
+        chart - "map" or "bar" (str)
+        row - the row number, as shown in the UI (int)
+        formats - e.g. ["pdf", "png"] (list of str)
+        outFolder - the folder outputs are written under (str)
+        previousHashes - the content hash of each output from the last run's manifest, keyed by relative path (dict)
+    Returns:
+        entries - manifest entries for the outputs, keyed by relative path (dict)
+    '''
+    import plotly.io as pio
+    from export import exportJobId
+    from datastore import writeAtomically
+    figureJSON = _figureJSON(chart, row)
+    figure = None
+    settings = chartSettings[chart]
+    entries = {}
+    for imageFormat in formats:
+        relativePath = f"{chart}/{row}.{imageFormat}"
+        path = os.path.join(outFolder, relativePath)
+        contentHash = exportJobId(figureJSON, imageFormat, settings["width"], settings["height"])
+        entry = {"chart": chart, "row": row, "format": imageFormat, "hash": contentHash}
+        if previousHashes.get(relativePath) == contentHash and os.path.exists(path):
+            entry.update(skipped=True, bytes=os.path.getsize(path), seconds=0)
+        else:
+            if figure is None:
+                figure = json.loads(figureJSON)
+            start = time.perf_counter()
+            image = pio.to_image(figure, format=imageFormat, engine="kaleido", width=settings["width"], height=settings["height"], validate=False)
+            writeAtomically(path, lambda imageFile: imageFile.write(image))
+            entry.update(skipped=False, bytes=len(image), seconds=time.perf_counter() - start)
+        entries[relativePath] = entry
+    return entries
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Render census rows to PDF/PNG/SVG in parallel")
+    parser.add_argument("--rows", default="all", help='rows as shown in the UI, e.g. "37,40-45", or "all" (default)')
+    parser.add_argument("--charts", default="map", help='comma-separated charts to render: "map", "bar" (default: map)')
+    parser.add_argument("--formats", default="pdf", help='comma-separated formats: "pdf", "png", "svg" (default: pdf)')
+    parser.add_argument("--out", default="exports", help="output folder (default: exports)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    #Loaded before the pool starts so forked workers inherit the parsed data; "lazy" keeps map.py from warming in a thread that would be running while the pool forks
+    os.environ.setdefault("STARTUP_MODE", "lazy")
+    import map
+    from datastore import parseRows, writeAtomically
+    store = map.getStore()
+    try:
+        rows = parseRows(args.rows, len(store.rowLabels))
+    except ValueError as error:
+        parser.error(f"--rows: {error}")
+    charts = args.charts.split(",")
+    formats = args.formats.split(",")
+    for chart in charts:
+        if chart not in chartSettings:
+            parser.error(f"unknown chart {chart}")
+
+    manifestPath = os.path.join(args.out, "manifest.json")
+    manifest = {"outputs": {}}
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as manifestFile:
+            manifest = json.load(manifestFile)
+    previousHashes = {path: entry["hash"] for path, entry in manifest["outputs"].items()}
+
+    start = time.perf_counter()
+    rendered = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_startWorker) as executor:
+        futures = {executor.submit(renderRow, chart, row, formats, args.out, previousHashes): (chart, row) for chart in charts for row in rows}
+        for done, future in enumerate(as_completed(futures), 1):
+            chart, row = futures[future]
+            try:
+                entries = future.result()
+            except Exception as error:
+                failed += 1
+                print(f"{chart} row {row} failed: {error!r}", file=sys.stderr)
+                continue
+            manifest["outputs"].update(entries)
+            for entry in entries.values():
+                if entry["skipped"]:
+                    skipped += 1
+                else:
+                    rendered += 1
+            if done % 50 == 0 or done == len(futures):
+                print(f"{done}/{len(futures)} rows, {rendered} rendered, {skipped} up to date, {failed} failed, {time.perf_counter() - start:.0f}s")
+
+    manifest["generated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    manifest["data"] = {path: mtime for path, mtime in zip((store.censusFilePath, store.neighbourhoodFilePath, store.citywardsFilePath), store.mtimes)}
+    writeAtomically(manifestPath, lambda manifestFile: json.dump(manifest, manifestFile, indent=1, sort_keys=True), mode="w")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,84 @@
+'''
+Benchmark for the geometry tiers in geometry.py: bytes on the wire and time to build, serialize and (optionally) render the census map at each tier.
+
+Run from the repository root:
+    python -m benchmarks.geometry [--render]
+'''
+import sys
+import gzip
+import json
+import time
+import os
+import argparse
+import plotly.io as pio
+#Nothing is warmed in the background while tiers are being timed
+os.environ["STARTUP_MODE"] = "lazy"
+import map
+from datastore import getStore
+from geometry import geometryTiers, geometryTier
+
+def _vertexCount (geoDataDict):
+    count = 0
+    for feature in geoDataDict["features"]:
+        for polygon in feature["geometry"]["coordinates"]:
+            for ring in polygon:
+                count += len(ring)
+    return count
+
+def benchmarkTier (store, tier, render=False):
+    '''
+    A function to measure one geometry tier.
+    ----
+    Parameters:
+        store - the store to measure (CensusStore)
+        tier - a key of geometryTiers (str)
+        render - also time a kaleido PNG render of the map (bool)
+    Returns:
+        result - the measurements for this tier (dict)
+    '''
+    neighbourhoods = geometryTier(store, "neighbourhood", tier)
+    wards = geometryTier(store, "ward", tier)
+
+    #Clears built templates so the first figure pays for a cold template build at this tier
+    map._mapTemplates.clear()
+    start = time.perf_counter()
+    figDict = map.censusMapFigure(map.neighbourhoodFilePath, map.censusFilePath, 37, "Value", [10, 43.710, -79.380, 2000, 1250], tier=tier)
+    buildSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    figJSON = pio.to_json(figDict, validate=False)
+    serializeSeconds = time.perf_counter() - start
+
+    result = {
+        "tier": tier,
+        "vertices": _vertexCount(neighbourhoods) + _vertexCount(wards),
+        "geometryBytes": len(json.dumps(neighbourhoods, separators=(",", ":"))) + len(json.dumps(wards, separators=(",", ":"))),
+        "figureBytes": len(figJSON),
+        "figureGzipBytes": len(gzip.compress(figJSON.encode())),
+        "templateBuildSeconds": buildSeconds,
+        "serializeSeconds": serializeSeconds,
+    }
+    if render:
+        start = time.perf_counter()
+        pio.to_image(figDict, format="png", engine="kaleido", width=1300, height=900)
+        result["renderSeconds"] = time.perf_counter() - start
+    return result
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Bytes and time saved by each geometry tier")
+    parser.add_argument("--render", action="store_true", help="also time a kaleido render of each tier (slow, needs map tiles)")
+    args = parser.parse_args(argv)
+
+    store = getStore()
+    results = [benchmarkTier(store, tier, args.render) for tier in geometryTiers]
+    full = results[0]
+    print(f"{'tier':<8}{'vertices':>10}{'figure KB':>11}{'gzip KB':>9}{'saved':>8}{'build ms':>10}{'json ms':>9}" + (f"{'render ms':>11}" if args.render else ""))
+    for result in results:
+        saved = 1 - result["figureBytes"] / full["figureBytes"]
+        line = f"{result['tier']:<8}{result['vertices']:>10}{result['figureBytes'] / 1024:>11.0f}{result['figureGzipBytes'] / 1024:>9.0f}{saved:>8.0%}{result['templateBuildSeconds'] * 1000:>10.1f}{result['serializeSeconds'] * 1000:>9.1f}"
+        if args.render:
+            line += f"{result['renderSeconds'] * 1000:>11.0f}"
+        print(line)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
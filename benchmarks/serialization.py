@@ -0,0 +1,103 @@
+'''
+Benchmark for figure serialization and response compression (figjson.py, compression.py): bytes on the wire and server time of the map callback, as a full figure and as a patch, for each content encoding.
+
+Run from the repository root:
+    python -m benchmarks.serialization [--repeat 20]
+'''
+import os
+import sys
+import time
+import argparse
+import plotly.io as pio
+#Nothing is warmed in the background while callbacks are being timed
+os.environ["STARTUP_MODE"] = "lazy"
+import map
+from geometry import geometryTier, chooseGeometryTier
+from figjson import compactFigure, compactTrace
+from datastore import getStore
+
+mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+
+def _callbackRequest (value, rowShown, classification="none", compareRow=""):
+    #The body dash-renderer posts to /_dash-update-component when the search box changes
+    outputs = [
+        {"id": "graph", "property": "figure"},
+        {"id": "graphBar", "property": "figure"},
+        {"id": "suggestion", "property": "children"},
+        {"id": "suggestion", "property": "style"},
+        {"id": "rowGlobalData", "property": "data"},
+    ]
+    return {
+        "output": ".." + "...".join(f"{output['id']}.{output['property']}" for output in outputs) + "..",
+        "outputs": outputs,
+        "inputs": [
+            {"id": "search", "property": "value", "value": value},
+            [],
+            {"id": "mapClassification", "property": "value", "value": classification},
+            {"id": "compareRow", "property": "value", "value": compareRow},
+            {"id": "comparisonMode", "property": "value", "value": "ratio"},
+            {"id": "mapLevel", "property": "value", "value": "neighbourhood"},
+        ],
+        "changedPropIds": ["search.value"],
+        "state": [{"id": "rowGlobalData", "property": "data", "value": rowShown}],
+    }
+
+def benchmarkCallback (client, body, encoding, repeat):
+    '''
+    A function to time the map callback through the Flask test client, as a browser would call it.
+    ----
+    Parameters:
+        client - a test client of map.server (flask.testing.FlaskClient)
+        body - the callback request (dict, see _callbackRequest)
+        encoding - the Accept-Encoding to send: "identity", "gzip" or "br" (str)
+        repeat - requests to time; the median is kept (int)
+    Returns:
+        result - response bytes and median seconds (dict)
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.post("/_dash-update-component", json=body, headers={"Accept-Encoding": encoding})
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    timings.sort()
+    return {"encoding": encoding, "bytes": len(response.data), "seconds": timings[len(timings) // 2]}
+
+def plainMapFigure (row):
+    '''The map as it was sent before figjson.py: every neighbourhood property kept and every array written out as a JSON list'''
+    store = getStore()
+    figDict = map.censusMapFigure(map.neighbourhoodFilePath, map.censusFilePath, row, "Value", mapZoomSettings)
+    choropleth = dict(figDict["data"][0], geojson=geometryTier(store, "neighbourhood", chooseGeometryTier(mapZoomSettings[0])))
+    return dict(figDict, data=[choropleth] + figDict["data"][1:])
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Measure map callback bytes and time for each content encoding")
+    parser.add_argument("--repeat", type=int, default=20, help="requests per measurement; the median is kept (default: 20)")
+    args = parser.parse_args(argv)
+
+    #Payload before and after compact encoding, without compression
+    plain = plainMapFigure(37)
+    compact = compactFigure(map.censusMapFigure(map.neighbourhoodFilePath, map.censusFilePath, 37, "Value", mapZoomSettings))
+    comparison = map.censusMapFigure(map.neighbourhoodFilePath, map.censusFilePath, 37, "Value", mapZoomSettings, comparison=(4, "perCapita"))["data"][0]
+    print("payload bytes (identity)")
+    print(f"  full map, plain:           {len(pio.to_json(plain, validate=False)):>9,}")
+    print(f"  full map, compact:         {len(pio.to_json(compact, validate=False)):>9,}")
+    print(f"  per-capita colouring, plain:   {len(pio.to_json({field: comparison[field] for field in ('z', 'customdata')}, validate=False)):>5,}")
+    print(f"  per-capita colouring, compact: {len(pio.to_json({field: compactTrace(comparison)[field] for field in ('z', 'customdata')}, validate=False)):>5,}")
+
+    client = map.server.test_client()
+    results = []
+    for name, body in (("full map", _callbackRequest("37", None)), ("patch", _callbackRequest("50", 37)), ("per-capita patch", _callbackRequest("50", 37, "jenks", "4"))):
+        #The first request warms the figure cache and geometry, so the timings below are of warm responses
+        client.post("/_dash-update-component", json=body)
+        for encoding in ("identity", "gzip", "br"):
+            result = benchmarkCallback(client, body, encoding, args.repeat)
+            result["request"] = name
+            results.append(result)
+    print(f"{'callback':<18}{'encoding':>10}{'bytes':>10}{'ms':>8}")
+    for result in results:
+        print(f"{result['request']:<18}{result['encoding']:>10}{result['bytes']:>10,}{result['seconds'] * 1000:>8.1f}")
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+'''
+Benchmark for censusBarStack in map.py: the vectorized builder against the previous melt-and-filter builder, copied as it was (reading the csv on every call), stacking k = 1, 10 and 50 rows.
+
+Run from the repository root:
+    python -m benchmarks.stack [--repeat 5] [--rows 1,10,50]
+'''
+import os
+import sys
+import time
+import numpy
+import builtins
+import argparse
+import textwrap
+import plotly.io as pio
+import plotly.graph_objects as go
+#Nothing is warmed in the background while builders are being timed
+os.environ["STARTUP_MODE"] = "lazy"
+import map
+from datastore import getStore
+
+def meltStack (dataSource, input_array):
+    '''The stacked bar builder censusBarStack replaced, as it was before the data store: reads the csv, copies each row with iloc and float(), melts the rows into one long DataFrame, then filters it once per row and validates every trace through go.Bar. Only rows without text cells can be stacked, as float() fails on them'''
+    import pandas
+    i = 0
+    n = 0
+    rowArray = []
+    graphTitleArray = []
+    categoryValuesDict = {}
+
+    #Load census csv data
+
+    censusData = pandas.read_csv(dataSource)
+
+    while i < len(input_array):
+        rowArray.append(censusData.iloc[input_array[i]])
+        graphTitleArray.append(censusData.iloc[input_array[i]]["Neighbourhood Name"])
+        i += 1
+
+    for index, row in enumerate(rowArray):
+        key = f"categoryValues_{index+1}"
+        #builtins.map, since map is map.py here
+        categoryValuesDict[key] = list(builtins.map(float, row.iloc[1:].values))
+
+    x_values = rowArray[0].index[1:]
+    graphData = {"Neighbourhoood": x_values}
+
+    for key, y_values in categoryValuesDict.items():
+        graphData[key] = y_values
+
+    graphDataFrame = pandas.DataFrame(graphData)
+
+    plotMelt_censusData = graphDataFrame.melt(id_vars="Neighbourhoood", var_name="Category", value_name="Value")
+
+    #Assign bar graph variable
+    fig_bar_stack = go.Figure()
+
+    #Plotly tracing
+    for category in plotMelt_censusData['Category'].unique():
+        category_data = plotMelt_censusData[plotMelt_censusData ['Category'] == category]
+        fig_bar_stack.add_trace(go.Bar(
+            x=category_data["Neighbourhoood"],
+            y=category_data["Value"],
+            name= "<br>".join(textwrap.wrap(graphTitleArray[n], width=18))
+        ))
+        n += 1
+
+    #Render bar graph
+    fig_bar_stack.update_layout(
+        xaxis_title="Neighbourhoood<br> Made with torontocensusvisualizer.com",
+        yaxis_title="Value",
+        barmode="stack",
+        hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
+        title={"text": "Multi-variable stacked bar graph using Census 2021 data, City of Toronto", "x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
+        xaxis_title_font=dict(family="proxima-nova, sans-serif"),
+        yaxis_title_font=dict(family="proxima-nova, sans-serif"),
+        font=dict(family="proxima-nova, sans-serif")
+    )
+    return fig_bar_stack
+
+def _timeBuild (build, dataSource, input_array, repeat):
+    #Best of repeat runs, build and serialization timed separately
+    buildSeconds = serializeSeconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        figure = build(dataSource, input_array)
+        buildSeconds = min(buildSeconds, time.perf_counter() - start)
+        start = time.perf_counter()
+        pio.to_json(figure, validate=False)
+        serializeSeconds = min(serializeSeconds, time.perf_counter() - start)
+    return figure, buildSeconds, serializeSeconds
+
+def benchmarkStack (store, rowCount, repeat=5):
+    '''
+    A function to time both builders stacking the same rows, and check they draw the same bars.
+    ----
+    Parameters:
+        store - the store to read rows from (CensusStore)
+        rowCount - how many rows to stack (int)
+        repeat - runs per builder; the fastest is kept (int)
+    Returns:
+        result - the measurements for this row count (dict)
+    '''
+    #Evenly spread rows without text cells, which the previous builder cannot read, as row indexes like input_array holds
+    numericRows = [rowIndex for rowIndex in range(len(store.rowLabels)) if not store.nanMask[rowIndex].any()]
+    input_array = numericRows[::len(numericRows) // rowCount][:rowCount]
+
+    oldFigure, oldBuild, oldSerialize = _timeBuild(meltStack, store.censusFilePath, input_array, repeat)
+    newFigure, newBuild, newSerialize = _timeBuild(map.censusBarStack, store.censusFilePath, input_array, repeat)
+    same = all(
+        list(oldTrace.x) == newTrace["x"] and numpy.array_equal(oldTrace.y, newTrace["y"], equal_nan=True) and oldTrace.name == newTrace["name"]
+        for oldTrace, newTrace in zip(oldFigure.data, newFigure["data"])
+    ) and len(oldFigure.data) == len(newFigure["data"]) and oldFigure.layout.to_plotly_json() == newFigure["layout"]
+    return {
+        "rows": rowCount,
+        "meltBuildSeconds": oldBuild,
+        "meltSerializeSeconds": oldSerialize,
+        "vectorBuildSeconds": newBuild,
+        "vectorSerializeSeconds": newSerialize,
+        "sameBars": same,
+    }
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Time the stacked bar builders at several stack sizes")
+    parser.add_argument("--rows", default="1,10,50", help="comma-separated numbers of stacked rows (default: 1,10,50)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per builder; the fastest is kept (default: 5)")
+    args = parser.parse_args(argv)
+
+    store = getStore()
+    results = [benchmarkStack(store, int(rowCount), args.repeat) for rowCount in args.rows.split(",")]
+    print(f"{'rows':>5}{'melt ms':>10}{'vector ms':>11}{'speedup':>9}{'json ms':>9}{'same bars':>11}")
+    for result in results:
+        speedup = result["meltBuildSeconds"] / result["vectorBuildSeconds"]
+        print(f"{result['rows']:>5}{result['meltBuildSeconds'] * 1000:>10.1f}{result['vectorBuildSeconds'] * 1000:>11.1f}{speedup:>8.1f}x{result['vectorSerializeSeconds'] * 1000:>9.1f}{str(result['sameBars']):>11}")
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
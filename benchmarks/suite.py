@@ -0,0 +1,403 @@
+'''
+Benchmark suite for map.py's chart builders and callbacks, run offline against the files in data/. Each case runs in a fresh process, so its first call is cold (nothing built, only the on-disk caches in data/cache) and its peak memory is its own; later calls in the same process are warm. Callbacks are driven through the Flask test client with the same requests the browser sends.
+
+Results are written as JSON so runs can be compared between commits, e.g.
+
+    python -m benchmarks.suite --out before.json
+    (check out another commit)
+    python -m benchmarks.suite --out after.json --compare before.json
+
+Run from the repository root. Cases: censusMap, censusBar, censusBarStack, searchTyping, rowLookup, mapModes, stackGrowth, exportBar, exportMap, exportStack (--cases picks some).
+'''
+import os
+import sys
+import json
+import gzip
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+
+mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+
+def _peakRSS ():
+    #ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak * (1 if sys.platform == "darwin" else 1024)
+
+def _median (values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+def timeCalls (call, repeat):
+    '''
+    A function to time a call cold (its first run in this process) and warm (the median of repeat more runs).
+    ----
+    Parameters:
+        call - the call to time (function taking no arguments)
+        repeat - warm runs (int)
+    Returns:
+        coldSeconds, warmSeconds - the first run and the median warm run (float)
+        result - what the last run returned
+    '''
+    start = time.perf_counter()
+    result = call()
+    coldSeconds = time.perf_counter() - start
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        timings.append(time.perf_counter() - start)
+    return coldSeconds, _median(timings), result
+
+def payloadSizes (body):
+    '''Returns the size of a response or serialized figure (bytes or str), as sent and gzipped (dict)'''
+    if isinstance(body, str):
+        body = body.encode()
+    return {"payloadBytes": len(body), "payloadGzipBytes": len(gzip.compress(body, 6))}
+
+def dashRequest (app, callbackName, inputs, state=(), changed=None):
+    '''
+    A function to build the body dash-renderer posts to /_dash-update-component to call one of the app's callbacks.
+    ----
+    Parameters:
+        app - the Dash app (dash.Dash)
+        callbackName - the callback's function name, e.g. "update_output" (str)
+        inputs - (component id, property, value) for each input, or a list of {"id", "property", "value"} dicts for a pattern-matching input (list)
+        state - (component id, property, value) for each state (list of tuples)
+        changed - the "id.property" that triggered the callback; defaults to the first input (str)
+    Returns:
+        body - the request body (dict)
+    '''
+    #Outputs are taken from the app's own key, which carries the suffix Dash gives outputs with allow_duplicate
+    output = next(key for key, spec in app.callback_map.items() if getattr(spec["callback"], "__wrapped__", spec["callback"]).__name__ == callbackName)
+    outputList = []
+    for part in output.strip(".").split("..."):
+        componentId, _, prop = part.partition("@")[0].rpartition(".")
+        outputList.append({"id": componentId, "property": prop})
+    inputList = [item if isinstance(item, list) else {"id": item[0], "property": item[1], "value": item[2]} for item in inputs]
+    if changed is None:
+        changed = f"{inputs[0][0]}.{inputs[0][1]}"
+    return {
+        "output": output,
+        "outputs": outputList if output.startswith("..") else outputList[0],
+        "inputs": inputList,
+        "changedPropIds": [changed],
+        "state": [{"id": componentId, "property": prop, "value": value} for componentId, prop, value in state],
+    }
+
+def _post (client, body):
+    response = client.post("/_dash-update-component", json=body, headers={"Accept-Encoding": "identity"})
+    if response.status_code == 204:
+        return None, b""
+    if response.status_code != 200:
+        raise RuntimeError(f"{body['output']} returned {response.status_code}: {response.data[:500]!r}")
+    return response.get_json(), response.data
+
+def _showRowRequest (app, value, rowShown, classification="none", compareRow="", comparisonMode="ratio", changed="search.value", level="neighbourhood"):
+    return dashRequest(
+        app, "update_output",
+        [("search", "value", value), [], ("mapClassification", "value", classification), ("compareRow", "value", compareRow), ("comparisonMode", "value", comparisonMode), ("mapLevel", "value", level)],
+        [("rowGlobalData", "data", rowShown)],
+        changed,
+    )
+
+def _stackRequest (app, stackSession, value, clicks=1):
+    return dashRequest(
+        app, "update_array",
+        [("multiVarConfirm", "n_clicks", clicks), [], []],
+        [("stackSession", "data", stackSession), ("multiVarInput", "value", value)],
+    )
+
+def caseCensusMap (map, client, repeat):
+    '''censusMap: the full go.Figure map of one row, as exported'''
+    import plotly.io as pio
+    cold, warm, fig = timeCalls(lambda: map.censusMap(map.neighbourhoodFilePath, map.censusFilePath, 37, "Value", mapZoomSettings), repeat)
+    return dict(coldSeconds=cold, warmSeconds=warm, **payloadSizes(pio.to_json(fig, validate=False)))
+
+def caseCensusBar (map, client, repeat):
+    '''censusBar: the single bar graph of one row'''
+    import plotly.io as pio
+    cold, warm, fig = timeCalls(lambda: map.censusBar(map.censusFilePath, 37), repeat)
+    return dict(coldSeconds=cold, warmSeconds=warm, **payloadSizes(pio.to_json(fig, validate=False)))
+
+def caseCensusBarStack (map, client, repeat):
+    '''censusBarStack: ten stacked rows'''
+    import plotly.io as pio
+    rows = list(range(35, 45))
+    cold, warm, fig = timeCalls(lambda: map.censusBarStack(map.censusFilePath, rows), repeat)
+    return dict(coldSeconds=cold, warmSeconds=warm, rows=len(rows), **payloadSizes(pio.to_json(fig, validate=False)))
+
+def caseSearchTyping (map, client, repeat):
+    '''update_output and update_array: search suggestions for each keystroke of a query, as if the search boxes were not debounced'''
+    query = "population aged 15"
+    prefixes = [query[:length] for length in range(1, len(query) + 1)]
+    start = time.perf_counter()
+    _, body = _post(client, _showRowRequest(map.app, prefixes[0], None))
+    cold = time.perf_counter() - start
+    timings = []
+    for _ in range(max(1, repeat // len(prefixes))):
+        for prefix in prefixes:
+            start = time.perf_counter()
+            _, body = _post(client, _showRowRequest(map.app, prefix, None))
+            timings.append(time.perf_counter() - start)
+    stackTimings = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        _post(client, _stackRequest(map.app, None, prefix))
+        stackTimings.append(time.perf_counter() - start)
+    return dict(coldSeconds=cold, warmSeconds=_median(timings), stackWarmSeconds=_median(stackTimings), keystrokes=len(prefixes), **payloadSizes(body))
+
+def caseRowLookup (map, client, repeat):
+    '''update_output: the first map and bar graph of a visit, then changing rows (sent as patches)'''
+    cold, warm, (_, body) = timeCalls(lambda: _post(client, _showRowRequest(map.app, "37", None)), repeat)
+    result = dict(coldSeconds=cold, warmSeconds=warm, **payloadSizes(body))
+    rows = [40 + 7 * i for i in range(max(repeat, 2))]
+    patchCold, patchWarm, (_, patchBody) = timeCalls(lambda: _post(client, _showRowRequest(map.app, str(rows.pop()), 37)), len(rows) - 1)
+    result.update(patchColdSeconds=patchCold, patchWarmSeconds=patchWarm, patchPayloadBytes=len(patchBody))
+    return result
+
+def caseMapModes (map, client, repeat):
+    '''update_output: recolouring the map by classification and by comparison with a second row, and switching it to wards'''
+    _post(client, _showRowRequest(map.app, "37", None))
+    result = {}
+    for name, classification, compareRow, changed in (
+        ("jenks", "jenks", "", "mapClassification.value"),
+        ("quantile", "quantile", "", "mapClassification.value"),
+        ("perCapita", "none", "4", "compareRow.value"),
+    ):
+        cold, warm, (_, body) = timeCalls(lambda: _post(client, _showRowRequest(map.app, "37", 37, classification, compareRow, "perCapita", changed)), repeat)
+        result.update({f"{name}ColdSeconds": cold, f"{name}WarmSeconds": warm, f"{name}PayloadBytes": len(body)})
+    result.update(coldSeconds=result["jenksColdSeconds"], warmSeconds=result["jenksWarmSeconds"], payloadBytes=result["jenksPayloadBytes"])
+    #Switching to wards sends the ward map whole; changing rows on it sends patches
+    cold, warm, (_, body) = timeCalls(lambda: _post(client, _showRowRequest(map.app, "37", 37, changed="mapLevel.value", level="wardSum")), repeat)
+    result.update(wardColdSeconds=cold, wardWarmSeconds=warm, wardPayloadBytes=len(body))
+    rows = [40 + 7 * i for i in range(max(repeat, 2))]
+    cold, warm, (_, body) = timeCalls(lambda: _post(client, _showRowRequest(map.app, str(rows.pop()), 37, level="wardSum")), len(rows) - 1)
+    result.update(wardPatchColdSeconds=cold, wardPatchWarmSeconds=warm, wardPatchPayloadBytes=len(body))
+    return result
+
+def caseStackGrowth (map, client, repeat):
+    '''update_array: adding rows to the stacked bar graph one at a time (the first as a full figure, the rest as patches), then removing one'''
+    rowCount = max(repeat, 20)
+    stackSession = None
+    timings = []
+    sizes = []
+    for i in range(rowCount):
+        start = time.perf_counter()
+        response, body = _post(client, _stackRequest(map.app, stackSession, str(40 + i), i + 1))
+        timings.append(time.perf_counter() - start)
+        sizes.append(len(body))
+        stackSession = response["response"]["stackSession"]["data"]
+    #Removing the first row, by the key on its remove button
+    removeBody = dashRequest(
+        map.app, "update_array",
+        [("multiVarConfirm", "n_clicks", rowCount), [{"id": {"type": "remove-btn", "index": 0}, "property": "n_clicks", "value": 1}], []],
+        [("stackSession", "data", stackSession), ("multiVarInput", "value", "40")],
+        changed='{"index":0,"type":"remove-btn"}.n_clicks',
+    )
+    start = time.perf_counter()
+    _, body = _post(client, removeBody)
+    removeSeconds = time.perf_counter() - start
+    return dict(
+        coldSeconds=timings[0],
+        warmSeconds=_median(timings[1:]),
+        rows=rowCount,
+        lastAddSeconds=timings[-1],
+        removeSeconds=removeSeconds,
+        firstPayloadBytes=sizes[0],
+        payloadBytes=_median(sizes[1:]),
+        lastPayloadBytes=sizes[-1],
+        removePayloadBytes=len(body),
+    )
+
+def _export (map, client, button, rowShown, stackSession):
+    '''
+    A function to press an export button and poll for the file as the browser would, until it is downloaded or has failed.
+    ----
+    Parameters:
+        map - the app module
+        client - a test client of map.server (flask.testing.FlaskClient)
+        button - "exportPDFBar", "exportPDFMap" or "exportPDFStack" (str)
+        rowShown - the row in the map and bar graph (int)
+        stackSession - the session of the stacked bar graph (str)
+    Returns:
+        result - seconds to queue the export and until it finished, the number of polls, "done" or the error shown, and the last poll response (dict)
+    '''
+    clicks = {"exportPDFBar": 0, "exportPDFMap": 0, "exportPDFStack": 0}
+    clicks[button] = 1
+    startBody = dashRequest(
+        map.app, "start_export",
+        [(name, "n_clicks", value) for name, value in clicks.items()],
+        [("exportJobs", "data", []), ("rowGlobalData", "data", rowShown), ("stackSession", "data", stackSession), ("mapClassification", "value", "none"), ("compareRow", "value", ""), ("comparisonMode", "value", "ratio"), ("mapLevel", "value", "neighbourhood")],
+        changed=f"{button}.n_clicks",
+    )
+    start = time.perf_counter()
+    response, _ = _post(client, startBody)
+    submitSeconds = time.perf_counter() - start
+    exportJobs = response["response"]["exportJobs"]["data"]
+    status = "running"
+    body = b""
+    polls = 0
+    while exportJobs and time.perf_counter() - start < 300:
+        time.sleep(0.05)
+        polls += 1
+        response, body = _post(client, dashRequest(map.app, "poll_export", [("exportPoll", "n_intervals", polls)], [("exportJobs", "data", exportJobs)]))
+        outputs = response["response"]
+        exportJobs = outputs["exportJobs"]["data"]
+        if any(outputs.get(name, {}).get("data") for name in ("downloadPDFBar", "downloadPDFMap", "downloadPDFStack")):
+            status = "done"
+        elif not exportJobs:
+            status = outputs["exportStatus"]["children"] or "error"
+    return {"seconds": time.perf_counter() - start, "submitSeconds": submitSeconds, "polls": polls, "status": status, "body": body}
+
+def _exportCase (target, button):
+    def caseExport (map, client, repeat):
+        #Every export needs something to export: the row shown, and for the stack, a few stacked rows
+        _post(client, _showRowRequest(map.app, "37", None))
+        stackSession = None
+        for i in range(3):
+            response, _ = _post(client, _stackRequest(map.app, stackSession, str(40 + i), i + 1))
+            stackSession = response["response"]["stackSession"]["data"]
+        cold = _export(map, client, button, 37, stackSession)
+        #A second, different figure (identical exports share one job), once the renderers are running
+        _post(client, _stackRequest(map.app, stackSession, "43", 4))
+        warm = _export(map, client, button, 38, stackSession)
+        return dict(
+            coldSeconds=cold["seconds"],
+            warmSeconds=warm["seconds"],
+            submitSeconds=warm["submitSeconds"],
+            polls=warm["polls"],
+            status=cold["status"] if cold["status"] != "done" else warm["status"],
+            **payloadSizes(warm["body"]),
+        )
+    caseExport.__doc__ = f"start_export and poll_export: exporting the {target} as a PDF, from the button press until the download is sent; cold includes starting the kaleido renderers"
+    return caseExport
+
+cases = {
+    "censusMap": caseCensusMap,
+    "censusBar": caseCensusBar,
+    "censusBarStack": caseCensusBarStack,
+    "searchTyping": caseSearchTyping,
+    "rowLookup": caseRowLookup,
+    "mapModes": caseMapModes,
+    "stackGrowth": caseStackGrowth,
+    "exportBar": _exportCase("bar graph", "exportPDFBar"),
+    "exportMap": _exportCase("map", "exportPDFMap"),
+    "exportStack": _exportCase("stacked bar graph", "exportPDFStack"),
+}
+
+def runCase (name, repeat):
+    '''
+    A function to run one case in this process; the suite calls it in a fresh process per case (see main).
+    ----
+    Parameters:
+        name - a key of cases (str)
+        repeat - warm runs (int)
+    Returns:
+        result - timings in seconds, payload sizes in bytes, and the process's memory before and after (dict)
+    '''
+    start = time.perf_counter()
+    import map
+    importSeconds = time.perf_counter() - start
+    client = map.server.test_client()
+    rssBefore = _peakRSS()
+    result = cases[name](map, client, repeat)
+    result.update(case=name, importSeconds=importSeconds, rssAfterImportBytes=rssBefore, peakRSSBytes=_peakRSS())
+    return result
+
+def _commit ():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _childEnvironment (emptyFolder):
+    environment = dict(os.environ)
+    #Nothing warms in the background, no snapshot, shared figure cache or earlier export answers for the code being measured, and sessions stay in the one process
+    environment.update(STARTUP_MODE="lazy", SNAPSHOT_FOLDER=os.path.join(emptyFolder, "snapshots"), EXPORT_FOLDER=os.path.join(emptyFolder, "exports"), SESSION_BACKEND="memory")
+    environment.pop("FIGURE_CACHE_FOLDER", None)
+    return environment
+
+def _formatSeconds (seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+def compareResults (results, baseline):
+    '''
+    A function to print how each case changed against an earlier run.
+    ----
+    Parameters:
+        results, baseline - suite results (dict, see main)
+    '''
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    print(f"{'case':<16}{'cold':>10}{'warm':>10}{'payload':>10}{'peak RSS':>10}")
+    for name, result in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None or "error" in result or "error" in before:
+            continue
+        ratios = []
+        for key in ("coldSeconds", "warmSeconds", "payloadBytes", "peakRSSBytes"):
+            if result.get(key) and before.get(key):
+                ratios.append(f"{result[key] / before[key]:>9.2f}x")
+            else:
+                ratios.append(f"{'-':>10}")
+        print(f"{name:<16}" + "".join(ratios))
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Time map.py's chart builders and callbacks, cold and warm")
+    parser.add_argument("--cases", default=",".join(cases), help="comma-separated cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=10, help="warm runs per case; the median is kept (default: 10)")
+    parser.add_argument("--out", default=None, help="where to write the results (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="an earlier results file to compare against")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(runCase(args.child, args.repeat)))
+        return 0
+
+    names = args.cases.split(",")
+    for name in names:
+        if name not in cases:
+            parser.error(f"unknown case {name}")
+    results = {
+        "commit": _commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "cases": {},
+    }
+    print(f"{'case':<16}{'cold ms':>10}{'warm ms':>10}{'payload KB':>12}{'peak RSS MB':>13}")
+    with tempfile.TemporaryDirectory() as emptyFolder:
+        for name in names:
+            child = subprocess.run(
+                [sys.executable, "-m", "benchmarks.suite", "--child", name, "--repeat", str(args.repeat)],
+                capture_output=True, text=True, env=_childEnvironment(emptyFolder),
+            )
+            try:
+                result = json.loads(child.stdout.strip().splitlines()[-1])
+            except (IndexError, ValueError):
+                result = {"case": name, "error": child.stderr.strip().splitlines()[-1] if child.stderr.strip() else f"exit code {child.returncode}"}
+                print(f"{name:<16}failed: {result['error']}")
+                results["cases"][name] = result
+                continue
+            results["cases"][name] = result
+            payload = result.get("payloadBytes")
+            print(f"{name:<16}{_formatSeconds(result['coldSeconds']):>10}{_formatSeconds(result['warmSeconds']):>10}{'-' if payload is None else f'{payload / 1024:.1f}':>12}{result['peakRSSBytes'] / 2 ** 20:>13.0f}" + (f"  {result['status']}" if "status" in result else ""))
+
+    out = args.out or os.path.join("benchmarks", "results", f"{results['commit'] or 'results'}.json")
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as resultsFile:
+        json.dump(results, resultsFile, indent=1)
+    print(f"Results written to {out}")
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            compareResults(results, json.load(baselineFile))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
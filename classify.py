@@ -0,0 +1,184 @@
+import os
+import numpy
+import warnings
+import threading
+from datastore import writeAtomically
+
+#The ways the map can colour neighbourhoods: raw values on a continuous scale, or one of the precomputed classifications
+classificationModes = {
+    "none": "Values",
+    "quantile": "Quantiles",
+    "jenks": "Natural breaks (Jenks)",
+    "equal": "Equal intervals",
+}
+classCount = int(os.environ.get("MAP_CLASS_COUNT", 5))
+classificationCacheFolder = "data/cache"
+
+def quantileBreaks (censusMatrix, classes=classCount):
+    '''Returns, for every row, the classes + 1 boundaries that put the same number of neighbourhoods in each class (rows x classes + 1 numpy array, NaN for rows without numbers)'''
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return numpy.nanpercentile(censusMatrix, numpy.linspace(0, 100, classes + 1), axis=1).T
+
+def equalIntervalBreaks (censusMatrix, classes=classCount):
+    '''Returns, for every row, the classes + 1 boundaries that split the range from its minimum to its maximum into equal steps (rows x classes + 1 numpy array)'''
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        minimum = numpy.nanmin(censusMatrix, axis=1)
+        maximum = numpy.nanmax(censusMatrix, axis=1)
+    return minimum[:, None] + (maximum - minimum)[:, None] * numpy.linspace(0, 1, classes + 1)
+
+def jenksBreaks (censusMatrix, classes=classCount):
+    '''
+    A function to find Jenks natural breaks for every row at once: the class boundaries that minimise the sum of squared deviations from each class mean. Uses Fisher's exact dynamic programme over the sorted values, run for all rows together so each step is one NumPy operation over the whole matrix. Rows with fewer numbers than classes fall back to quantile breaks.
+    ----
+    Parameters:
+        censusMatrix - every census value, rows x neighbourhoods, NaN where a cell is not a number (numpy float64 array)
+        classes - the number of classes (int)
+    Returns:
+        breaks - the classes + 1 boundaries of every row, from its minimum to its maximum (rows x classes + 1 numpy array)
+    '''
+    rowCount, columnCount = censusMatrix.shape
+    #NaN sorts last, so the first counts[row] values of each sorted row are its numbers
+    sortedValues = numpy.sort(censusMatrix, axis=1)
+    counts = (~numpy.isnan(censusMatrix)).sum(axis=1)
+    filledValues = numpy.nan_to_num(sortedValues)
+    sums = numpy.concatenate([numpy.zeros((rowCount, 1)), numpy.cumsum(filledValues, axis=1)], axis=1)
+    squareSums = numpy.concatenate([numpy.zeros((rowCount, 1)), numpy.cumsum(filledValues ** 2, axis=1)], axis=1)
+
+    #cost[:, j] is the least total deviation of the first j values split into the classes so far; back[m][:, j] is where the last of m + 1 classes starts
+    cost = numpy.full((rowCount, columnCount + 1), numpy.inf)
+    cost[:, 0] = 0
+    back = numpy.zeros((classes, rowCount, columnCount + 1), dtype=numpy.intp)
+    rows = numpy.arange(rowCount)
+    for m in range(classes):
+        newCost = numpy.full_like(cost, numpy.inf)
+        for j in range(m + 1, columnCount + 1):
+            starts = numpy.arange(j)
+            lengths = j - starts
+            segmentSums = sums[:, j, None] - sums[:, :j]
+            deviation = squareSums[:, j, None] - squareSums[:, :j] - segmentSums ** 2 / lengths
+            candidates = cost[:, :j] + deviation
+            best = numpy.argmin(candidates, axis=1)
+            back[m, :, j] = best
+            newCost[:, j] = candidates[rows, best]
+        cost = newCost
+
+    breaks = numpy.empty((rowCount, classes + 1))
+    end = numpy.maximum(counts, classes)
+    breaks[:, classes] = sortedValues[rows, numpy.maximum(counts - 1, 0)]
+    for m in range(classes - 1, 0, -1):
+        start = back[m, rows, end]
+        #A class boundary is the largest value of the class below it
+        breaks[:, m] = sortedValues[rows, numpy.maximum(start - 1, 0)]
+        end = start
+    breaks[:, 0] = sortedValues[:, 0]
+    fewValues = counts < classes
+    if fewValues.any():
+        breaks[fewValues] = quantileBreaks(censusMatrix[fewValues], classes)
+    return breaks
+
+def classifyValues (censusMatrix, breaks):
+    '''Returns the class of every value given its row's breaks, 0 for the lowest class, -1 where the value is not a number (rows x neighbourhoods numpy int8 array). A value on an inner boundary belongs to the class below it'''
+    innerBreaks = breaks[:, 1:-1]
+    classes = (censusMatrix[:, :, None] > innerBreaks[:, None, :]).sum(axis=2).astype(numpy.int8)
+    classes[numpy.isnan(censusMatrix)] = -1
+    return classes
+
+def rankValues (censusMatrix):
+    '''
+    A function to rank the neighbourhoods within every row at once.
+    ----
+    Parameters:
+        censusMatrix - every census value, rows x neighbourhoods (numpy float64 array)
+    Returns:
+        ranks - 1 for the highest value in the row, 0 where the value is not a number (rows x neighbourhoods numpy int16 array)
+        percentiles - the share of the row's numbers at or below each value, 0 to 100, NaN where the value is not a number (rows x neighbourhoods numpy float32 array)
+    '''
+    counts = (~numpy.isnan(censusMatrix)).sum(axis=1, keepdims=True)
+    #Sorting -values puts the highest first and NaN last; ties share the best rank of their group
+    order = numpy.argsort(-censusMatrix, axis=1, kind="stable")
+    sortedValues = numpy.take_along_axis(censusMatrix, order, axis=1)
+    positions = numpy.arange(censusMatrix.shape[1])
+    newGroup = numpy.ones(censusMatrix.shape, dtype=bool)
+    newGroup[:, 1:] = sortedValues[:, 1:] != sortedValues[:, :-1]
+    sortedRanks = numpy.maximum.accumulate(numpy.where(newGroup, positions, 0), axis=1) + 1
+    ranks = numpy.empty(censusMatrix.shape, dtype=numpy.int16)
+    numpy.put_along_axis(ranks, order, sortedRanks, axis=1)
+    nanMask = numpy.isnan(censusMatrix)
+    ranks[nanMask] = 0
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        #Everything from a value's tie group down is at or below it
+        percentiles = (100 * (counts - ranks + 1) / counts).astype(numpy.float32)
+    percentiles[nanMask] = numpy.nan
+    return ranks, percentiles
+
+class Classification:
+    '''
+    Every row's classifications (quantile, Jenks and equal-interval breaks and classes) and every neighbourhood's rank and percentile within each row, computed for the whole census matrix at once. Built once per store, so colouring a map by any mode is a lookup.
+    ----
+    Parameters:
+        censusMatrix - every census value, rows x neighbourhoods (numpy float64 array)
+        classes - the number of classes (int)
+        arrays - previously computed arrays (see getClassification) to use instead of computing them from censusMatrix (dict)
+    '''
+    def __init__ (self, censusMatrix, classes=classCount, arrays=None):
+        self.classes = classes
+        if arrays is None:
+            censusMatrix = numpy.asarray(censusMatrix)
+            arrays = {}
+            for mode, findBreaks in (("quantile", quantileBreaks), ("jenks", jenksBreaks), ("equal", equalIntervalBreaks)):
+                arrays[f"{mode}Breaks"] = findBreaks(censusMatrix, classes)
+                arrays[f"{mode}Classes"] = classifyValues(censusMatrix, arrays[f"{mode}Breaks"])
+            arrays["ranks"], arrays["percentiles"] = rankValues(censusMatrix)
+        self.arrays = arrays
+
+    def breaks (self, mode, rowIndex):
+        '''Returns the classes + 1 class boundaries of one row (0-based) for a mode of classificationModes'''
+        return self.arrays[f"{mode}Breaks"][rowIndex]
+
+    def rowClasses (self, mode, rowIndex):
+        '''Returns the class of each neighbourhood in one row (0-based), in census column order, -1 where there is no number'''
+        return self.arrays[f"{mode}Classes"][rowIndex]
+
+    def ranks (self, rowIndex):
+        '''Returns each neighbourhood's rank in one row (0-based), 1 for the highest, in census column order'''
+        return self.arrays["ranks"][rowIndex]
+
+    def percentiles (self, rowIndex):
+        '''Returns each neighbourhood's percentile in one row (0-based), in census column order'''
+        return self.arrays["percentiles"][rowIndex]
+
+_classifications = {}
+_classificationLock = threading.Lock()
+
+def _cachePath (censusPath, classes):
+    stem = os.path.splitext(os.path.basename(censusPath))[0]
+    return os.path.join(classificationCacheFolder, f"{stem}.classes{classes}.npz")
+
+def getClassification (store, classes=classCount):
+    '''
+    A function to get the classification of a store, computing it on first use. It is cached in memory and in classificationCacheFolder; a cached file older than the census csv is rebuilt.
+    ----
+    Parameters:
+        store - the store to classify (CensusStore)
+        classes - the number of classes (int)
+    Returns:
+        classification - the shared classification (Classification)
+    '''
+    key = (store.censusFilePath, classes)
+    cached = _classifications.get(key)
+    if cached is None or cached[0] is not store:
+        with _classificationLock:
+            cached = _classifications.get(key)
+            if cached is None or cached[0] is not store:
+                cachePath = _cachePath(store.censusFilePath, classes)
+                if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= os.path.getmtime(store.censusFilePath):
+                    with numpy.load(cachePath) as cacheFile:
+                        classification = Classification(None, classes, arrays=dict(cacheFile))
+                else:
+                    classification = Classification(store.censusMatrix, classes)
+                    writeAtomically(cachePath, lambda cacheFile: numpy.savez(cacheFile, **classification.arrays))
+                cached = (store, classification)
+                _classifications[key] = cached
+    return cached[1]
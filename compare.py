@@ -0,0 +1,137 @@
+import numpy
+import threading
+from stats import rowStatNames, computeRowStats
+
+#Ways of drawing row A against row B on the map: (menu label, what joins the two row labels in the map title)
+comparisonModes = {
+    "ratio": ("Ratio (A ÷ B)", "÷"),
+    "difference": ("Difference (A − B)", "−"),
+    "perCapita": ("Per 1,000 of B", "per 1,000 of"),
+}
+correlationMethods = {
+    "pearson": "Pearson",
+    "spearman": "Spearman",
+}
+
+def compareRows (store, rowIndex, compareIndex, comparison):
+    '''
+    A function to combine two census rows neighbourhood by neighbourhood, e.g. a count divided by the total population row.
+    ----
+    Parameters:
+        store - the store holding both rows (CensusStore)
+        rowIndex - row A, 0-based (int)
+        compareIndex - row B, 0-based (int)
+        comparison - a key of comparisonModes (str)
+    Returns:
+        values - the combined value of every neighbourhood in census column order, NaN where either row has no number or B is 0 for a division (numpy float64 array)
+    '''
+    return combineValues(store.rowValues(rowIndex), store.rowValues(compareIndex), comparison)
+
+def combineValues (rowA, rowB, comparison):
+    '''Same as compareRows, for two arrays of values rather than two stored rows, e.g. rows aggregated to wards (numpy float64 array)'''
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if comparison == "ratio":
+            values = rowA / rowB
+        elif comparison == "difference":
+            values = rowA - rowB
+        elif comparison == "perCapita":
+            values = 1000 * rowA / rowB
+        else:
+            raise ValueError(f"Unknown comparison {comparison}")
+    values[~numpy.isfinite(values)] = numpy.nan
+    return values
+
+def summarizeValues (values):
+    '''Returns the same statistics as CensusStore.rowSummary for values that are not a stored row, e.g. from compareRows (dict)'''
+    return dict(zip(rowStatNames, computeRowStats(values[None, :])[0].tolist()))
+
+def _averageRanks (censusMatrix):
+    #Ranks within every row, 1 for the lowest, ties sharing the average of their positions; NaN stays NaN
+    order = numpy.argsort(censusMatrix, axis=1, kind="stable")
+    sortedValues = numpy.take_along_axis(censusMatrix, order, axis=1)
+    positions = numpy.broadcast_to(numpy.arange(1, censusMatrix.shape[1] + 1, dtype=numpy.float64), censusMatrix.shape)
+    newGroup = numpy.ones(censusMatrix.shape, dtype=bool)
+    newGroup[:, 1:] = sortedValues[:, 1:] != sortedValues[:, :-1]
+    groupIds = numpy.cumsum(newGroup, axis=1) - 1
+    #The average position of each tie group, found with one bincount over every row
+    offsets = (numpy.arange(censusMatrix.shape[0]) * censusMatrix.shape[1])[:, None]
+    flatIds = (groupIds + offsets).ravel()
+    averages = numpy.bincount(flatIds, weights=positions.ravel(), minlength=censusMatrix.size) / numpy.maximum(numpy.bincount(flatIds, minlength=censusMatrix.size), 1)
+    ranks = numpy.empty(censusMatrix.shape)
+    numpy.put_along_axis(ranks, order, averages[flatIds].reshape(censusMatrix.shape), axis=1)
+    ranks[numpy.isnan(censusMatrix)] = numpy.nan
+    return ranks
+
+def _normalizedRows (censusMatrix):
+    #Centres every row and scales it to unit length, so the dot product of two rows is their Pearson correlation. Missing values are filled with the row mean (0 once centred); rows with fewer than 3 numbers or no spread become all NaN
+    counts = (~numpy.isnan(censusMatrix)).sum(axis=1, keepdims=True)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        means = numpy.nansum(censusMatrix, axis=1, keepdims=True) / counts
+        centred = numpy.nan_to_num(censusMatrix - means)
+        lengths = numpy.linalg.norm(centred, axis=1, keepdims=True)
+        normalized = centred / lengths
+    normalized[(counts[:, 0] < 3) | ~(lengths[:, 0] > 0)] = numpy.nan
+    return normalized.astype(numpy.float32)
+
+class CorrelationIndex:
+    '''
+    Every census row centred and scaled to unit length, once as values (Pearson) and once as ranks (Spearman), so the correlation of one row with all 2,600 is a single matrix-vector product.
+    ----
+    Parameters:
+        censusMatrix - every census value, rows x neighbourhoods (numpy float64 array)
+        rowLabels - the label of every row (sequence of str)
+    '''
+    def __init__ (self, censusMatrix, rowLabels):
+        censusMatrix = numpy.asarray(censusMatrix)
+        self.rowLabels = rowLabels
+        self.normalized = {
+            "pearson": _normalizedRows(censusMatrix),
+            "spearman": _normalizedRows(_averageRanks(censusMatrix)),
+        }
+
+    def correlations (self, rowIndex, method="pearson"):
+        '''Returns the correlation of one row (0-based) with every row, NaN for rows that cannot be correlated (numpy float32 array)'''
+        normalized = self.normalized[method]
+        return normalized @ normalized[rowIndex]
+
+    def topCorrelated (self, rowIndex, limit=10, method="pearson"):
+        '''
+        A function to find the rows whose values across neighbourhoods move most closely with one row, positively or negatively.
+        ----
+        Parameters:
+            rowIndex - the row, 0-based (int)
+            limit - the most rows to return (int)
+            method - a key of correlationMethods (str)
+        Returns:
+            results - (row number as shown in the UI, i.e. row index + 2, label, correlation) for each row, strongest first (list of tuples of int, str, float)
+        '''
+        correlations = self.correlations(rowIndex, method)
+        strength = numpy.nan_to_num(numpy.abs(correlations), nan=-1)
+        strength[rowIndex] = -1
+        limit = min(limit, strength.size - 1)
+        if limit <= 0:
+            return []
+        candidates = numpy.argpartition(-strength, limit - 1)[:limit]
+        candidates = candidates[numpy.argsort(-strength[candidates], kind="stable")]
+        return [(int(i) + 2, str(self.rowLabels[i]), float(correlations[i])) for i in candidates if strength[i] >= 0]
+
+_indexes = {}
+_indexLock = threading.Lock()
+
+def getCorrelationIndex (store):
+    '''
+    A function to get the correlation index of a store, building it on first use.
+    ----
+    Parameters:
+        store - the store to index (CensusStore)
+    Returns:
+        index - the shared index (CorrelationIndex)
+    '''
+    cached = _indexes.get(store.censusFilePath)
+    if cached is None or cached[0] is not store:
+        with _indexLock:
+            cached = _indexes.get(store.censusFilePath)
+            if cached is None or cached[0] is not store:
+                cached = (store, CorrelationIndex(store.censusMatrix, store.rowLabels))
+                _indexes[store.censusFilePath] = cached
+    return cached[1]
@@ -0,0 +1,152 @@
+import os
+import gzip
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import span
+
+#Preferred first; "identity" is the body as it is
+contentEncodings = ("br", "gzip", "identity")
+#Bodies smaller than this fit in a packet or two either way, so they are sent as they are
+compressMinimumBytes = int(os.environ.get("COMPRESS_MINIMUM_BYTES", 1400))
+#Large bodies (full figures) are often sent again unchanged, so their compressed copies are kept, keyed by a hash of the body
+compressCacheMinimumBytes = 32 * 1024
+compressCacheEntries = int(os.environ.get("COMPRESS_CACHE_ENTRIES", 64))
+_compressedTypes = {"application/json", "text/html", "text/plain", "text/css", "application/javascript", "text/javascript"}
+
+def compressBody (body, encoding, fast=False):
+    '''Returns body (bytes) compressed with "br", "gzip" or "identity"; fast trades size for speed, for bodies compressed per request'''
+    if encoding == "br":
+        import brotli
+        return brotli.compress(body, quality=5 if fast else 11)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=5 if fast else 9, mtime=0)
+    return body
+
+def chooseEncoding (acceptEncoding, available=contentEncodings):
+    '''
+    A function to pick the encoding to answer a request with from its Accept-Encoding header.
+    ----
+    Parameters:
+        acceptEncoding - the header, e.g. "gzip, deflate, br" (str)
+        available - the encodings that can be sent, best first (sequence of str)
+    Returns:
+        encoding - "br", "gzip" or "identity" (str)
+    '''
+    accepted = {}
+    for part in (acceptEncoding or "").split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = 1.0
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in available:
+        if encoding == "identity" or accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+def encodedETag (etag, encoding):
+    '''Returns the ETag of one encoding of a body whose identity ETag is etag, e.g. "<hash>-br", since a strong ETag names exactly one representation'''
+    return etag if encoding == "identity" else f"{etag}-{encoding}"
+
+def matchesAnyEncoding (ifNoneMatch, etag):
+    '''Whether an If-None-Match header (werkzeug ETags) names any encoding of the body whose identity ETag is etag; the client already has that content, whichever encoding it was sent in'''
+    return any(ifNoneMatch.contains(encodedETag(etag, encoding)) for encoding in contentEncodings)
+
+_compressed = OrderedDict()
+_compressedLock = threading.Lock()
+_compressedCounts = {"hits": 0, "misses": 0}
+
+def cachedCompressBody (body, encoding):
+    '''Same as compressBody with fast=True, but keeps the compressed copies of the last compressCacheEntries large bodies so identical responses are only compressed once (bytes)'''
+    if len(body) < compressCacheMinimumBytes:
+        return compressBody(body, encoding, fast=True)
+    key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+    with _compressedLock:
+        compressed = _compressed.get(key)
+        if compressed is not None:
+            _compressed.move_to_end(key)
+            _compressedCounts["hits"] += 1
+            return compressed
+    compressed = compressBody(body, encoding, fast=True)
+    with _compressedLock:
+        _compressedCounts["misses"] += 1
+        _compressed[key] = compressed
+        while len(_compressed) > compressCacheEntries:
+            _compressed.popitem(last=False)
+    return compressed
+
+def compressionStats ():
+    '''Returns the hits and misses of cachedCompressBody's cache of large bodies, and how many it holds (dict)'''
+    with _compressedLock:
+        return dict(_compressedCounts, entries=len(_compressed), bytes=sum(len(compressed) for compressed in _compressed.values()))
+
+def compressStream (chunks, encoding):
+    '''
+    A function to compress a streamed body chunk by chunk, flushing after each so the client can read what has been sent so far. compressResponses leaves streamed responses alone, so streaming routes call this themselves.
+    ----
+    Parameters:
+        chunks - the body, in pieces (iterable of bytes)
+        encoding - "br", "gzip" or "identity" (str)
+    Returns:
+        compressed - the compressed body, in pieces (generator of bytes)
+    '''
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            compressed = compressor.process(chunk) + compressor.flush()
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    elif encoding == "gzip":
+        #wbits 31 writes a gzip header and trailer rather than a bare deflate stream
+        compressor = zlib.compressobj(5, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    else:
+        yield from chunks
+
+def compressResponses (server, minimumBytes=compressMinimumBytes):
+    '''
+    A function to compress the Flask server's text responses, Dash callback responses included, with brotli or gzip as each request accepts. Responses that are already encoded (e.g. snapshots), streamed, or smaller than minimumBytes are left alone. A compressed response's ETag gets the encoding as a suffix (see encodedETag).
+    ----
+    Parameters:
+        server - the Flask app, i.e. app.server (flask.Flask)
+        minimumBytes - the smallest body worth compressing (int)
+    '''
+    from flask import request, Response
+
+    @server.after_request
+    def compressResponse (response):
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers:
+            return response
+        if response.mimetype not in _compressedTypes:
+            return response
+        response.vary.add("Accept-Encoding")
+        body = response.get_data()
+        if len(body) < minimumBytes:
+            return response
+        encoding = chooseEncoding(request.headers.get("Accept-Encoding"))
+        if encoding == "identity":
+            return response
+        etag, weak = response.get_etag()
+        if etag is not None and matchesAnyEncoding(request.if_none_match, etag):
+            #The view compared If-None-Match with the identity ETag; the client may hold this body under the compressed one
+            notModified = Response(status=304, headers={name: value for name, value in response.headers.items() if name in ("Cache-Control", "Expires", "Vary")})
+            notModified.set_etag(encodedETag(etag, encoding), weak)
+            return notModified
+        with span("compressResponses", encoding):
+            response.set_data(cachedCompressBody(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        if etag is not None:
+            response.set_etag(encodedETag(etag, encoding), weak)
+        return response
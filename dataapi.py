@@ -0,0 +1,267 @@
+'''
+A data API on the Flask server, for scripts and dashboards that want the numbers behind the charts without rendering a figure. Everything is read from the census matrix already loaded in datastore.py.
+
+    /api/rows/<row>.<format>        one row, with its city-wide summary
+    /api/rows.<format>              a batch of rows (?rows=37,40-45, read like --rows, see datastore.parseRows), or every row if rows is left out
+    /api/lookup.json                the neighbourhood and ward of a point (?lon=&lat=), or the areas in a box (?bbox=minLon,minLat,maxLon,maxLat&layer=ward)
+
+format is json, csv, or arrow (an Arrow IPC stream, if pyarrow is installed). ?neighbourhoods=Annex,Rosedale-Moore Park keeps only those columns, and ?level=wardSum or wardMean returns rows aggregated to wards instead (see spatial.py). Batches are streamed as they are written, compressed as the client accepts. Every response carries an ETag and Last-Modified that change only when the data files do, so a poller that sends them back gets 304 Not Modified without anything being read.
+'''
+import io
+import os
+import csv
+import json
+import math
+import hashlib
+import numpy
+from datastore import parseRows
+from compression import compressStream, chooseEncoding, encodedETag, matchesAnyEncoding
+from metrics import metrics, bytesBuckets
+from spatial import mapLevels, wardAggregations, getSpatialIndex
+try:
+    #Optional: writes rows of floats several times faster than json, and NaN as null without converting
+    import orjson
+except ImportError:
+    orjson = None
+
+dataApiMaxAge = int(os.environ.get("DATA_API_MAX_AGE", 300))
+#Rows read, encoded and sent at a time when streaming
+dataApiChunkRows = 256
+dataFormats = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+class DataRequestError (ValueError):
+    '''A query the data API cannot answer; its message is sent back with a 400'''
+
+def dataTable (store, level="neighbourhood", names=None):
+    '''
+    A function to get the table rows are read from: census values by neighbourhood, or aggregated to wards.
+    ----
+    Parameters:
+        store - the store to read (CensusStore)
+        level - a key of spatial.mapLevels (str)
+        names - the neighbourhoods (or wards) to keep, in the order given, or None for all (list of str)
+    Returns:
+        columnNames - the names of the columns kept (list of str)
+        matrix - every row, rows x all columns (numpy array)
+        columnIndexes - the columns of matrix kept (numpy int array)
+    '''
+    if level == "neighbourhood":
+        allNames, matrix = list(store.columnNames), store.censusMatrix
+    elif level in wardAggregations:
+        allNames = [str(name) for name in store.wardGeo["AREA_NAME"]]
+        matrix = getSpatialIndex(store).wardMatrices[wardAggregations[level]]
+    else:
+        raise DataRequestError(f"level must be one of {', '.join(mapLevels)}")
+    if names is None:
+        return allNames, matrix, numpy.arange(len(allNames))
+    positions = {name: position for position, name in enumerate(allNames)}
+    unknown = [name for name in names if name not in positions]
+    if unknown:
+        raise DataRequestError(f"Unknown {'neighbourhood' if level == 'neighbourhood' else 'ward'}: {', '.join(unknown)}")
+    return names, matrix, numpy.asarray([positions[name] for name in names], dtype=numpy.intp)
+
+def rowChunks (store, matrix, rowIndexes, columnIndexes, chunkRows=dataApiChunkRows):
+    '''Yields (row numbers as shown in the UI, labels, values rows x columns) for chunkRows rows at a time, so only one chunk of a bulk request is ever copied out of the matrix'''
+    for start in range(0, len(rowIndexes), chunkRows):
+        chunk = rowIndexes[start:start + chunkRows]
+        yield chunk + 2, [str(label) for label in store.rowLabels[chunk]], numpy.ascontiguousarray(matrix[chunk][:, columnIndexes], dtype=numpy.float64)
+
+def _withoutNaN (value):
+    #json would write NaN as NaN, which is not JSON and which strict parsers such as JSON.parse reject
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _withoutNaN(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_withoutNaN(item) for item in value]
+    return value
+
+def _dumps (value):
+    if orjson is not None:
+        #orjson writes NaN as null itself
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_withoutNaN(value), allow_nan=False).encode()
+
+def _jsonValues (values):
+    #json cannot write numpy arrays, so rows become lists, with NaN already None
+    if orjson is not None:
+        return values
+    return numpy.where(numpy.isnan(values), None, values).tolist()
+
+def encodeJSON (columnNames, chunks, level):
+    '''Yields {"level", "columns", "rows": [{"row", "label", "values"}, ...]} as bytes, one chunk of rows at a time; missing values are null'''
+    yield b'{"level":' + _dumps(level) + b',"columns":' + _dumps(columnNames) + b',"rows":['
+    first = True
+    for rowNumbers, labels, values in chunks:
+        for rowNumber, label, rowValues in zip(rowNumbers.tolist(), labels, _jsonValues(values)):
+            yield (b"" if first else b",") + _dumps({"row": rowNumber, "label": label, "values": rowValues})
+            first = False
+    yield b"]}"
+
+def encodeCSV (columnNames, chunks):
+    '''Yields a header (row, label, then one column per neighbourhood or ward) and one line per row as bytes, one chunk of rows at a time; missing values are empty'''
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\n")
+    writer.writerow(["row", "label"] + list(columnNames))
+    yield text.getvalue().encode()
+    for rowNumbers, labels, values in chunks:
+        text.seek(0)
+        text.truncate()
+        #%.15g writes whole numbers without a trailing .0 and keeps every digit a float64 holds
+        formatted = numpy.char.mod("%.15g", values)
+        formatted[numpy.isnan(values)] = ""
+        writer.writerows([rowNumber, label] + rowValues for rowNumber, label, rowValues in zip(rowNumbers.tolist(), labels, formatted.tolist()))
+        yield text.getvalue().encode()
+
+def encodeArrow (columnNames, chunks):
+    '''Yields an Arrow IPC stream with a row, a label and one float64 column per neighbourhood or ward, one record batch per chunk of rows; missing values are null'''
+    import pyarrow
+    schema = pyarrow.schema([("row", pyarrow.int32()), ("label", pyarrow.string())] + [(name, pyarrow.float64()) for name in columnNames])
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    def drain ():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+    for rowNumbers, labels, values in chunks:
+        columns = [pyarrow.array(rowNumbers, pyarrow.int32()), pyarrow.array(labels, pyarrow.string())]
+        columns += [pyarrow.array(values[:, column], pyarrow.float64(), from_pandas=True) for column in range(values.shape[1])]
+        writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+def encodeRows (dataFormat, columnNames, chunks, level):
+    '''Yields rows (see rowChunks) encoded as dataFormat, a key of dataFormats (generator of bytes)'''
+    if dataFormat == "json":
+        return encodeJSON(columnNames, chunks, level)
+    if dataFormat == "csv":
+        return encodeCSV(columnNames, chunks)
+    return encodeArrow(columnNames, chunks)
+
+def _countedStream (chunks, route, encoding):
+    #Streamed bodies are not seen by the metrics after_request hook, so they are counted here once sent
+    sent = 0
+    for chunk in chunks:
+        sent += len(chunk)
+        yield chunk
+    metrics.observe("census_response_bytes", sent, {"route": route, "encoding": encoding}, bytesBuckets)
+
+def registerDataRoutes (server, getStore):
+    '''
+    A function to serve the data API (see the top of this file) from the Flask server behind the Dash app.
+    ----
+    Parameters:
+        server - the Flask app, i.e. app.server (flask.Flask)
+        getStore - returns the store to read, loading it if needed (function -> CensusStore)
+    '''
+    from datetime import datetime, timezone
+    from flask import request, abort, Response
+
+    def notModified (etag, lastModified):
+        if request.if_none_match:
+            return matchesAnyEncoding(request.if_none_match, etag)
+        return request.if_modified_since is not None and lastModified <= request.if_modified_since
+
+    def cacheHeaders (response, etag, lastModified, vary=True):
+        response.set_etag(etag)
+        response.last_modified = lastModified
+        response.headers["Cache-Control"] = f"public, max-age={dataApiMaxAge}"
+        if vary:
+            response.vary.add("Accept-Encoding")
+        return response
+
+    def respond (store, build, dataFormat="json", stream=False):
+        #The ETag depends only on the data files and the request, so a conditional request is answered before anything is read
+        etag = hashlib.sha256(repr((store.mtimes, request.path, sorted(request.args.items(multi=True)))).encode()).hexdigest()[:32]
+        lastModified = datetime.fromtimestamp(int(max(store.mtimes)), timezone.utc)
+        #Streamed bodies are compressed here, each encoding with its own ETag; other bodies are compressed, and their ETag suffixed, by compressResponses
+        encoding = chooseEncoding(request.headers.get("Accept-Encoding")) if stream else "identity"
+        if notModified(etag, lastModified):
+            return cacheHeaders(Response(status=304), encodedETag(etag, encoding), lastModified)
+        try:
+            body = build()
+        except DataRequestError as error:
+            abort(400, description=str(error))
+        if not stream:
+            return cacheHeaders(Response(body, content_type=dataFormats[dataFormat]), etag, lastModified)
+        response = Response(_countedStream(compressStream(body, encoding), request.url_rule.rule, encoding), content_type=dataFormats[dataFormat])
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        return cacheHeaders(response, encodedETag(etag, encoding), lastModified)
+
+    def checkFormat (dataFormat):
+        if dataFormat not in dataFormats:
+            abort(404)
+        if dataFormat == "arrow":
+            try:
+                import pyarrow
+            except ImportError:
+                abort(501, description="Arrow output needs pyarrow, which is not installed on this server")
+
+    def columnsRequested (store):
+        names = request.args.get("neighbourhoods")
+        return dataTable(store, request.args.get("level", "neighbourhood"), [name.strip() for name in names.split(",")] if names else None)
+
+    @server.route("/api/rows/<int:row>.<dataFormat>")
+    def dataRow (row, dataFormat):
+        checkFormat(dataFormat)
+        store = getStore()
+        if not 2 <= row < len(store.rowLabels) + 2:
+            abort(404)
+        def build ():
+            columnNames, matrix, columnIndexes = columnsRequested(store)
+            chunks = rowChunks(store, matrix, numpy.asarray([row - 2]), columnIndexes)
+            if dataFormat != "json":
+                return b"".join(encodeRows(dataFormat, columnNames, chunks, request.args.get("level", "neighbourhood")))
+            _, labels, values = next(chunks)
+            return _dumps({
+                "level": request.args.get("level", "neighbourhood"),
+                "columns": columnNames,
+                "row": row,
+                "label": labels[0],
+                "values": _jsonValues(values)[0],
+                #The summary is of the whole row as the map shows it, whichever columns were asked for
+                "summary": store.rowSummary(row - 2) if request.args.get("level", "neighbourhood") == "neighbourhood" else None,
+            })
+        return respond(store, build, dataFormat)
+
+    @server.route("/api/rows.<dataFormat>")
+    def dataRows (dataFormat):
+        checkFormat(dataFormat)
+        store = getStore()
+        def build ():
+            try:
+                rowIndexes = numpy.asarray(parseRows(request.args.get("rows"), len(store.rowLabels)), dtype=numpy.intp) - 2
+            except ValueError as error:
+                raise DataRequestError(str(error))
+            columnNames, matrix, columnIndexes = columnsRequested(store)
+            return encodeRows(dataFormat, columnNames, rowChunks(store, matrix, rowIndexes, columnIndexes), request.args.get("level", "neighbourhood"))
+        return respond(store, build, dataFormat, stream=True)
+
+    @server.route("/api/lookup.json")
+    def dataLookup ():
+        store = getStore()
+        def build ():
+            spatialIndex = getSpatialIndex(store)
+            if "bbox" in request.args:
+                layer = request.args.get("layer", "neighbourhood")
+                if layer not in spatialIndex.trees:
+                    raise DataRequestError("layer must be neighbourhood or ward")
+                try:
+                    minLon, minLat, maxLon, maxLat = (float(value) for value in request.args["bbox"].split(","))
+                except ValueError:
+                    raise DataRequestError("bbox must be minLon,minLat,maxLon,maxLat")
+                featureIndexes = spatialIndex.inBounds(layer, minLon, minLat, maxLon, maxLat)
+                return _dumps({"layer": layer, "areas": [str(name) for name in spatialIndex.names[layer][featureIndexes]]})
+            try:
+                lon, lat = float(request.args["lon"]), float(request.args["lat"])
+            except (KeyError, ValueError):
+                raise DataRequestError("Give a point as lon and lat, or a box as bbox")
+            return _dumps(dict(spatialIndex.lookupPoint(lon, lat), lon=lon, lat=lat))
+        return respond(store, build)
@@ -0,0 +1,339 @@
+from __future__ import annotations
+import os
+import json
+import numpy
+import hashlib
+import threading
+from typing import TYPE_CHECKING
+from dataclasses import dataclass
+from stats import rowStatNames, computeRowStats
+
+#pandas (only needed to build the census cache) and geopandas are imported where they are used rather than here, so importing this module (and map.py) stays fast when loading is deferred (see startup.py)
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+#Constants for file paths
+neighbourhoodFilePath = "data/Neighbourhoods.geojson"
+censusFilePath =  "data/CityCensusData.csv"
+citywardsFilePath = "data/CityWards.geojson"
+
+#Where the columnar copy of the census csv is kept (see buildCensusCache)
+censusCacheFolder = "data/cache"
+_censusCacheVersion = 2
+
+@dataclass(frozen=True)
+class CensusStore:
+    '''
+    A read-only bundle of everything parsed from the data/ folder. One instance is shared by every chart function and Dash callback in the process, so treat its members as immutable. The census values are memory-mapped from the columnar cache (see buildCensusCache), so every worker on the machine reads the same pages instead of holding its own parsed copy.
+    ----
+    Attributes:
+        censusFilePath - the path the census table was read from (str)
+        neighbourhoodFilePath - the path the neighbourhood geometry was read from (str)
+        citywardsFilePath - the path the ward geometry was read from (str)
+        neighbourhoodGeo - the neighbourhood geometry (gpd.GeoDataFrame)
+        neighbourhoodGeoDict - the neighbourhood geometry as a FeatureCollection readable by plotly (dict)
+        wardGeo - the ward geometry (gpd.GeoDataFrame)
+        wardGeoDict - the ward geometry as a FeatureCollection (dict)
+        rowLabels - the "Neighbourhood Name" label of every census row (numpy array of str)
+        columnNames - the neighbourhood names, in census column order (tuple of str)
+        censusMatrix - every census value as a float, rows x neighbourhoods in column order, NaN where the cell is not a number (read-only, memory-mapped numpy float64 array)
+        textCells - the raw text of every non-empty cell that is not a number, e.g. "..." or a TSNS designation, keyed by (row index, column index) (dict)
+        nanMask - True where censusMatrix is NaN (read-only numpy bool array)
+        rowStats - summary statistics of every row, rows x stats.rowStatNames, see stats.computeRowStats (read-only, memory-mapped numpy float64 array)
+        geoPermutation - for each neighbourhood feature, in geojson order, its column in censusMatrix, or -1 if it has no census column (read-only numpy int array)
+        unmatchedNeighbourhoods - AREA_NAMEs in the geojson without a census column (tuple of str)
+        mtimes - modification times of the three files when they were loaded (tuple of floats)
+    '''
+    censusFilePath: str
+    neighbourhoodFilePath: str
+    citywardsFilePath: str
+    neighbourhoodGeo: gpd.GeoDataFrame
+    neighbourhoodGeoDict: dict
+    wardGeo: gpd.GeoDataFrame
+    wardGeoDict: dict
+    rowLabels: numpy.ndarray
+    columnNames: tuple
+    censusMatrix: numpy.ndarray
+    textCells: dict
+    nanMask: numpy.ndarray
+    geoPermutation: numpy.ndarray
+    unmatchedNeighbourhoods: tuple
+    rowStats: numpy.ndarray
+    mtimes: tuple
+
+    def rowValues (self, rowIndex):
+        '''Returns the values of one census row (0-based, i.e. the UI row number - 2) in census column order, as a read-only view'''
+        return self.censusMatrix[rowIndex]
+
+    def rowSummary (self, rowIndex):
+        '''Returns the precomputed statistics of one census row (0-based) by name, e.g. {"median": 26490.0, "q1": ..., "nanCount": 0.0, ...}'''
+        return dict(zip(rowStatNames, self.rowStats[rowIndex].tolist()))
+
+    def rowText (self, rowIndex):
+        '''Returns one census row (0-based) the way the csv has it: the number where a cell is numeric, the raw text where it is not, and None where it is empty'''
+        return [
+            self.textCells.get((rowIndex, columnIndex)) if numpy.isnan(value) else value
+            for columnIndex, value in enumerate(self.censusMatrix[rowIndex].tolist())
+        ]
+
+    def geoOrder (self, columnValues):
+        '''Reorders one value per census column (e.g. a row of ranks) into geojson feature order, as floats, with NaN for features without a census column'''
+        values = numpy.asarray(columnValues, dtype=numpy.float64)[self.geoPermutation]
+        if self.unmatchedNeighbourhoods:
+            values[self.geoPermutation < 0] = numpy.nan
+        return values
+
+_stores = {}
+_storeLock = threading.Lock()
+
+def _fileMtimes (paths):
+    return tuple(os.path.getmtime(path) for path in paths)
+
+def _geoToFeatureCollection (geoData):
+    '''Converts a GeoDataFrame to a FeatureCollection dict readable by plotly'''
+    geoDataDict = json.loads(geoData.to_json())
+    return {
+        "type": "FeatureCollection",
+        "features": geoDataDict["features"]
+    }
+
+def _readOnly (array):
+    array.setflags(write=False)
+    return array
+
+def _numericMatrix (censusData):
+    '''
+    A function to coerce the neighbourhood columns of the census table to a dense float64 matrix. Thousands separators, "%" and "$" are stripped; anything that is still not a number ("...", "x", TSNS designations) becomes NaN.
+    ----
+    Parameters:
+        censusData - the census table (pandas.DataFrame)
+    Returns:
+        censusMatrix - the values, rows x neighbourhoods (numpy float64 array)
+    '''
+    import pandas
+    values = censusData.iloc[:, 1:]
+    flatValues = pandas.Series(values.to_numpy().ravel(), dtype="string")
+    flatValues = flatValues.str.replace(r"[,\s$%]", "", regex=True)
+    censusMatrix = pandas.to_numeric(flatValues, errors="coerce").to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+    return censusMatrix.reshape(values.shape)
+
+def _fileHash (path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as dataFile:
+        for chunk in iter(lambda: dataFile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _censusCachePaths (censusPath):
+    stem = os.path.splitext(os.path.basename(censusPath))[0]
+    return tuple(os.path.join(censusCacheFolder, f"{stem}.{part}") for part in ("matrix.npy", "stats.npy", "labels.json"))
+
+def parseRows (rowsText, rowCount):
+    '''
+    A function to turn a row list like "37,40-45" into row numbers, as shown in the UI (2 to rowCount + 1). The batch and snapshot CLIs (--rows) and the data API (?rows=) all read rows this way.
+    ----
+    Parameters:
+        rowsText - comma-separated rows and inclusive ranges; "all", "" or None for every row (str)
+        rowCount - the number of census rows (int)
+    Returns:
+        rows - the row numbers, in the order given, without repeats (list of ints)
+    '''
+    if not rowsText or rowsText == "all":
+        return list(range(2, rowCount + 2))
+    rows = []
+    for part in rowsText.split(","):
+        start, _, end = part.strip().partition("-")
+        try:
+            start = int(start)
+            end = int(end) if end else start
+        except ValueError:
+            raise ValueError(f"{part.strip()!r} is not a row or a range of rows")
+        if end < start:
+            raise ValueError(f"{part.strip()} runs backwards")
+        if not 2 <= start <= end <= rowCount + 1:
+            raise ValueError(f"{part.strip()} is not within rows 2-{rowCount + 1}")
+        rows.extend(range(start, end + 1))
+    return list(dict.fromkeys(rows))
+
+def writeAtomically (path, write, mode="wb"):
+    '''
+    A function to write a file so that no other worker or thread ever reads it half-written: the contents go to a temporary file beside it, which then replaces path in one step. Every cache, snapshot, session and export file is written this way.
+    ----
+    Parameters:
+        path - the file to write; its folder is made if missing (str)
+        write - called with the open temporary file to write the contents (function)
+        mode - "wb" for bytes or "w" for text (str)
+    '''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporaryPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaryPath, mode) as cacheFile:
+        write(cacheFile)
+    os.replace(temporaryPath, path)
+
+def buildCensusCache (censusPath=censusFilePath):
+    '''
+    A function to convert the census csv, once, into a typed columnar cache in censusCacheFolder: the values as a float64 .npy matrix that can be memory-mapped, the per-row statistics table (see stats.computeRowStats) as a second .npy, plus a .labels.json sidecar with the row labels, column names, the raw text of non-numeric cells, and the csv's size, mtime and sha256 the cache was built from. Run "python datastore.py" to do this ahead of deploying; otherwise the first load after the csv changes does it.
+    ----
+    Parameters:
+        censusPath - the path for the census data (str to .csv file path)
+    Returns:
+        sidecar - the contents written to the .labels.json sidecar (dict)
+    '''
+    import pandas
+    sourceStat = os.stat(censusPath)
+    sourceHash = _fileHash(censusPath)
+    censusData = pandas.read_csv(censusPath)
+    censusMatrix = numpy.ascontiguousarray(_numericMatrix(censusData))
+    values = censusData.iloc[:, 1:].to_numpy()
+    textRows, textColumns = numpy.nonzero(numpy.isnan(censusMatrix) & pandas.notna(values))
+    sidecar = {
+        "version": _censusCacheVersion,
+        "source": censusPath,
+        "size": sourceStat.st_size,
+        "mtime": sourceStat.st_mtime,
+        "sha256": sourceHash,
+        "shape": list(censusMatrix.shape),
+        "rowLabels": [str(label) for label in censusData["Neighbourhood Name"]],
+        "columnNames": [str(name) for name in censusData.columns[1:]],
+        "textCells": [[int(row), int(column), str(values[row, column])] for row, column in zip(textRows, textColumns)],
+    }
+    rowStats = computeRowStats(censusMatrix)
+    matrixPath, statsPath, sidecarPath = _censusCachePaths(censusPath)
+    #The matrices go first, so a sidecar on disk always describes complete matrices
+    writeAtomically(matrixPath, lambda cacheFile: numpy.save(cacheFile, censusMatrix))
+    writeAtomically(statsPath, lambda cacheFile: numpy.save(cacheFile, rowStats))
+    writeAtomically(sidecarPath, lambda cacheFile: json.dump(sidecar, cacheFile), mode="w")
+    return sidecar
+
+def _cacheIsCurrent (sidecar, censusPath):
+    '''Checks a sidecar against the csv: a matching size and mtime is enough; a new mtime with unchanged contents (e.g. the file was copied) only refreshes the sidecar'''
+    if sidecar is None or sidecar.get("version") != _censusCacheVersion:
+        return False
+    sourceStat = os.stat(censusPath)
+    if sidecar["size"] != sourceStat.st_size:
+        return False
+    if sidecar["mtime"] == sourceStat.st_mtime:
+        return True
+    if sidecar["sha256"] != _fileHash(censusPath):
+        return False
+    sidecar["mtime"] = sourceStat.st_mtime
+    writeAtomically(_censusCachePaths(censusPath)[2], lambda cacheFile: json.dump(sidecar, cacheFile), mode="w")
+    return True
+
+def loadCensusCache (censusPath=censusFilePath):
+    '''
+    A function to open the columnar cache of the census csv, building it first if it is missing or out of date.
+    ----
+    Parameters:
+        censusPath - the path for the census data (str to .csv file path)
+    Returns:
+        censusMatrix - every census value, memory-mapped read-only (numpy float64 memmap)
+        rowStats - the per-row statistics table, memory-mapped read-only (numpy float64 memmap)
+        sidecar - the row labels, column names and text cells the cache was built with, see buildCensusCache (dict)
+    '''
+    matrixPath, statsPath, sidecarPath = _censusCachePaths(censusPath)
+    try:
+        with open(sidecarPath) as sidecarFile:
+            sidecar = json.load(sidecarFile)
+    except (FileNotFoundError, ValueError):
+        sidecar = None
+    if not _cacheIsCurrent(sidecar, censusPath) or not os.path.exists(matrixPath) or not os.path.exists(statsPath):
+        sidecar = buildCensusCache(censusPath)
+    censusMatrix = numpy.load(matrixPath, mmap_mode="r")
+    rowStats = numpy.load(statsPath, mmap_mode="r")
+    if list(censusMatrix.shape) != sidecar["shape"] or rowStats.shape != (censusMatrix.shape[0], len(rowStatNames)):
+        #Another process rebuilt the cache between our reads (or rowStatNames changed); build it again so the files agree
+        sidecar = buildCensusCache(censusPath)
+        censusMatrix = numpy.load(matrixPath, mmap_mode="r")
+        rowStats = numpy.load(statsPath, mmap_mode="r")
+    return censusMatrix, rowStats, sidecar
+
+def _geoPermutation (neighbourhoodGeo, columnNames):
+    '''Maps each geojson feature to its census column by AREA_NAME; features without a census column get -1 and are reported once'''
+    columnIndex = {name: i for i, name in enumerate(columnNames)}
+    geoPermutation = numpy.array([columnIndex.get(name, -1) for name in neighbourhoodGeo["AREA_NAME"]], dtype=numpy.intp)
+    unmatchedNeighbourhoods = tuple(neighbourhoodGeo["AREA_NAME"][geoPermutation < 0])
+    for neighbourhood_name in unmatchedNeighbourhoods:
+        print(f"Not appended {neighbourhood_name}")
+    return geoPermutation, unmatchedNeighbourhoods
+
+def loadStore (censusPath=censusFilePath, neighbourhoodPath=neighbourhoodFilePath, wardPath=citywardsFilePath):
+    '''
+    A function to load the census table (from its columnar cache, see loadCensusCache) and parse both geojson files from disk. This is the only place the data/ files are read; use getStore() to get the shared copy.
+    ----
+    Parameters:
+        censusPath - the path for the census data (str to .csv file path)
+        neighbourhoodPath - the path for the neighbourhood geoData (str to .geojson file path)
+        wardPath - the path for the ward geoData (str to .geojson file path)
+    Returns:
+        store - a freshly loaded store (CensusStore)
+    '''
+    import geopandas as gpd
+    paths = (censusPath, neighbourhoodPath, wardPath)
+    mtimes = _fileMtimes(paths)
+    censusMatrix, rowStats, sidecar = loadCensusCache(censusPath)
+    neighbourhoodGeo = gpd.read_file(neighbourhoodPath)
+    wardGeo = gpd.read_file(wardPath)
+    columnNames = tuple(sidecar["columnNames"])
+    geoPermutation, unmatchedNeighbourhoods = _geoPermutation(neighbourhoodGeo, columnNames)
+    return CensusStore(
+        censusFilePath=censusPath,
+        neighbourhoodFilePath=neighbourhoodPath,
+        citywardsFilePath=wardPath,
+        neighbourhoodGeo=neighbourhoodGeo,
+        neighbourhoodGeoDict=_geoToFeatureCollection(neighbourhoodGeo),
+        wardGeo=wardGeo,
+        wardGeoDict=_geoToFeatureCollection(wardGeo),
+        rowLabels=_readOnly(numpy.array(sidecar["rowLabels"], dtype=str)),
+        columnNames=columnNames,
+        censusMatrix=censusMatrix,
+        rowStats=rowStats,
+        textCells={(row, column): text for row, column, text in sidecar["textCells"]},
+        nanMask=_readOnly(numpy.isnan(censusMatrix)),
+        geoPermutation=_readOnly(geoPermutation),
+        unmatchedNeighbourhoods=unmatchedNeighbourhoods,
+        mtimes=mtimes,
+    )
+
+def getStore (censusPath=censusFilePath, neighbourhoodPath=neighbourhoodFilePath, wardPath=citywardsFilePath):
+    '''
+    A function to get the process-wide store for a set of data files, loading it on first use. When map.py is imported by a gunicorn master with preload_app (see gunicorn.conf.py), the store is loaded once and shared copy-on-write with every worker.
+    ----
+    Parameters:
+        censusPath - the path for the census data (str to .csv file path)
+        neighbourhoodPath - the path for the neighbourhood geoData (str to .geojson file path)
+        wardPath - the path for the ward geoData (str to .geojson file path)
+    Returns:
+        store - the shared store (CensusStore)
+    '''
+    key = (censusPath, neighbourhoodPath, wardPath)
+    store = _stores.get(key)
+    if store is None:
+        with _storeLock:
+            store = _stores.get(key)
+            if store is None:
+                store = loadStore(*key)
+                _stores[key] = store
+    return store
+
+def reloadStore (force=False):
+    '''
+    A function to re-read every loaded store whose files changed on disk. Call this after replacing anything in data/; gunicorn calls it on SIGHUP through gunicorn.conf.py.
+    ----
+    Parameters:
+        force - reload even if the files have not changed (bool)
+    Returns:
+        reloaded - the keys of the stores that were reloaded (list of tuples of str)
+    '''
+    reloaded = []
+    with _storeLock:
+        for key, store in list(_stores.items()):
+            if force or _fileMtimes(key) != store.mtimes:
+                _stores[key] = loadStore(*key)
+                reloaded.append(key)
+    return reloaded
+
+if __name__ == '__main__':
+    sidecar = buildCensusCache()
+    for path in _censusCachePaths(censusFilePath):
+        print(f"{path}: {os.path.getsize(path)} bytes")
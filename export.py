@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datastore import writeAtomically
+from figcache import FigureCache, pruneFolder
+from metrics import metrics
+
+#Where finished exports are written; every gunicorn worker on the machine reads the same folder, so a client can poll any of them
+exportFolder = os.environ.get("EXPORT_FOLDER", os.path.join(tempfile.gettempdir(), "torontoCensusExports"))
+#The most bytes of finished exports kept in exportFolder; job ids are content hashes, so without a bound every distinct export would be kept forever
+exportFolderBytes = int(os.environ.get("EXPORT_FOLDER_BYTES", 256 * 1024 * 1024))
+exportWorkers = int(os.environ.get("EXPORT_WORKERS", 2))
+
+def _startRenderer ():
+    '''Runs once in each pool process: starts kaleido's chromium with a throwaway render so the first real export doesn't pay for it'''
+    import plotly.io as pio
+    pio.kaleido.scope.mathjax = None
+    pio.to_image({"data": [], "layout": {}}, format="png", engine="kaleido", width=10, height=10)
+
+def _render (figureJSON, imageFormat, width, height):
+    import plotly.io as pio
+    #Not validated: cached figures hold typed arrays (see figjson.py), which plotly.js reads but plotly.py's validators reject
+    return pio.to_image(json.loads(figureJSON), format=imageFormat, engine="kaleido", width=width, height=height, validate=False)
+
+def exportJobId (figureJSON, imageFormat="pdf", width=None, height=None):
+    '''
+    A function to get the id of an export: a hash of everything that affects the output, so identical exports share one job and one file.
+    ----
+    Parameters:
+        figureJSON - the serialized figure (bytes)
+        imageFormat - "pdf", "png" or "svg" (str)
+        width, height - the export size in pixels, or None for kaleido's default (int)
+    Returns:
+        jobId - the content hash (str)
+    '''
+    digest = hashlib.sha256(figureJSON)
+    digest.update(f"|{imageFormat}|{width}|{height}".encode())
+    return digest.hexdigest()
+
+class ExportPool:
+    '''
+    A pool of processes that each keep a warm kaleido renderer, fed by a job queue. Exports run outside the Dash request: submit() returns at once with a job id the client polls with status(), then fetches with result(). Identical exports (same figure, format and size) are deduplicated by content hash, and finished files are kept in memory and in folder.
+    ----
+    Parameters:
+        workers - the number of renderer processes (int)
+        folder - where finished exports are written (str)
+        folderMaxBytes - the most bytes kept in folder; the least recently fetched exports are deleted past it (int)
+    '''
+    def __init__ (self, workers=exportWorkers, folder=exportFolder, folderMaxBytes=exportFolderBytes):
+        self.workers = workers
+        self.folder = folder
+        self.folderMaxBytes = folderMaxBytes
+        #Bytes written to folder since it was last pruned; starts full so the first export prunes what earlier processes left
+        self._written = folderMaxBytes
+        self.results = FigureCache(maxEntries=32, maxBytes=128 * 1024 * 1024)
+        self._executor = None
+        self._jobs = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def _getExecutor (self):
+        #Created on first use, never at import, so a gunicorn master with preload_app doesn't start chromium; "spawn" keeps the renderers out of the forked worker's threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_startRenderer)
+            return self._executor
+
+    def warm (self):
+        '''Starts every renderer process now instead of on the first export'''
+        executor = self._getExecutor()
+        for future in [executor.submit(len, "") for _ in range(self.workers)]:
+            future.result()
+
+    def _path (self, jobId, imageFormat):
+        return os.path.join(self.folder, f"{jobId}.{imageFormat}")
+
+    def _finish (self, jobId, imageFormat, started, future):
+        try:
+            image = future.result()
+        except Exception as error:
+            with self._lock:
+                self._errors[jobId] = repr(error)
+            metrics.observe("census_export_seconds", time.perf_counter() - started, {"format": imageFormat, "status": "error"})
+        else:
+            metrics.observe("census_export_seconds", time.perf_counter() - started, {"format": imageFormat, "status": "done"})
+            self.results.put(jobId, image)
+            writeAtomically(self._path(jobId, imageFormat), lambda imageFile: imageFile.write(image))
+            with self._lock:
+                self._written += len(image)
+                prune = self._written >= self.folderMaxBytes // 8
+                if prune:
+                    self._written = 0
+            if prune:
+                pruneFolder(self.folder, self.folderMaxBytes)
+        finally:
+            with self._lock:
+                self._jobs.pop(jobId, None)
+
+    def submit (self, figureJSON, imageFormat="pdf", width=None, height=None):
+        '''
+        A function to queue an export, unless the same export is already queued or done.
+        ----
+        Parameters:
+            figureJSON - the serialized figure (bytes)
+            imageFormat - "pdf", "png" or "svg" (str)
+            width, height - the export size in pixels, or None for kaleido's default (int)
+        Returns:
+            jobId - the id to poll with status() and fetch with result() (str)
+        '''
+        jobId = exportJobId(figureJSON, imageFormat, width, height)
+        if self.status(jobId, imageFormat) in ("running", "done"):
+            return jobId
+        executor = self._getExecutor()
+        with self._lock:
+            if jobId in self._jobs:
+                return jobId
+            self._errors.pop(jobId, None)
+            started = time.perf_counter()
+            future = executor.submit(_render, figureJSON, imageFormat, width, height)
+            self._jobs[jobId] = future
+        future.add_done_callback(lambda future: self._finish(jobId, imageFormat, started, future))
+        return jobId
+
+    def status (self, jobId, imageFormat="pdf"):
+        '''
+        A function to check on an export.
+        ----
+        Parameters:
+            jobId - an id from submit() (str)
+            imageFormat - the format it was submitted with (str)
+        Returns:
+            status - "done", "running", "error", or "unknown" if this machine has never seen the job (str)
+        '''
+        #A membership check, not results.get, so polling a running job does not count as a cache miss
+        if jobId in self.results or os.path.exists(self._path(jobId, imageFormat)):
+            return "done"
+        with self._lock:
+            if jobId in self._jobs:
+                return "running"
+            if jobId in self._errors:
+                return "error"
+        return "unknown"
+
+    def result (self, jobId, imageFormat="pdf"):
+        '''
+        A function to get a finished export.
+        ----
+        Parameters:
+            jobId - an id from submit() (str)
+            imageFormat - the format it was submitted with (str)
+        Returns:
+            image - the exported file, or None if it is not done (bytes)
+        '''
+        image = self.results.get(jobId)
+        if image is None:
+            path = self._path(jobId, imageFormat)
+            try:
+                with open(path, "rb") as imageFile:
+                    image = imageFile.read()
+                #Marks the file as recently used for pruneFolder
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            self.results.put(jobId, image)
+        return image
+
+    def error (self, jobId):
+        '''Returns why a job failed, or None'''
+        with self._lock:
+            return self._errors.get(jobId)
+
+exportPool = ExportPool()
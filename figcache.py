@@ -0,0 +1,204 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from datastore import writeAtomically
+from figjson import figureToJSON, figureFromJSON
+from metrics import metrics, span, bytesBuckets
+
+def pruneFolder (folder, maxBytes):
+    '''
+    A function to delete the least recently used files in a cache folder (by modification time, which readers refresh with os.utime) until it holds at most maxBytes. Files still being written by writeAtomically are left alone.
+    ----
+    Parameters:
+        folder - the folder (str)
+        maxBytes - the most bytes to keep (int)
+    Returns:
+        removed - the number of files deleted (int)
+    '''
+    try:
+        entries = [entry for entry in os.scandir(folder) if entry.is_file() and not entry.name.endswith(".tmp")]
+    except FileNotFoundError:
+        return 0
+    files = []
+    for entry in entries:
+        try:
+            status = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((status.st_mtime, status.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            #Another worker pruned it first
+            pass
+        total -= size
+    return removed
+
+class FigureCache:
+    '''
+    A least-recently-used cache of serialized Plotly figures, bounded both by entry count and by total bytes. Figures are stored compactly encoded (see figjson.py), and a hit returns the stored JSON without touching pandas or Plotly. With a diskFolder, entries are also written there so every gunicorn worker on the machine shares them; a memory miss checks the disk before building. The folder is kept under diskMaxBytes by deleting the least recently used files, which also clears out entries keyed by data files that have since been reloaded.
+    ----
+    Parameters:
+        maxEntries - the most figures kept in memory (int)
+        maxBytes - the most bytes of JSON kept in memory; figures larger than this are never cached in memory (int)
+        diskFolder - a folder to share entries through, or None to keep them in this process only (str)
+        diskMaxBytes - the most bytes kept in diskFolder (int)
+    '''
+    def __init__ (self, maxEntries=256, maxBytes=64 * 1024 * 1024, diskFolder=None, diskMaxBytes=512 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.diskFolder = diskFolder
+        self.diskMaxBytes = diskMaxBytes
+        #Bytes written to diskFolder since it was last pruned; starts full so the first write prunes what earlier processes left
+        self._diskWritten = diskMaxBytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _diskPath (self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.diskFolder, f"{digest}.json")
+
+    def _remember (self, key, figureJSON):
+        #Called with self._lock held
+        if len(figureJSON) > self.maxBytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = figureJSON
+        self._bytes += len(figureJSON)
+        while len(self._entries) > self.maxEntries or self._bytes > self.maxBytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def __contains__ (self, key):
+        '''Whether key is in memory, without counting a hit or miss or reading the disk'''
+        with self._lock:
+            return key in self._entries
+
+    def get (self, key):
+        '''
+        A function to look up a figure.
+        ----
+        Parameters:
+            key - a hashable key, e.g. ("map", row, mapZoomSettings, ...) (tuple)
+        Returns:
+            figureJSON - the serialized figure, or None on a miss (bytes)
+        '''
+        with self._lock:
+            figureJSON = self._entries.get(key)
+            if figureJSON is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return figureJSON
+        if self.diskFolder is not None:
+            path = self._diskPath(key)
+            try:
+                with open(path, "rb") as cacheFile:
+                    figureJSON = cacheFile.read()
+                #Marks the file as recently used for pruneDisk
+                os.utime(path)
+            except FileNotFoundError:
+                figureJSON = None
+            if figureJSON is not None:
+                with self._lock:
+                    self.diskHits += 1
+                    self._remember(key, figureJSON)
+                return figureJSON
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put (self, key, figureJSON):
+        '''
+        A function to store a serialized figure.
+        ----
+        Parameters:
+            key - a hashable key (tuple)
+            figureJSON - the serialized figure (bytes)
+        '''
+        with self._lock:
+            self._remember(key, figureJSON)
+        if self.diskFolder is not None:
+            writeAtomically(self._diskPath(key), lambda cacheFile: cacheFile.write(figureJSON))
+            with self._lock:
+                self._diskWritten += len(figureJSON)
+                prune = self._diskWritten >= self.diskMaxBytes // 8
+                if prune:
+                    self._diskWritten = 0
+            if prune:
+                self.pruneDisk()
+
+    def pruneDisk (self):
+        '''Deletes the least recently used files in diskFolder until it holds at most diskMaxBytes (see pruneFolder); put() calls this after every eighth of diskMaxBytes written, so the folder never grows past about 9/8 of it. Returns the number of files deleted (int)'''
+        return pruneFolder(self.diskFolder, self.diskMaxBytes)
+
+    def getOrBuild (self, key, build, chart="figure"):
+        '''
+        A function to get a serialized figure, building and caching it on a miss. Building and serializing are timed apart (see metrics.span), and the size of every figure built is recorded in census_figure_bytes.
+        ----
+        Parameters:
+            key - a hashable key (tuple)
+            build - called with no arguments on a miss; returns the figure (function -> go.Figure or dict)
+            chart - what is drawn, e.g. "map" or "bar", to label the timings by (str)
+        Returns:
+            figureJSON - the serialized figure (bytes)
+        '''
+        figureJSON = self.get(key)
+        if figureJSON is None:
+            with span("FigureCache.getOrBuild", f"build {chart}"):
+                figure = build()
+            with span("FigureCache.getOrBuild", f"serialize {chart}"):
+                figureJSON = figureToJSON(figure)
+            metrics.observe("census_figure_bytes", len(figureJSON), {"chart": chart}, bytesBuckets)
+            self.put(key, figureJSON)
+        return figureJSON
+
+    def getFigure (self, key, build, chart="figure"):
+        '''Same as getOrBuild, but returns the figure as a dict ready to be returned from a Dash callback'''
+        figureJSON = self.getOrBuild(key, build, chart)
+        with span("FigureCache.getFigure", f"parse {chart}"):
+            return figureFromJSON(figureJSON)
+
+    def clear (self):
+        '''Empties the in-memory cache (the disk folder, if any, is left alone)'''
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats (self):
+        '''
+        A function to report the cache counters.
+        ----
+        Returns:
+            stats - hits, diskHits, misses, evictions, entries and bytes (dict)
+        '''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "diskHits": self.diskHits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+#The cache shared by map.py. Set FIGURE_CACHE_FOLDER to share entries between gunicorn workers through a local folder, at most FIGURE_CACHE_FOLDER_BYTES of it (empty it when deploying code that changes how figures look)
+figureCache = FigureCache(
+    maxEntries=int(os.environ.get("FIGURE_CACHE_ENTRIES", 256)),
+    maxBytes=int(os.environ.get("FIGURE_CACHE_BYTES", 64 * 1024 * 1024)),
+    diskFolder=os.environ.get("FIGURE_CACHE_FOLDER"),
+    diskMaxBytes=int(os.environ.get("FIGURE_CACHE_FOLDER_BYTES", 512 * 1024 * 1024)),
+)
@@ -0,0 +1,94 @@
+import json
+import base64
+import numpy
+import plotly.io as pio
+try:
+    #Optional: parses cached figures several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+#Numeric arrays shorter than this stay JSON lists; short arrays gain little, and plotly.js only decodes typed arrays in data arrays, not in fixed-length settings like domain [0, 1]
+typedArrayMinimumLength = 16
+#Trace fields that must stay JSON: geojson is not a data array, and locations and ids are matched as categories
+_plainFields = {"geojson", "locations", "ids"}
+#Smallest first, so whole numbers get the narrowest type that holds them
+_integerTypes = (
+    (numpy.int8, "i1"),
+    (numpy.uint8, "u1"),
+    (numpy.int16, "i2"),
+    (numpy.uint16, "u2"),
+    (numpy.int32, "i4"),
+    (numpy.uint32, "u4"),
+)
+
+def typedArray (values):
+    '''
+    A function to encode a numeric array as a plotly.js typed array ({"dtype", "bdata", "shape"}, read by plotly.js 2.28 and later), in the narrowest type that holds every value exactly: whole numbers as 8, 16 or 32-bit integers, others as 32 or 64-bit floats. Base64 of a float64 is longer than short decimals written out, so the array is only encoded when that makes it smaller.
+    ----
+    Parameters:
+        values - a 1 or 2-dimensional array (numpy array, list or tuple)
+    Returns:
+        encoded - the typed array (dict), or values unchanged if they are not numeric or encoding would not make them smaller
+    '''
+    array = numpy.asarray(values)
+    if array.dtype.kind not in "iuf" or array.ndim not in (1, 2) or array.size < typedArrayMinimumLength:
+        return values
+    encoded = None
+    finite = numpy.isfinite(array).all() if array.dtype.kind == "f" else True
+    if finite and (array.dtype.kind != "f" or (array == numpy.round(array)).all()):
+        low, high = array.min(), array.max()
+        for integerType, dtype in _integerTypes:
+            limits = numpy.iinfo(integerType)
+            if limits.min <= low and high <= limits.max:
+                encoded = array.astype(numpy.dtype(integerType).newbyteorder("<"))
+                break
+    if encoded is None:
+        single = array.astype(numpy.float32)
+        if numpy.array_equal(single, array, equal_nan=True):
+            encoded, dtype = single.astype("<f4"), "f4"
+        else:
+            encoded, dtype = array.astype("<f8"), "f8"
+    bdata = base64.b64encode(numpy.ascontiguousarray(encoded).tobytes()).decode("ascii")
+    if len(bdata) >= len(json.dumps(array.tolist())):
+        return values
+    spec = {"dtype": dtype, "bdata": bdata}
+    if array.ndim == 2:
+        spec["shape"] = f"{array.shape[0]},{array.shape[1]}"
+    return spec
+
+def _compactValue (field, value):
+    if field in _plainFields:
+        return value
+    if isinstance(value, dict):
+        return {key: _compactValue(key, item) for key, item in value.items()}
+    if isinstance(value, numpy.ndarray) or (isinstance(value, (list, tuple)) and len(value) >= typedArrayMinimumLength):
+        return typedArray(value)
+    return value
+
+def compactTrace (trace):
+    '''Returns a copy of a trace dict with its numeric arrays encoded as typed arrays where that is smaller (see typedArray)'''
+    return {field: _compactValue(field, value) for field, value in trace.items()}
+
+def compactFigure (figure):
+    '''
+    A function to shrink a figure before it is sent: every trace's numeric arrays are encoded as typed arrays where that is smaller. The layout is left as it is.
+    ----
+    Parameters:
+        figure - the figure (go.Figure or dict)
+    Returns:
+        figDict - a copy of the figure; fields that were not encoded are shared with it, so do not modify it in place (dict)
+    '''
+    if hasattr(figure, "to_plotly_json"):
+        figure = figure.to_plotly_json()
+    return dict(figure, data=[compactTrace(trace) for trace in figure.get("data", [])])
+
+def figureToJSON (figure):
+    '''Serializes a figure compactly (see compactFigure) for the figure cache and snapshots (bytes)'''
+    return pio.to_json(compactFigure(figure), validate=False).encode()
+
+def figureFromJSON (figureJSON):
+    '''Parses a serialized figure (bytes) back into a dict, e.g. to return it from a Dash callback'''
+    if orjson is not None:
+        return orjson.loads(figureJSON)
+    return json.loads(figureJSON)
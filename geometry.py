@@ -0,0 +1,190 @@
+import os
+import json
+import numpy
+import shapely
+import threading
+from datastore import writeAtomically
+
+#Simplification tolerance (degrees) and coordinate precision (decimal places) for each geometry tier. At Toronto's latitude 0.0001 degrees is roughly 10 m
+geometryTiers = {
+    "full": {"tolerance": 0, "decimals": None},
+    "high": {"tolerance": 0.00002, "decimals": 6},
+    "medium": {"tolerance": 0.0001, "decimals": 5},
+    "low": {"tolerance": 0.0003, "decimals": 5},
+}
+
+geometryCacheFolder = "data/cache"
+
+_tierCache = {}
+_tierLock = threading.Lock()
+_outlineCache = {}
+
+def chooseGeometryTier (zoom, exportMode=False):
+    '''
+    A function to pick the coarsest geometry tier that still looks right at a map zoom level.
+    ----
+    Parameters:
+        zoom - the mapbox zoom the map is drawn at, i.e. mapZoomSettings[0] (float)
+        exportMode - True when the map is being exported to a file rather than drawn on screen (bool)
+    Returns:
+        tier - a key of geometryTiers (str)
+    '''
+    if exportMode or zoom >= 14:
+        return "high"
+    if zoom >= 12:
+        return "medium"
+    return "low"
+
+def simplifyGeometry (geoData, tier):
+    '''
+    A function to simplify and quantize every geometry in a GeoDataFrame. Neighbouring polygons are simplified as one coverage so shared borders stay shared (no gaps or slivers between neighbourhoods), then snapped to the tier's decimal grid.
+    ----
+    Parameters:
+        geoData - the geometry to simplify (gpd.GeoDataFrame)
+        tier - a key of geometryTiers (str)
+    Returns:
+        simplifiedGeoData - a simplified copy of geoData (gpd.GeoDataFrame)
+    '''
+    settings = geometryTiers[tier]
+    geometries = geoData.geometry.to_numpy()
+    if settings["tolerance"]:
+        if hasattr(shapely, "coverage_simplify"):
+            geometries = shapely.coverage_simplify(geometries, settings["tolerance"])
+        else:
+            #shapely < 2.1 has no coverage simplification; simplify each polygon on its own
+            geometries = shapely.simplify(geometries, settings["tolerance"], preserve_topology=True)
+    if settings["decimals"] is not None:
+        decimals = settings["decimals"]
+        geometries = shapely.set_precision(geometries, 10 ** -decimals)
+        #set_precision snaps to the grid but can leave float noise like 43.712340000000005, which would be written out in full
+        geometries = shapely.transform(geometries, lambda coordinates: numpy.round(coordinates, decimals))
+    return geoData.set_geometry(geometries, crs=geoData.crs)
+
+def _cachePath (sourcePath, tier):
+    stem = os.path.splitext(os.path.basename(sourcePath))[0]
+    return os.path.join(geometryCacheFolder, f"{stem}.{tier}.geojson")
+
+def _layerSource (store, layer):
+    if layer == "neighbourhood":
+        return store.neighbourhoodGeo, store.neighbourhoodGeoDict, store.neighbourhoodFilePath
+    if layer == "ward":
+        return store.wardGeo, store.wardGeoDict, store.citywardsFilePath
+    raise ValueError(f"Unknown geometry layer {layer}")
+
+def geometryTier (store, layer, tier):
+    '''
+    A function to get one geometry tier of a store as a FeatureCollection readable by plotly. Tiers are kept in memory and cached to geometryCacheFolder; a cached file older than its source geojson is rebuilt.
+    ----
+    Parameters:
+        store - the store holding the full-precision geometry (CensusStore)
+        layer - "neighbourhood" or "ward" (str)
+        tier - a key of geometryTiers (str)
+    Returns:
+        geoDataDict - the simplified geometry (dict)
+    '''
+    geoData, fullGeoDataDict, sourcePath = _layerSource(store, layer)
+    if tier == "full":
+        return fullGeoDataDict
+
+    sourceMtime = os.path.getmtime(sourcePath)
+    key = (sourcePath, tier)
+    cached = _tierCache.get(key)
+    if cached is not None and cached[0] == sourceMtime:
+        return cached[1]
+
+    with _tierLock:
+        cached = _tierCache.get(key)
+        if cached is not None and cached[0] == sourceMtime:
+            return cached[1]
+        cachePath = _cachePath(sourcePath, tier)
+        if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= sourceMtime:
+            with open(cachePath) as cacheFile:
+                geoDataDict = json.load(cacheFile)
+        else:
+            geoDataDict = json.loads(simplifyGeometry(geoData, tier).to_json())
+            geoDataDict = {
+                "type": "FeatureCollection",
+                "features": geoDataDict["features"]
+            }
+            writeAtomically(cachePath, lambda cacheFile: json.dump(geoDataDict, cacheFile, separators=(",", ":")), mode="w")
+        _tierCache[key] = (sourceMtime, geoDataDict)
+    return geoDataDict
+
+def wardOutlines (store, tier):
+    '''
+    A function to get the ward outlines of a geometry tier as NumPy coordinate arrays, one entry per ward. Every ring of a ward is joined into one line, separated by NaN, which plotly draws as a gap (NaN is sent as null). Computed once per tier and reused.
+    ----
+    Parameters:
+        store - the store holding the ward geometry (CensusStore)
+        tier - a key of geometryTiers (str)
+    Returns:
+        outlines - (ward name, longitudes, latitudes) for each ward (list of tuples of str, numpy array, numpy array)
+    '''
+    cityGeoDataDict = geometryTier(store, "ward", tier)
+    key = (store.citywardsFilePath, tier)
+    cached = _outlineCache.get(key)
+    if cached is not None and cached[0] is cityGeoDataDict:
+        return cached[1]
+
+    outlines = []
+    gap = numpy.full((1, 2), numpy.nan)
+    for feature in cityGeoDataDict["features"]:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        rings = []
+        for polygon in polygons:
+            for ring in polygon:
+                rings.append(numpy.asarray(ring, dtype=numpy.float64)[:, :2])
+                rings.append(gap)
+        coordinates = numpy.concatenate(rings[:-1])
+        coordinates.setflags(write=False)
+        outlines.append((feature["properties"]["AREA_NAME"], coordinates[:, 0], coordinates[:, 1]))
+    _outlineCache[key] = (cityGeoDataDict, outlines)
+    return outlines
+
+def mergedWardOutline (store, tier):
+    '''
+    A function to join every ward outline of a geometry tier into a single line, so all wards can be drawn as one trace.
+    ----
+    Parameters:
+        store - the store holding the ward geometry (CensusStore)
+        tier - a key of geometryTiers (str)
+    Returns:
+        lon - longitudes, with NaN between rings and wards (numpy array)
+        lat - latitudes, with NaN between rings and wards (numpy array)
+        text - the ward name of each point, for hover text (numpy array of str)
+    '''
+    outlines = wardOutlines(store, tier)
+    lonArrays, latArrays, textArrays = [], [], []
+    for wardName, lon, lat in outlines:
+        lonArrays += [lon, [numpy.nan]]
+        latArrays += [lat, [numpy.nan]]
+        textArrays += [numpy.full(len(lon) + 1, wardName)]
+    lon = numpy.concatenate(lonArrays[:-1])
+    lat = numpy.concatenate(latArrays[:-1])
+    text = numpy.concatenate(textArrays)[:-1]
+    return lon, lat, text
+
+def buildGeometryTiers (store):
+    '''
+    A function to build (or refresh) the cached geometry tiers for both the neighbourhood and ward geometry of a store. Run "python geometry.py" to do this ahead of deploying.
+    ----
+    Parameters:
+        store - the store to build tiers for (CensusStore)
+    Returns:
+        paths - the cache files, one per geometry and tier (list of str)
+    '''
+    paths = []
+    for layer in ("neighbourhood", "ward"):
+        sourcePath = _layerSource(store, layer)[2]
+        for tier in geometryTiers:
+            if tier == "full":
+                continue
+            geometryTier(store, layer, tier)
+            paths.append(_cachePath(sourcePath, tier))
+    return paths
+
+if __name__ == '__main__':
+    from datastore import getStore
+    for path in buildGeometryTiers(getStore()):
+        print(f"{path}: {os.path.getsize(path)} bytes")
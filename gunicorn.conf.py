@@ -0,0 +1,23 @@
+#Gunicorn settings, picked up automatically by "gunicorn map:server" (see Procfile)
+
+#Import map.py (and with it the shared data store in datastore.py) once in the master process, so every worker starts with the census table and geometry already parsed and shares those pages copy-on-write
+preload_app = True
+
+#Warm up (load the data and build the first page's figures, see startup.py) in the master before forking, rather than in a background thread that forking would cut short
+import os
+os.environ.setdefault("STARTUP_MODE", "eager")
+#Each worker would otherwise keep its own stacked-bar sessions (see sessions.py), and a browser's requests can reach any worker
+os.environ.setdefault("SESSION_BACKEND", "sqlite")
+
+def on_reload(server):
+    '''Re-reads data/ in the master on SIGHUP so the workers gunicorn forks next see the new files'''
+    import datastore
+    reloaded = datastore.reloadStore()
+    server.log.info(f"Reloaded census data stores: {reloaded}")
+
+def post_worker_init(worker):
+    '''Starts each worker's kaleido export pool (see export.py) before it takes requests, if EXPORT_WARM is set'''
+    import os
+    if os.environ.get("EXPORT_WARM"):
+        import export
+        export.exportPool.warm()
@@ -1,126 +1,111 @@
 import json
+import time
 import dash
-import pandas
+import numpy
 import textwrap
-import statistics
-import geopandas as gpd 
 import plotly.io as pio
 import plotly.graph_objects as go
 from dash import Dash, html, dcc, Input, Output, State
-pio.kaleido.scope.mathjax = None
+from datastore import getStore, neighbourhoodFilePath, censusFilePath, citywardsFilePath
+from search import searchRows, getSearchIndex
+from figcache import figureCache
+from figjson import compactFigure, compactTrace, figureToJSON, figureFromJSON
+from compression import compressResponses, compressionStats
+from metrics import metrics, span, cacheCollector, instrumentServer
+from export import exportPool
+from geometry import chooseGeometryTier, geometryTier, wardOutlines, mergedWardOutline
+from startup import startWarmUp
+from sessions import sessionStore
+from stats import formatStat
+from classify import classificationModes, getClassification, Classification
+from snapshots import snapshotStore, registerSnapshotRoutes
+from dataapi import registerDataRoutes
+from compare import comparisonModes, correlationMethods, compareRows, combineValues, summarizeValues, getCorrelationIndex
+from spatial import mapLevels, wardAggregations, getSpatialIndex
+from plotly.colors import sample_colorscale
 
-#Constants for file paths
-neighbourhoodFilePath = "data/Neighbourhoods.geojson"
-censusFilePath =  "data/CityCensusData.csv"
-citywardsFilePath = "data/CityWards.geojson"
+_mapTemplates = {}
 
-def censusMap (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, fileName=None):
+def censusMapTemplate (geoDataFilePath, dataSource, mapZoomSettings, exportMode=False, tier=None, wardTraceMode="ward", layer="neighbourhood"):
     '''
-    A function to convert a single row of census 2021 data to a map relative to Toronto's neighbourhoods. 
+    A function to build everything in the census map that does not depend on the census row: the neighbourhood (or ward) geometry, ward outlines, layout and annotations. It is built once per store, zoom setting, geometry tier and layer and shared, so never modify the returned dict; censusMapFigure() copies what it changes.
     ----
     Parameters:
         geoDataFilePath - the path for the geoData (str to .geojson file path)
-            "data/Neighbourhoods.geojson" for city-wide neighbourhood map
-        dataSource - the path for the data (str to .json file path)
-            "data/CityCensusData.csv" for city-wide Census 2021 data
-        rowCompare - the row in dataSource  to measure data from (int)
-        title - the title of the graph (str)
-        rowArrayBar - label for the variable (str)
-        mapZoomSettings - specific settings for map zooming (array). Should be set up in form
-            [Zoom variable (float), latitude (float), longitude (float), export height (int) [optional], export width (int) [optional]]
-            ---
-            Use [11, 43.710, -79.380, 2000, 1250] for City of Toronto-wide maps
-        fileName - the path where you want to export the file in a PDF form. If left blank, the graph will not be exported. If this parameter is used, ensure mapZoomSettings have export heights and export widths (str)
-
+        dataSource - the path for the data (str to .csv file path)
+        mapZoomSettings - specific settings for map zooming (array), see censusMap. Only the first three entries are used
+        exportMode - True to use the finer geometry tier meant for exported files (bool)
+        tier - a geometry tier to use instead of the one chosen from the zoom and exportMode (str, see geometry.geometryTiers)
+        wardTraceMode - how ward outlines are drawn (str)
+            "ward" for one trace and legend entry per ward, each ward's rings joined into one line
+            "merged" for a single trace holding every ward, with the ward name as hover text
+        layer - what the choropleth fills: "neighbourhood", or "ward" for a map of wards, which needs no separate ward outlines (str)
     Returns:
-        fig - a Plotly figure object (go.Figure)
+        mapTemplate - a Plotly figure dict without z values or a title (dict)
     '''
     global citywardsFilePath
-    #Opens up geoData, reads and converts it to a JSON (feature), then converts it to a FeatureCollection readable by plotly
-    geoData = gpd.read_file(geoDataFilePath)
-    geoDataJSON = geoData.to_json()
-    geoDataDict = json.loads(geoDataJSON)
-    geoDataDict = {
-        "type": "FeatureCollection",
-        "features": geoDataDict['features']
-    }
+    store = getStore(dataSource, geoDataFilePath, citywardsFilePath)
+    if tier is None:
+        tier = chooseGeometryTier(mapZoomSettings[0], exportMode)
+    key = (dataSource, geoDataFilePath, citywardsFilePath, tuple(mapZoomSettings[:3]), tier, wardTraceMode, layer)
+    cached = _mapTemplates.get(key)
+    if cached is not None and cached[0] is store:
+        return cached[1]
 
-    rowArray = []
-
-    #Imports Census Data
-    censusData = pandas.read_csv(dataSource)
-
-    rowCompare = int(rowCompare) - 2
-    #Traverses censusData, appends the rowCompare value as an int relative to Neighbourhood array
-    df_geo = pandas.DataFrame(geoData.drop(columns="geometry"))
-    columnsSet = set(censusData.columns)
-    graphTitle = censusData.iloc[rowCompare]["Neighbourhood Name"]
-    for _, row in df_geo.iterrows():
-        neighbourhood_name = row["AREA_NAME"]
-        
-        if neighbourhood_name in columnsSet:
-            neighbourhood_data = censusData[neighbourhood_name] 
-            rowArray.append(neighbourhood_data[rowCompare])
-        else: 
-            print(f"Not appended {neighbourhood_name}")
+    #Gets the geoData, simplified for the zoom level and converted to a FeatureCollection readable by plotly (see geometry.py)
+    with span("censusMapTemplate", "geometry"):
+        geoData = store.neighbourhoodGeo if layer == "neighbourhood" else store.wardGeo
+        geoDataDict = geometryTier(store, layer, tier)
+        #Only AREA_ID (the featureidkey) is read in the browser; the other properties would be sent with every full map
+        geoDataDict = dict(geoDataDict, features=[
+            dict(feature, properties={"AREA_ID": feature["properties"]["AREA_ID"]})
+            for feature in geoDataDict["features"]
+        ])
+    figureStart = time.perf_counter()
 
-    #Creates a figure with its fill being the z value (in this case, rowArray), relative to all the other z values
+    #Creates a figure whose fill (z) is set per row by censusMapFigure
     fig = go.Figure(go.Choroplethmapbox(
         geojson=geoDataDict,
         locations=geoData["AREA_ID"],  
-        z=rowArray,  
         marker_opacity=0.5,
         marker_line_width=1,
         featureidkey="properties.AREA_ID", 
         text = geoData["AREA_NAME"],
         hoverinfo="text+z",
-        hovertemplate= f"%{{text}}<br>%{{z}} {rowArrayBar}<extra></extra>",
         hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
         colorbar=dict(
-            title=rowArrayBar,
             tickfont = dict(family = "proxima-nova, sans-serif"),
         )
     ))
 
-    #Appends ward outlines (opens up data, gets coords, and then adds a Scatter trace with each trace connected with a line)
-
-    cityGeoData = gpd.read_file(citywardsFilePath)
-    cityGeoDataJSON = cityGeoData.to_json()
-    cityGeoDataDict = json.loads(cityGeoDataJSON)
-    cityGeoDataDict = {
-        "cityGeoData": "FeatureCollection",
-        "features": cityGeoDataDict["features"]
-    }
-
-    mainlonArray = []
-    mainlatArray = []
-    wardNameArray = []
- 
-    for feature in cityGeoDataDict["features"]:
-        geometry = feature["geometry"]
-        properties = feature["properties"]
-        wardNameArray.append(properties["AREA_NAME"])
-        for polygon in geometry["coordinates"]:
-            for multiCoordinate in polygon:
-                lonArray = []
-                latArray = []
-                for coordinate in multiCoordinate:
-                    lonArray.append(coordinate[0])
-                    latArray.append(coordinate[1])
-                mainlonArray.append(lonArray)
-                mainlatArray.append(latArray)
-    i = 0
-    for i in range(len(mainlatArray)):
-        fig.add_trace(go.Scattermapbox(
-            mode = "lines",
-            showlegend=True,
-            lon=mainlonArray[i],
-            lat=mainlatArray[i],
-            line=dict(width=2, color="red"),  
-            text = wardNameArray[i],
-            name =  wardNameArray[i],
-            hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
-        ))
+    #Appends ward outlines, precomputed as NumPy lon/lat arrays per geometry tier (see geometry.wardOutlines); a map of wards draws their boundaries itself
+    if layer == "neighbourhood":
+        if wardTraceMode == "merged":
+            lon, lat, text = mergedWardOutline(store, tier)
+            fig.add_trace(go.Scattermapbox(
+                mode = "lines",
+                showlegend=True,
+                lon=lon,
+                lat=lat,
+                line=dict(width=2, color="red"),  
+                text = text,
+                hoverinfo="text",
+                name = "City wards",
+                hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
+            ))
+        else:
+            for wardName, lon, lat in wardOutlines(store, tier):
+                fig.add_trace(go.Scattermapbox(
+                    mode = "lines",
+                    showlegend=True,
+                    legendgroup=wardName,
+                    lon=lon,
+                    lat=lat,
+                    line=dict(width=2, color="red"),  
+                    text = wardName,
+                    name =  wardName,
+                    hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
+                ))
 
     #Updates appearance
     fig.update_layout(
@@ -128,7 +113,7 @@ def censusMap (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSett
         mapbox_zoom=mapZoomSettings[0], 
         mapbox_center={"lat": mapZoomSettings[1], "lon": mapZoomSettings[2]}, 
         margin={"r":0,"t":60,"l":0,"b":0}, 
-        title={"text": graphTitle, "x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
+        title={"x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
         legend=dict(
             x=1.1,               
             y=0.25,               
@@ -150,8 +135,161 @@ def censusMap (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSett
         )]
     )
 
+    mapTemplate = fig.to_plotly_json()
+    metrics.observe("census_stage_seconds", time.perf_counter() - figureStart, {"function": "censusMapTemplate", "stage": "figure"})
+    _mapTemplates[key] = (store, mapTemplate)
+    return mapTemplate
+
+def wardOrder (wardValues):
+    '''The ward counterpart of CensusStore.geoOrder: ward values are already in ward geojson order, so this only returns them as a new float array, safe to modify'''
+    return numpy.array(wardValues, dtype=numpy.float64)
+
+def mapColouring (store, rowIndex, rowArrayBar, classification="none", compareIndex=None, comparison="ratio", level="neighbourhood"):
+    '''
+    A function to get the choropleth fields that colour the map for one row: raw values on a continuous scale, or a precomputed classification (see classify.py) on a stepped one. Every mode sets the same fields (None restores Plotly's default), so switching modes can be sent as a patch.
+    ----
+    Parameters:
+        store - the store holding the row (CensusStore)
+        rowIndex - the row, 0-based (int)
+        rowArrayBar - label for the variable (str)
+        classification - a key of classify.classificationModes (str)
+        compareIndex - a second row (0-based) to compare the row with, or None to map the row on its own (int)
+        comparison - how the row is compared with compareIndex, a key of compare.comparisonModes (str)
+        level - a key of spatial.mapLevels: "neighbourhood" to colour neighbourhoods, otherwise wards, from the row aggregated by spatial.py (str)
+    Returns:
+        fields - z, customdata (value, rank, percentile), hovertemplate, colorscale, zmin, zmax and colorbar settings, for a Choroplethmapbox trace (dict)
+    '''
+    if classification not in classificationModes:
+        raise ValueError(f"Unknown classification {classification}")
+    order = store.geoOrder
+    if level != "neighbourhood":
+        #Ward values are precomputed for every row and already in ward geojson order; there are only 25, so they are classified and summarized on the spot
+        spatialIndex = getSpatialIndex(store)
+        columnValues = spatialIndex.wardValues(rowIndex, wardAggregations[level])
+        if compareIndex is not None:
+            columnValues = combineValues(columnValues, spatialIndex.wardValues(compareIndex, wardAggregations[level]), comparison)
+        classified = Classification(columnValues[None, :], getClassification(store).classes)
+        rowSummary = summarizeValues(columnValues)
+        rowIndex = 0
+        order = wardOrder
+    elif compareIndex is None:
+        classified = getClassification(store)
+        columnValues = store.rowValues(rowIndex)
+        rowSummary = store.rowSummary(rowIndex)
+    else:
+        #A compared row is not precomputed, but it is a single row of 158 values, so it is classified and summarized on the spot
+        columnValues = compareRows(store, rowIndex, compareIndex, comparison)
+        classified = Classification(columnValues[None, :], getClassification(store).classes)
+        rowSummary = summarizeValues(columnValues)
+        rowIndex = 0
+    values = order(columnValues)
+    #Percentiles are shown whole, so they are sent whole
+    customdata = numpy.column_stack([values, order(classified.ranks(rowIndex)), numpy.round(order(classified.percentiles(rowIndex)))])
+    firstLines = f"%{{text}}<br>%{{customdata[0]}} {rowArrayBar}"
+    if rowSummary["count"]:
+        firstLines += f"<br>Rank %{{customdata[1]}} of {formatStat(rowSummary['count'])} (percentile %{{customdata[2]:.0f}})"
+    fields = {
+        "customdata": customdata,
+        "hovertemplate": summaryHovertemplate(firstLines, rowSummary),
+    }
+    if classification == "none":
+        fields.update(z=values, colorscale=None, zmin=None, zmax=None, colorbar=dict(title=dict(text=rowArrayBar), tickvals=None, ticktext=None))
+        return fields
+
+    classes = order(classified.rowClasses(classification, rowIndex))
+    classes[classes < 0] = numpy.nan
+    breaks = classified.breaks(classification, rowIndex)
+    classCount = len(breaks) - 1
+    #A stepped colorscale: each class gets one flat band of colour
+    colours = sample_colorscale("Plasma", [i / max(classCount - 1, 1) for i in range(classCount)])
+    colorscale = []
+    for i, colour in enumerate(colours):
+        colorscale += [[i / classCount, colour], [(i + 1) / classCount, colour]]
+    fields.update(
+        z=classes,
+        colorscale=colorscale,
+        zmin=-0.5,
+        zmax=classCount - 0.5,
+        colorbar=dict(
+            title=dict(text=f"{rowArrayBar}<br>({classificationModes[classification]})"),
+            tickvals=list(range(classCount)),
+            ticktext=[f"{formatStat(breaks[i])} to {formatStat(breaks[i + 1])}" for i in range(classCount)],
+        ),
+    )
+    return fields
+
+def censusMapFigure (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, exportMode=False, tier=None, wardTraceMode="ward", classification="none", comparison=None, level="neighbourhood"):
+    '''
+    A function to get the census map for a single row as a Plotly figure dict, without rebuilding any geometry. Only the choropleth trace and the title are copied from censusMapTemplate(); the geometry and ward traces are shared with it, so do not modify the result in place. dcc.Graph, pio.to_json and pio.write_image all accept it directly.
+    ----
+    Parameters:
+        geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings - see censusMap
+        exportMode, tier, wardTraceMode - see censusMapTemplate
+        classification - how neighbourhoods are coloured, a key of classify.classificationModes (str, see mapColouring)
+        comparison - (row B, a key of compare.comparisonModes) to map rowCompare as a ratio, difference or per-capita rate of row B, or None to map rowCompare on its own (tuple of int, str)
+        level - whether neighbourhoods or wards are coloured, a key of spatial.mapLevels (str, see mapColouring)
+    Returns:
+        figDict - a Plotly figure dict (dict)
+    '''
+    global citywardsFilePath
+    with span("censusMapFigure", "data"):
+        store = getStore(dataSource, geoDataFilePath, citywardsFilePath)
+    with span("censusMapFigure", "template"):
+        mapTemplate = censusMapTemplate(geoDataFilePath, dataSource, mapZoomSettings, exportMode, tier, wardTraceMode, "neighbourhood" if level == "neighbourhood" else "ward")
+
+    rowCompare = int(rowCompare) - 2
+    #Slices the rowCompare values out of the census matrix, already permuted into the geoData's neighbourhood order
+    graphTitle = str(store.rowLabels[rowCompare])
+    with span("censusMapFigure", "colouring"):
+        if comparison is None:
+            colouring = mapColouring(store, rowCompare, rowArrayBar, classification, level=level)
+        else:
+            compareIndex = int(comparison[0]) - 2
+            graphTitle = f"{graphTitle.strip()} {comparisonModes[comparison[1]][1]} {str(store.rowLabels[compareIndex]).strip()}"
+            colouring = mapColouring(store, rowCompare, rowArrayBar, classification, compareIndex, comparison[1], level)
+    if level != "neighbourhood":
+        graphTitle = f"{graphTitle.strip()} by ward ({wardAggregations[level]})"
+
+    choropleth = mapTemplate["data"][0]
+    choropleth = dict(choropleth, **colouring)
+    choropleth["colorbar"] = dict(mapTemplate["data"][0]["colorbar"], **colouring["colorbar"])
+    layout = mapTemplate["layout"]
+    layout = dict(layout, title=dict(layout["title"], text=graphTitle))
+    return {"data": [choropleth] + mapTemplate["data"][1:], "layout": layout}
+
+def censusMap (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, fileName=None, wardTraceMode="ward"):
+    '''
+    A function to convert a single row of census 2021 data to a map relative to Toronto's neighbourhoods. 
+    ----
+    Parameters:
+        geoDataFilePath - the path for the geoData (str to .geojson file path)
+            "data/Neighbourhoods.geojson" for city-wide neighbourhood map
+        dataSource - the path for the data (str to .json file path)
+            "data/CityCensusData.csv" for city-wide Census 2021 data
+        rowCompare - the row in dataSource  to measure data from (int)
+        title - the title of the graph (str)
+        rowArrayBar - label for the variable (str)
+        mapZoomSettings - specific settings for map zooming (array). Should be set up in form
+            [Zoom variable (float), latitude (float), longitude (float), export height (int) [optional], export width (int) [optional]]
+            ---
+            Use [11, 43.710, -79.380, 2000, 1250] for City of Toronto-wide maps
+        fileName - the path where you want to export the file in a PDF form. If left blank, the graph will not be exported. If this parameter is used, ensure mapZoomSettings have export heights and export widths (str)
+        wardTraceMode - "ward" for one legend entry per ward or "merged" for all ward outlines in one trace (str, see censusMapTemplate)
+
+    Returns:
+        fig - a Plotly figure object (go.Figure)
+    '''
+    with span("censusMap", "figure"):
+        figDict = censusMapFigure(geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, exportMode=fileName is not None, wardTraceMode=wardTraceMode)
+    with span("censusMap", "graph object"):
+        #go.Figure copies figDict, so the shared template is left untouched
+        fig = go.Figure(figDict)
+
     if fileName is not None and len(mapZoomSettings) == 5:
-       fig.write_image(fileName, format="pdf", engine="kaleido", width= mapZoomSettings[3], height=mapZoomSettings[4])
+       #Set here rather than at import, since touching pio.kaleido.scope loads kaleido
+       pio.kaleido.scope.mathjax = None
+       with span("censusMap", "export"):
+           fig.write_image(fileName, format="pdf", engine="kaleido", width= mapZoomSettings[3], height=mapZoomSettings[4])
     return fig 
 
 def censusBar (dataSource, rowSelect, fileName = None):
@@ -166,32 +304,36 @@ def censusBar (dataSource, rowSelect, fileName = None):
     Returns:
         fig_bar - a Plotly figure object (go.Figure)
     '''
+    dataStart = time.perf_counter()
     fig_bar = go.Figure()
-    censusData = pandas.read_csv(dataSource)
+    store = getStore(dataSource)
     rowSelect -= 2
-    rowArray = censusData.iloc[rowSelect].to_list()
-    graphTitle = rowArray[0]
-    rowArray.pop(0) 
-    try:
-        rowArrayFloat =  list(map(float, rowArray))
-    except ValueError:
-        rowArrayFloat = rowArray
+    graphTitle = str(store.rowLabels[rowSelect])
+    rowArrayFloat = store.rowValues(rowSelect)
+    rowSummary = store.rowSummary(rowSelect)
+    hasNumbers = rowSummary["count"] > 0
+    if not hasNumbers:
+        #Rows with no numbers at all (e.g. TSNS 2020 Designation) are plotted as their raw text
+        rowArrayFloat = store.rowText(rowSelect)
 
-    x_values = censusData.columns.to_list()
-    x_values.pop(0)
+    x_values = list(store.columnNames)
+    figureStart = time.perf_counter()
+    metrics.observe("census_stage_seconds", figureStart - dataStart, {"function": "censusBar", "stage": "data"})
     
     fig_bar.add_trace(go.Bar(
         x=x_values,
         y=rowArrayFloat,
         name="Neighbourhood<br>Data",
-        marker_color="blue"
+        marker_color="blue",
+        hovertemplate=summaryHovertemplate("%{x}<br>%{y}", rowSummary)
     ))
 
     x1_endpoint = len(fig_bar.data[0]["x"])
 
-    if isinstance(rowArrayFloat[2], float):
+    if hasNumbers:
         '''"Else" special case for if rowSelect = 1'''
-        cityWideMedian = statistics.median(rowArrayFloat) 
+        cityWideMedian = rowSummary["median"]
+        medianName = f"City-wide Median<br>({cityWideMedian})"
             
         fig_bar.add_shape(
             type="line",
@@ -200,16 +342,21 @@ def censusBar (dataSource, rowSelect, fileName = None):
             y0=cityWideMedian,
             y1=cityWideMedian,
             line=dict(color="red", width=3, dash="dash"), 
-            name=f"City-wide Median<br>({cityWideMedian})"
+            name=medianName
         )
-        fig_bar.add_trace(go.Scatter(
-            x=[None],  
-            y=[None],
-            mode="lines",
-            line=dict(color="red", width=2, dash="dash"),
-            showlegend=True,
-            name=f"City-wide Median<br>({cityWideMedian})"
-        ))
+    else:
+        medianName = "City-wide Median"
+
+    #The median legend entry is always present (hidden for rows without numbers) so censusBarPatch can update it in place
+    fig_bar.add_trace(go.Scatter(
+        x=[None],  
+        y=[None],
+        mode="lines",
+        line=dict(color="red", width=2, dash="dash"),
+        showlegend=True,
+        visible=hasNumbers,
+        name=medianName
+    ))
 
     fig_bar.update_layout(
         title={"text": graphTitle, "x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
@@ -221,8 +368,147 @@ def censusBar (dataSource, rowSelect, fileName = None):
         yaxis_title_font=dict(family="proxima-nova, sans-serif"),
         font=dict(family="proxima-nova, sans-serif")
     )
+    metrics.observe("census_stage_seconds", time.perf_counter() - figureStart, {"function": "censusBar", "stage": "figure"})
     return fig_bar
 
+def summaryHovertemplate (firstLines, rowSummary):
+    '''
+    A function to build hover text that adds a row's city-wide statistics (from the precomputed table, see stats.py) under the hovered value.
+    ----
+    Parameters:
+        firstLines - the hovertemplate for the hovered value itself, e.g. "%{x}<br>%{y}" (str)
+        rowSummary - the row's statistics, see CensusStore.rowSummary (dict)
+    Returns:
+        hovertemplate - the Plotly hovertemplate (str)
+    '''
+    if not rowSummary["count"]:
+        return f"{firstLines}<extra></extra>"
+    return (
+        f"{firstLines}<br>"
+        f"City-wide median: {formatStat(rowSummary['median'])}<br>"
+        f"Middle half: {formatStat(rowSummary['q1'])} to {formatStat(rowSummary['q3'])}<br>"
+        f"City-wide total: {formatStat(rowSummary['total'])}"
+        "<extra></extra>"
+    )
+
+def cachedFigure (chartType, dataSource, rowSelect, settings, build):
+    '''
+    A function to get a figure through the shared LRU cache in figcache.py, keyed by chart type, row and settings (e.g. mapZoomSettings). The key includes when the data files were loaded, so reloading the store never serves stale figures.
+    ----
+    Parameters:
+        chartType - what is drawn, e.g. "map" or "bar" (str)
+        dataSource - the file source for the Census Data (str)
+        rowSelect - the row in the census data (int)
+        settings - anything else the figure depends on (tuple)
+        build - called on a miss to build the figure (function -> go.Figure or dict)
+    Returns:
+        figDict - the figure (dict)
+    '''
+    return figureCache.getFigure(_figureKey(chartType, dataSource, rowSelect, settings), build, chartType)
+
+def cachedFigureJSON (chartType, dataSource, rowSelect, settings, build):
+    '''Same as cachedFigure, but returns the serialized figure (bytes)'''
+    return figureCache.getOrBuild(_figureKey(chartType, dataSource, rowSelect, settings), build, chartType)
+
+def _figureKey (chartType, dataSource, rowSelect, settings):
+    return (chartType, dataSource, int(rowSelect), settings, getStore(dataSource).mtimes)
+
+def isCensusRow (rowSelect):
+    '''Whether a row number, as shown in the UI, is a row of the census data (bool)'''
+    return 2 <= rowSelect < len(getStore().rowLabels) + 2
+
+def liveFigureJSON (chart, rowSelect):
+    '''
+    A function to render the map or single bar graph of a row as first drawn on the page (values, no comparison), through the figure cache. snapshots.py writes these ahead of time.
+    ----
+    Parameters:
+        chart - "map" or "bar" (str)
+        rowSelect - the row in the census data, as shown in the UI (int)
+    Returns:
+        figureJSON - the serialized figure (bytes)
+    '''
+    rowSelect = int(rowSelect)
+    if not isCensusRow(rowSelect):
+        raise ValueError(f"Row {rowSelect} is not in the census data")
+    if chart == "map":
+        mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+        return cachedFigureJSON("map", censusFilePath, rowSelect, (tuple(mapZoomSettings), "Value", "none", None, "neighbourhood"), lambda: censusMapFigure(neighbourhoodFilePath, censusFilePath, rowSelect, "Value", mapZoomSettings))
+    if chart == "bar":
+        return cachedFigureJSON("bar", censusFilePath, rowSelect, (), lambda: censusBar(censusFilePath, rowSelect))
+    raise ValueError(f"Unknown chart {chart}")
+
+def rowFigureJSON (chart, rowSelect):
+    '''Same as liveFigureJSON, but reads the row's static snapshot instead when a current one has been built (see snapshots.py)'''
+    snapshot = snapshotStore.read(chart, rowSelect, getStore().mtimes)
+    metrics.increment("census_snapshot_requests_total", {"chart": chart, "result": "miss" if snapshot is None else "hit"})
+    return snapshot if snapshot is not None else liveFigureJSON(chart, rowSelect)
+
+def censusBarPatch (dataSource, rowSelect):
+    '''
+    A function to turn a single bar graph already on the page into the graph for another row, sending only the fields that change (the bar heights, median line and title) instead of the whole figure.
+    ----
+    Parameters:
+        dataSource - the file source for the Census Data (str)
+        rowSelect - the row in the census data to compare (ints)
+    Returns:
+        patch - partial update for a dcc.Graph figure that holds a censusBar figure (dash.Patch)
+    '''
+    fig_bar = cachedFigure("bar", dataSource, rowSelect, (), lambda: censusBar(dataSource, rowSelect))
+    patch = dash.Patch()
+    patch["data"][0]["y"] = fig_bar["data"][0]["y"]
+    patch["data"][0]["hovertemplate"] = fig_bar["data"][0]["hovertemplate"]
+    patch["data"][1]["name"] = fig_bar["data"][1]["name"]
+    patch["data"][1]["visible"] = fig_bar["data"][1]["visible"]
+    patch["layout"]["shapes"] = fig_bar["layout"].get("shapes", [])
+    patch["layout"]["title"]["text"] = fig_bar["layout"]["title"]["text"]
+    return patch
+
+def censusMapPatch (geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, classification="none", comparison=None, level="neighbourhood"):
+    '''
+    A function to turn a census map already on the page into the map for another row, classification or comparison. Only the colouring (see mapColouring) and title are sent; the neighbourhood geometry and ward outlines stay in the browser, so the map on the page must already be drawn at the same level.
+    ----
+    Parameters:
+        geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings - see censusMap
+        classification, comparison, level - see censusMapFigure
+    Returns:
+        patch - partial update for a dcc.Graph figure that holds a censusMapFigure figure (dash.Patch)
+    '''
+    figDict = censusMapFigure(geoDataFilePath, dataSource, rowCompare, rowArrayBar, mapZoomSettings, classification=classification, comparison=comparison, level=level)
+    choropleth = compactTrace(figDict["data"][0])
+    patch = dash.Patch()
+    for field in ("z", "customdata", "hovertemplate", "colorscale", "zmin", "zmax"):
+        patch["data"][0][field] = choropleth[field]
+    for field in ("tickvals", "ticktext"):
+        patch["data"][0]["colorbar"][field] = choropleth["colorbar"][field]
+    patch["data"][0]["colorbar"]["title"]["text"] = choropleth["colorbar"]["title"]["text"]
+    patch["layout"]["title"]["text"] = figDict["layout"]["title"]["text"]
+    return patch
+
+
+_barStackLayout = None
+
+def censusBarStackLayout ():
+    '''
+    A function to build the layout of the stacked bar graph, which is the same for every selection of rows. It is built once and shared, so never modify the returned dict.
+    ----
+    Returns:
+        layout - a Plotly layout dict, including the default template (dict)
+    '''
+    global _barStackLayout
+    if _barStackLayout is None:
+        fig_bar_stack = go.Figure()
+        fig_bar_stack.update_layout(
+            xaxis_title="Neighbourhoood<br> Made with torontocensusvisualizer.com",
+            yaxis_title="Value",
+            barmode="stack",
+            hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
+            title={"text": "Multi-variable stacked bar graph using Census 2021 data, City of Toronto", "x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
+            xaxis_title_font=dict(family="proxima-nova, sans-serif"),
+            yaxis_title_font=dict(family="proxima-nova, sans-serif"),
+            font=dict(family="proxima-nova, sans-serif")
+        )
+        _barStackLayout = fig_bar_stack.to_plotly_json()["layout"]
+    return _barStackLayout
 
 def censusBarStack (dataSource, input_array):
     '''
@@ -230,70 +516,48 @@ def censusBarStack (dataSource, input_array):
     ----
     Parameters:
         dataSource - the file source for the Census Data (str)
-        input_array - the array of rows to compare (array of ints)
+        input_array - the array of rows to compare, as row indexes, i.e. the UI row number - 2 (array of ints)
     Returns:
-        fig_bar_stack - a Plotly figure object (go.Figure)
-    '''
-    i = 0 
-    n = 0
-    rowArray = []
-    graphTitleArray = []
-    categoryValuesDict = {}
-
-    #Load census csv data
-
-    censusData = pandas.read_csv(dataSource)
-
-    while i < len(input_array):
-        ''' In operating within a non-front-end environemnt include this statement. 
-        -> input_array[i] -= 2
-        This is conducted in the front-end as it'll adjust the cancel buttons'''
-        rowArray.append(censusData.iloc[input_array[i]])
-        graphTitleArray.append(censusData.iloc[input_array[i]]["Neighbourhood Name"])
-        i += 1
-
-    for index, row in enumerate(rowArray):
-        key = f"categoryValues_{index+1}"
-        categoryValuesDict[key] = list(map(float, row.iloc[1:].values))
-
-    x_values = rowArray[0].index[1:]
-    graphData = {"Neighbourhoood": x_values}
-
-    for key, y_values in categoryValuesDict.items():
-        graphData[key] = y_values
-
-    graphDataFrame = pandas.DataFrame(graphData)
-
-    plotMelt_censusData = graphDataFrame.melt(id_vars="Neighbourhoood", var_name="Category", value_name="Value")
-
-    #Assign bar graph variable
-    fig_bar_stack = go.Figure()
-
-    #Plotly tracing
-    for category in plotMelt_censusData['Category'].unique():
-        category_data = plotMelt_censusData[plotMelt_censusData ['Category'] == category]
-        fig_bar_stack.add_trace(go.Bar(
-            x=category_data["Neighbourhoood"],
-            y=category_data["Value"],
-            name= "<br>".join(textwrap.wrap(graphTitleArray[n], width=18))
-        ))
-        n += 1
-
-    #Render bar graph
-    fig_bar_stack.update_layout(
-        xaxis_title="Neighbourhoood<br> Made with torontocensusvisualizer.com",
-        yaxis_title="Value",
-        barmode="stack",
-        hoverlabel= dict(font = dict(family = "proxima-nova, sans-serif")),
-        title={"text": "Multi-variable stacked bar graph using Census 2021 data, City of Toronto", "x": 0.5, "xanchor": "center", "yanchor": "top", "font": {"family": "proxima-nova, sans-serif", "weight": 700, "size": 25}},
-        xaxis_title_font=dict(family="proxima-nova, sans-serif"),
-        yaxis_title_font=dict(family="proxima-nova, sans-serif"),
-        font=dict(family="proxima-nova, sans-serif")
-    )
+        fig_bar_stack - a Plotly figure dict, sharing its layout with censusBarStackLayout() so do not modify it in place. dcc.Graph and pio.to_json accept it directly (dict)
+    '''
+    with span("censusBarStack", "data"):
+        store = getStore(dataSource)
+
+        #All rows are gathered from the matrix in one step, k x neighbourhoods
+        rowIndexes = numpy.asarray(input_array, dtype=numpy.intp)
+        rowMatrix = numpy.asarray(store.censusMatrix[rowIndexes])
+        x_values = list(store.columnNames)
+
+    #One bar trace per row, straight from its row of rowMatrix
+    with span("censusBarStack", "figure"):
+        fig_bar_stack = {
+            "data": [_barStackTrace(x_values, rowValues, store.rowLabels[rowIndex]) for rowIndex, rowValues in zip(rowIndexes, rowMatrix)],
+            "layout": censusBarStackLayout()
+        }
     return fig_bar_stack
 
-fig = censusMap(neighbourhoodFilePath, censusFilePath , 37, "Values", [10, 43.710, -79.380, 2000, 1250])
-fig_bar = censusBar(censusFilePath, 37)
+def _barStackTrace (x_values, rowValues, rowLabel):
+    #A plain dict: go.Bar would validate every value again, which costs more than everything else in censusBarStack
+    return {
+        "type": "bar",
+        "x": x_values,
+        "y": rowValues,
+        "name": "<br>".join(textwrap.wrap(str(rowLabel), width=18))
+    }
+
+def censusBarStackTrace (dataSource, rowIndex):
+    '''
+    A function to build the trace one row adds to the stacked bar graph, the same as censusBarStack draws it.
+    ----
+    Parameters:
+        dataSource - the file source for the Census Data (str)
+        rowIndex - the row, as a row index, i.e. the UI row number - 2 (int)
+    Returns:
+        trace - a Plotly bar trace (dict)
+    '''
+    store = getStore(dataSource)
+    return _barStackTrace(list(store.columnNames), store.rowValues(rowIndex), store.rowLabels[rowIndex])
+
 app = Dash(__name__, suppress_callback_exceptions=True, prevent_initial_callbacks='initial_duplicate')
 app.title = "Toronto Census Visualizer"
 app.index_string = '''
@@ -322,10 +586,11 @@ app.index_string = '''
 app.layout = html.Div(
     style={'color': '#252525'},
     children=[
-        dcc.Store(id = "input_array", data=[]),
-        dcc.Store(id = "figGlobalData", data=go.Figure().to_dict()),
-        dcc.Store(id = "figbarGlobalData", data=go.Figure().to_dict()),
-        dcc.Store(id = "figbarstackGlobalData", data=go.Figure().to_dict()),
+        dcc.Store(id = "stackSession", data=None),
+        dcc.Store(id = "rowGlobalData", data=None),
+        dcc.Store(id = "exportJobs", data=[]),
+        dcc.Interval(id = "exportPoll", interval=500, disabled=True),
+        html.Div(id = "exportStatus", className = "exportStatus"),
         html.H1("Toronto Census Visualizer", style={"textAlign": "center"}),
         html.H3(["By ",  html.A("Derek Song", href="https://www.linkedin.com/in/dereksong/"), ", using data from ",  html.A("Toronto Open Data", href="#About")], style={"textAlign": "center", "color": "white", "margin" : 0,}),
         html.Div(
@@ -352,7 +617,47 @@ app.layout = html.Div(
                 dcc.Download(id="downloadPDFMap")
             ]
         ),
+        dcc.RadioItems(
+            id="mapLevel",
+            className="mapClassification",
+            options=[{"label": label, "value": level} for level, label in mapLevels.items()],
+            value="neighbourhood",
+            inline=True
+        ),
+        dcc.RadioItems(
+            id="mapClassification",
+            className="mapClassification",
+            options=[{"label": label, "value": mode} for mode, label in classificationModes.items()],
+            value="none",
+            inline=True
+        ),
+        html.Div(
+            className = "mapClassification",
+            children=[
+                dcc.Input(id="compareRow", className="textbox", type="text", value="", placeholder="Compare with row (optional)", debounce = True),
+                dcc.RadioItems(
+                    id="comparisonMode",
+                    options=[{"label": label, "value": mode} for mode, (label, _) in comparisonModes.items()],
+                    value="ratio",
+                    inline=True
+                ),
+            ]
+        ),
         dcc.Graph(id="graph", style={"height": "1060px"}),
+        html.Div(
+            className = "correlatedRows",
+            children=[
+                html.H2("Most correlated rows"),
+                dcc.RadioItems(
+                    id="correlationMethod",
+                    className="mapClassification",
+                    options=[{"label": label, "value": method} for method, label in correlationMethods.items()],
+                    value="pearson",
+                    inline=True
+                ),
+                html.Div(id="correlatedRows", children=[]),
+            ]
+        ),
         dcc.Graph(id="graphBar", style={"height": "1060px"}),
         html.H1("Multi-variable stacked graphs", style={"textAlign": "center", "font-size": "3.5rem"}),
                 html.Div(
@@ -373,7 +678,7 @@ app.layout = html.Div(
                 dcc.Download(id="downloadPDFStack")
             ]
         ),
-        html.Div(id="buttonContainer", className="buttonContainer"),
+        html.Div(id="buttonContainer", className="buttonContainer", children=[]),
         dcc.Graph(id="graphBarStack", style={"height": "1060px"}),
         html.H1("About", id="About", style={"textAlign": "center", "font-size": "3.5rem"}),
         html.Div(
@@ -401,116 +706,246 @@ app.layout = html.Div(
     ]
 )
 
+def searchSuggestions (value):
+    '''
+    A function to turn a search value into the suggestion buttons shown under both search boxes, using the prebuilt index in search.py.
+    ----
+    Parameters:
+        value - a search value (str)
+    Returns:
+        suggestionHTML - a list of HTML buttons, one per matching row, best match first (Array of HTML buttons)
+        suggestionStyle - to trigger suggestion button and div visibility (Dictionary -> CSS styling)
+    '''
+    suggestions = searchRows(getStore(), value, 5)
+    suggestionHTML = html.Ul([html.Li([
+        html.Button (f"Row Number: {rowNumber} {label}", className="textbox", id={"type": "search-btn", "index": rowNumber}, n_clicks=0)
+        for rowNumber, label in suggestions
+    ])
+    ])
+    suggestionStyle = {"position": "relative", "display": "block" if suggestions else "none"}
+    return suggestionHTML, suggestionStyle
+
+def mapComparison (compareRow, comparisonMode):
+    '''Returns the comparison censusMapFigure takes for the "compare with row" box, or None while it is empty or not a row number (tuple of int, str)'''
+    try:
+        compareRow = int(compareRow)
+    except (TypeError, ValueError):
+        return None
+    if not 2 <= compareRow < len(getStore().rowLabels) + 2:
+        return None
+    return (compareRow, comparisonMode)
+
+def showRow (rowSelect, rowArrayBar, rowShown, classification="none", comparison=None, level="neighbourhood"):
+    '''
+    A function to get the map and single bar graph for a row, as full figures if nothing is drawn yet and as patches of the drawn figures otherwise.
+    ----
+    Parameters:
+        rowSelect - the row to show (int)
+        rowArrayBar - label for the variable (str)
+        rowShown - the row currently drawn, or None (int)
+        classification - how the map colours neighbourhoods (str, see mapColouring)
+        comparison - a second row to compare the map with (tuple, see censusMapFigure)
+        level - whether the map colours neighbourhoods or wards (str, see censusMapFigure)
+    Returns:
+        fig - the map (dict or dash.Patch)
+        fig_bar - the single bar graph (dict or dash.Patch)
+    '''
+    if rowShown is None and rowArrayBar == "Value" and classification == "none" and comparison is None and level == "neighbourhood":
+        #The page as most visitors first see it, which may have been written ahead of time
+        mapJSON = rowFigureJSON("map", rowSelect)
+        barJSON = rowFigureJSON("bar", rowSelect)
+        with span("showRow", "parse"):
+            fig = figureFromJSON(mapJSON)
+            fig_bar = figureFromJSON(barJSON)
+    elif rowShown is None:
+        mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+        fig = cachedFigure("map", censusFilePath, rowSelect, (tuple(mapZoomSettings), rowArrayBar, classification, comparison, level), lambda: censusMapFigure(neighbourhoodFilePath, censusFilePath, rowSelect, rowArrayBar, mapZoomSettings, classification=classification, comparison=comparison, level=level))
+        fig_bar = cachedFigure("bar", censusFilePath, rowSelect, (), lambda: censusBar(censusFilePath, rowSelect))
+    else:
+        with span("showRow", "map patch"):
+            fig = censusMapPatch(neighbourhoodFilePath, censusFilePath, rowSelect, rowArrayBar, [10, 43.710, -79.380, 2000, 1250], classification, comparison, level)
+        with span("showRow", "bar patch"):
+            fig_bar = censusBarPatch(censusFilePath, rowSelect)
+    return fig, fig_bar
+
 @app.callback(
     [Output("graph", "figure"),
     Output("graphBar", "figure"),
     Output("suggestion", "children"),
     Output("suggestion", "style"),
-    Output("downloadPDFBar", "data"),
-    Output("downloadPDFMap", "data"),
-    Output("figGlobalData", "data"),
-    Output("figbarGlobalData", "data")],
+    Output("rowGlobalData", "data")],
     [Input("search", "value"), 
     Input({"type": "search-btn", "index": dash.dependencies.ALL}, "n_clicks"),
-    Input("exportPDFBar", "n_clicks"),
-    Input("exportPDFMap", "n_clicks"),
-    Input("figGlobalData", "data"),
-    Input("figbarGlobalData", "data")]
+    Input("mapClassification", "value"),
+    Input("compareRow", "value"),
+    Input("comparisonMode", "value"),
+    Input("mapLevel", "value")],
+    [State("rowGlobalData", "data")]
 )
 
-def update_output(value, _, exportPDFBar, exportPDFMap, figGlobalData, figbarGlobalData):
+def update_output(value, _, classification, compareRow, comparisonMode, level, rowGlobalData):
     '''
     A function to generate single bars and map graphs, and to traverse for search suggestions. 
     ----
     Parameters:
         value - a search value (int or str)
         _ - an placeholder variable to execute the search button function (int)
-        exportPDFBar - an placeholder variable to execute the export PDF bar function (int)
-        exportPDFMap - an placeholder variable to execute the export PDF map function (int)
-        figGlobalData - client-side global data to cache the map (dcc.Store -> go.Figure())
-        figbarGlobalData - client-side global data to cache the single-bar graph (dcc.Store -> go.Figure())
+        classification - how the map colours neighbourhoods, a key of classify.classificationModes (dcc.RadioItems -> str)
+        compareRow - a second row to compare the map's row with, or "" (dcc.Input -> str)
+        comparisonMode - how the rows are compared, a key of compare.comparisonModes (dcc.RadioItems -> str)
+        level - whether the map colours neighbourhoods or wards, a key of spatial.mapLevels (dcc.RadioItems -> str)
+        rowGlobalData - client-side global data holding the row currently shown in the map and single-bar graph, or None before the first one is drawn (dcc.Store -> int)
         neighbourhoodFilePath - server-side global data for the path to the neighbourhood geojson file (str)
         censusFilePath - server-side global data for the path to the census csv file (str)
     Returns:
-        fig - a Plotly figure object for the map (go.Figure)
-        fig_bar - a Plotly figure object for the single bar graph (go.Figure)
+        fig - the map: a full Plotly figure dict (see censusMapFigure) the first time, then a dash.Patch of only the fields that change
+        fig_bar - the single bar graph: a full Plotly figure dict the first time, then a dash.Patch
         suggestionHTML - a list of HTML buttons for the search feature (Array of HTML buttons)
         suggestionStyle - to trigger suggestion button and div visibility (Dictionary -> CSS styling)
-        exportFileBar - file as a result of exporting the single bar graph (PDF)
-        exportFileMap - file as a result of exporting the single bar map (PDF)
-        figGlobal - updated cache for map graph (Dictionary -> go.Figure())
-        figbarGlobal - updated cache for single bar graph (Dictionary -> go.Figure())
+        rowGlobal - updated row currently shown (int)
     '''
     global neighbourhoodFilePath, censusFilePath
-    suggestionHTML = html.Ul([])
+    #No component when there are no suggestions: a component in the response makes Plotly's fast orjson path fall back to walking every figure field in Python
+    suggestionHTML = []
     suggestionStyle = {"position": "relative", "display": "none"}
-    figGlobal = go.Figure(figGlobalData)
-    figbarGlobal = go.Figure(figbarGlobalData)
-    fig = figGlobal
-    fig_bar = figbarGlobal
-    exportFileBar = None
-    exportFileMap = None
+    rowGlobal = rowGlobalData
+    fig = dash.no_update
+    fig_bar = dash.no_update
+    comparison = mapComparison(compareRow, comparisonMode)
     ctx = dash.callback_context
-    if ctx.triggered and "search-btn" in ctx.triggered[0]["prop_id"]:
+    if ctx.triggered and ctx.triggered[0]["prop_id"] in ("mapClassification.value", "compareRow.value", "comparisonMode.value"):
+        #Only the map's colouring changes
+        if rowGlobalData is not None:
+            with span("update_output", "recolour"):
+                fig = censusMapPatch(neighbourhoodFilePath, censusFilePath, rowGlobalData, "Value", [10, 43.710, -79.380, 2000, 1250], classification, comparison, level)
+    elif ctx.triggered and ctx.triggered[0]["prop_id"] == "mapLevel.value":
+        #The map's geometry changes, so it is sent whole
+        if rowGlobalData is not None:
+            with span("update_output", "change level"):
+                fig, _ = showRow(rowGlobalData, "Value", None, classification, comparison, level)
+    elif ctx.triggered and "search-btn" in ctx.triggered[0]["prop_id"]:
         triggered = ctx.triggered
         indexStr = triggered[0]["prop_id"].split('.')[0]
         indexDic= json.loads(indexStr.replace("'", '"'))
         if "index" in indexDic:
             index = int(indexDic["index"]) 
-        fig = censusMap(neighbourhoodFilePath, censusFilePath, index, "Values", [10, 43.710, -79.380, 2000, 1250])
-        figGlobal = fig
-        fig_bar = censusBar(censusFilePath, index)
-        figbarGlobal = fig_bar
-    elif ctx.triggered and "exportPDFBar" in ctx.triggered[0]["prop_id"]:
-        figbarGlobal.write_image("figBar.pdf", format="pdf", engine="kaleido", width = 3000)
-        exportFileBar = dcc.send_file("figBar.pdf")
-    elif ctx.triggered and "exportPDFMap" in ctx.triggered[0]["prop_id"]:
-        figGlobal.write_image("figMap.pdf", format="pdf", engine="kaleido", width = 1300, height = 900)
-        exportFileMap = dcc.send_file("figMap.pdf")
+        with span("update_output", "show row"):
+            fig, fig_bar = showRow(index, "Values", rowGlobalData, classification, comparison, level)
+        rowGlobal = index
     else:
         try:
-            value =  int(value) 
-            fig = censusMap(neighbourhoodFilePath, censusFilePath, value, "Value", [10, 43.710, -79.380, 2000, 1250])
-            figGlobal = fig
-            fig_bar = censusBar(censusFilePath, value)
-            figbarGlobal = fig_bar
+            rowSelect = int(value)
         except ValueError:
-            censusData = pandas.read_csv(censusFilePath)
-            suggestion = censusData[censusData["Neighbourhood Name"].str.contains(value, case=False, regex=False, na=False)]
-            indices = suggestion.index[:5] + 2
-            suggestionsFive = suggestion.head(5)
-            suggestionList = suggestionsFive["Neighbourhood Name"].tolist()
-            combinedList = [f"Row number: {ind} - {string}" for ind, string in zip(indices, suggestionList)]
-            suggestionHTML = html.Ul([html.Li([
-                html.Button (f"Row Number: {str(indices[i])} {suggestionList[i]}", className="textbox", id={"type": "search-btn", "index": int(indices[i])}, n_clicks=0)
-                for i, p in enumerate(combinedList)
-            ])
-            ])
-            
-            if suggestionList is not None: 
-                suggestionStyle = {"position": "relative", "display": "block"}
-                
+            with span("update_output", "suggestions"):
+                suggestionHTML, suggestionStyle = searchSuggestions(value)
+        else:
+            #A number that is not a row leaves the graphs as they are
+            if isCensusRow(rowSelect):
+                with span("update_output", "show row"):
+                    fig, fig_bar = showRow(rowSelect, "Value", rowGlobalData, classification, comparison, level)
+                rowGlobal = rowSelect
         
-    return fig, fig_bar, suggestionHTML, suggestionStyle, exportFileBar, exportFileMap, figGlobal.to_dict(), figbarGlobal.to_dict()
+    return fig, fig_bar, suggestionHTML, suggestionStyle, rowGlobal
+
+@app.callback(
+    Output("correlatedRows", "children"),
+    Input("rowGlobalData", "data"),
+    Input("correlationMethod", "value"),
+)
+
+def update_correlated(rowGlobalData, method):
+    '''
+    A function to list the rows that vary across neighbourhoods most like the row shown, from the precomputed index in compare.py. Each is a button that compares the map with it.
+    ----
+    Parameters:
+        rowGlobalData - the row shown in the map and single-bar graph (dcc.Store -> int)
+        method - "pearson" or "spearman" (dcc.RadioItems -> str)
+    Returns:
+        correlatedHTML - a list of HTML buttons, strongest correlation first (Array of HTML buttons)
+    '''
+    if rowGlobalData is None:
+        return []
+    correlated = getCorrelationIndex(getStore()).topCorrelated(int(rowGlobalData) - 2, 10, method)
+    return html.Ul([html.Li([
+        html.Button(f"Row Number: {rowNumber} {label} (r = {correlation:.2f})", className="textbox", id={"type": "compare-btn", "index": rowNumber}, n_clicks=0)
+        for rowNumber, label, correlation in correlated
+    ])
+    ])
+
+@app.callback(
+    Output("compareRow", "value"),
+    Input({"type": "compare-btn", "index": dash.dependencies.ALL}, "n_clicks"),
+    prevent_initial_call=True
+)
+
+def compare_with(_):
+    '''Fills the "compare with row" box with a correlated row when its button is pressed'''
+    triggered = dash.callback_context.triggered
+    #A new list of buttons also triggers this callback, with no clicks yet
+    if not triggered or not triggered[0]["value"]:
+        return dash.no_update
+    return str(json.loads(triggered[0]["prop_id"].split(".")[0])["index"])
+
+def removeButton (key, rowIndex):
+    '''Returns the button that removes one stacked row; its id holds the entry's key in the session, which never changes, rather than its position'''
+    return html.Button(f"{rowIndex + 2} - {getStore().rowLabels[rowIndex]}", id={"type": "remove-btn", "index": key}, className= "textbox addArray ", n_clicks=0)
+
+def changeStack (sessionId, addRow=None, removeKey=None):
+    '''
+    A function to add or remove one row of a session's stacked bar graph. The session (see sessions.py) holds the stacked rows and whether the client has drawn the graph; once it has, the client is sent a dash.Patch that adds or deletes one trace and one remove button, so responses stay the same size however many rows are stacked.
+    ----
+    Parameters:
+        sessionId - the session whose graph changes (str)
+        addRow - a row to add, as a row index, i.e. the UI row number - 2 (int)
+        removeKey - the key of the entry to remove, from its remove button (int)
+    Returns:
+        fig_bar_stack - the full figure dict if the client has none yet, otherwise a dash.Patch (dict or dash.Patch)
+        buttons - every remove button if the client has none yet, otherwise a dash.Patch (list or dash.Patch)
+    '''
+    with sessionStore.edit(sessionId) as state:
+        #An empty state is a new session, or one that expired or was kept by another server; either way the client is sent everything again
+        drawn = state.get("drawn", False)
+        entries = state.setdefault("entries", [])
+        fig_bar_stack = dash.Patch()
+        buttons = dash.Patch()
+        if addRow is not None:
+            key = state.get("nextKey", 0)
+            state["nextKey"] = key + 1
+            entries.append([key, addRow])
+            fig_bar_stack["data"].append(compactTrace(censusBarStackTrace(censusFilePath, addRow)))
+            buttons.append(removeButton(key, addRow))
+        else:
+            positions = [position for position, (key, _) in enumerate(entries) if key == removeKey]
+            if not positions:
+                return dash.no_update, dash.no_update
+            entries.pop(positions[0])
+            del fig_bar_stack["data"][positions[0]]
+            del buttons[positions[0]]
+        if not drawn:
+            state["drawn"] = True
+            fig_bar_stack = compactFigure(censusBarStack(censusFilePath, [rowIndex for _, rowIndex in entries]))
+            buttons = [removeButton(key, rowIndex) for key, rowIndex in entries]
+    return fig_bar_stack, buttons
+
+def stackRows (sessionId):
+    '''Returns the rows stacked in a session, as row indexes, or [] for an unknown session'''
+    state = sessionStore.get(sessionId) or {}
+    return [rowIndex for _, rowIndex in state.get("entries", [])]
 
 @app.callback(
     Output("graphBarStack", "figure"),
     Output("suggestionStack", "children"),
     Output("suggestionStack", "style"),
     Output('buttonContainer', 'children'),
-    Output("downloadPDFStack", "data"),
-    Output("input_array", "data"),
-    Output("figbarstackGlobalData", "data"),
+    Output("stackSession", "data"),
     Input("multiVarConfirm", "n_clicks"),
     Input({"type": "remove-btn", "index": dash.dependencies.ALL}, 'n_clicks'),
     Input({"type": "search-btn", "index": dash.dependencies.ALL}, 'n_clicks'),
-    Input("exportPDFStack", "n_clicks"),
-    Input("input_array", "data"),
-    Input("figbarstackGlobalData", "data"),
+    State("stackSession", "data"),
     State("multiVarInput", "value")          
 )
 
-def update_array(_, nc1, nc2,exportFileStack, input_array, figbarstackGlobalData, input_value):
+def update_array(_, nc1, nc2, stackSession, input_value):
     '''
     A function to generate stacked bars, and to traverse for search suggestions. 
     ----
@@ -518,82 +953,192 @@ def update_array(_, nc1, nc2,exportFileStack, input_array, figbarstackGlobalData
         _ - an placeholder variable to execute the stacked bar function given an row input (int)
         nc1 - an placeholder variable to remove a row from the graph given an remove button input (int)
         nc1 - an placeholder variable to execute the stacked bar function given an search button input (int)
-        exportFileStack - a variable to execute the export PDF stacked bar function (int)
-        input_array - client-side global data to cache and store the inputted arrays (dcc.Store -> Array)
-        figbarstackGlobalData - client-side global data to cache the stacked bar grpah (dcc.Store -> go.Figure())
+        stackSession - client-side id of the server-side session holding the stacked rows, or None before the first row is added (dcc.Store -> str)
         input_value - the value inputted to add a trace to the stacked bar graph (dcc.State -> int)
     Returns:
-        fig_bar_stack - a Plotly figure object for the stacked bar graph (go.Figure)
+        fig_bar_stack - the stacked bar graph: a full figure dict the first time, then a dash.Patch adding or removing one trace, or dash.no_update if the rows did not change (see changeStack)
         suggestionHTML - a list of HTML buttons for the search feature (Array of HTML buttons)
         suggestionStyle - to trigger suggestion button and div visibility (Dictionary -> CSS styling)
-        buttons - the remove buttons (Array of HTML buttons)
-        exportFileStack - file as a result of exporting the stacked bar map (PDF)
-        input_array - updated cache for row inputs (Dictionary -> Array)
-        figbarstackGlobal - updated cache for stacked bar graph (Dictionary -> go.Figure())
+        buttons - the remove buttons: all of them the first time, then a dash.Patch (Array of HTML buttons or dash.Patch)
+        stackSession - the session id (str)
     '''
     global censusFilePath
-    suggestionHTML = html.Ul([])
+    suggestionHTML = []
     suggestionStyle = {"position": "relative", "display": "none"}
     ctx = dash.callback_context
-    figbarstackGlobal = go.Figure(figbarstackGlobalData)
-    fig_bar_stack = figbarstackGlobal
-    censusData = pandas.read_csv(censusFilePath)
-    exportFileStack = None
+    fig_bar_stack = dash.no_update
+    buttons = dash.no_update
+    if stackSession is None:
+        stackSession = sessionStore.newSessionId()
     if ctx.triggered and "remove-btn" in ctx.triggered[0]["prop_id"]:
         triggered = ctx.triggered
         indexStr = triggered[0]["prop_id"].split('.')[0]
         indexDic= json.loads(indexStr.replace("'", '"'))
-        if "index" in indexDic:
-            index = indexDic["index"]
-            
-            # Ensure index is valid and within bounds
-            if index < len(input_array):
-                input_array.pop(index)
-        fig_bar_stack = censusBarStack(censusFilePath, input_array)
-        figbarstackGlobal = fig_bar_stack
+        #Buttons added by a patch also trigger this callback, with no clicks yet
+        if "index" in indexDic and triggered[0]["value"]:
+            with span("update_array", "remove row"):
+                fig_bar_stack, buttons = changeStack(stackSession, removeKey=indexDic["index"])
     
     elif ctx.triggered and "search-btn" in ctx.triggered[0]["prop_id"]:
         triggered = ctx.triggered
         indexStr = triggered[0]["prop_id"].split('.')[0]
         indexDic= json.loads(indexStr.replace("'", '"'))
         if "index" in indexDic:
-            index = indexDic["index"]
-            input_array.append(index - 2)
-        fig_bar_stack = censusBarStack(censusFilePath, input_array)
-        figbarstackGlobal = fig_bar_stack
-
-    elif ctx.triggered and "exportPDFStack" in ctx.triggered[0]["prop_id"]:
-        figbarstackGlobal.write_image("figStack.pdf", format="pdf", engine="kaleido", width = 3000)
-        exportFileStack = dcc.send_file("figStack.pdf")
+            with span("update_array", "add row"):
+                fig_bar_stack, buttons = changeStack(stackSession, addRow=indexDic["index"] - 2)
 
     elif input_value.isnumeric():
         if ctx.triggered and int(input_value) <= 2604:
-            input_array.append(int(input_value) - 2)  # Add input value to the array
-            fig_bar_stack = censusBarStack(censusFilePath, input_array)
-            figbarstackGlobal = fig_bar_stack
+            with span("update_array", "add row"):
+                fig_bar_stack, buttons = changeStack(stackSession, addRow=int(input_value) - 2)
         elif ctx.triggered and int(input_value) > 2604 or ctx.triggered and int(input_value) < 2:
             raise ValueError ("Invaild input")
     
     else:
-        suggestion = censusData[censusData["Neighbourhood Name"].str.contains(input_value, case=False, regex=False, na=False)]
-        indices = suggestion.index[:5]
-        suggestionsFive = suggestion.head(5)
-        suggestionList = suggestionsFive["Neighbourhood Name"].tolist()
-        combinedList = [f"Row number: {ind} - {string}" for ind, string in zip(indices, suggestionList)]
-        suggestionHTML = html.Ul([html.Li([
-            html.Button (f"Row Number: {str(indices[i] + 2)} {suggestionList[i]}",className= "textbox", id={"type": "search-btn", "index": int(indices[i] + 2)}, n_clicks=0)
-            for i, p in enumerate(combinedList)
-        ])
-        ])
-        
-        if suggestionList is not None: 
-             suggestionStyle = {"position": "relative", "display": "block"}
-        
-    buttons = [html.Button(f"{val + 2} - {censusData.iloc[val]["Neighbourhood Name"]}", id={"type": "remove-btn", "index": i}, className= "textbox addArray ", n_clicks=0) for i, val in enumerate(input_array)]
+        with span("update_array", "suggestions"):
+            suggestionHTML, suggestionStyle = searchSuggestions(input_value)
 
-    return fig_bar_stack, suggestionHTML, suggestionStyle, buttons, exportFileStack, input_array, figbarstackGlobal.to_dict()
+    return fig_bar_stack, suggestionHTML, suggestionStyle, buttons, stackSession
+
+#PDF exports, rendered by the warm kaleido pool in export.py while the browser polls for the result
+exportSettings = {
+    "bar": {"download": "downloadPDFBar", "fileName": "figBar.pdf", "width": 3000, "height": None},
+    "map": {"download": "downloadPDFMap", "fileName": "figMap.pdf", "width": 1300, "height": 900},
+    "stack": {"download": "downloadPDFStack", "fileName": "figStack.pdf", "width": 3000, "height": None},
+}
+
+def submitExport (target, rows, classification="none", comparison=None, level="neighbourhood"):
+    '''
+    A function to queue a PDF export of one of the graphs. The figure is rebuilt server-side from the rows instead of being round-tripped through the browser.
+    ----
+    Parameters:
+        target - which graph to export: "bar", "map" or "stack" (str)
+        rows - the row shown (int) for "bar" and "map", or the stacked rows as row indexes (see stackRows) for "stack"
+        classification - how the map colours neighbourhoods, for "map" (str, see mapColouring)
+        comparison - a second row to compare the map with, for "map" (tuple or list, see censusMapFigure)
+        level - whether the map colours neighbourhoods or wards, for "map" (str, see censusMapFigure)
+    Returns:
+        job - what the client needs to poll for the export (dict)
+    '''
+    settings = exportSettings[target]
+    if target == "bar":
+        figureJSON = cachedFigureJSON("bar", censusFilePath, rows, (), lambda: censusBar(censusFilePath, rows))
+    elif target == "map":
+        mapZoomSettings = [10, 43.710, -79.380, 2000, 1250]
+        #Jobs round-trip through the browser as JSON, which turns the tuple into a list
+        comparison = None if comparison is None else tuple(comparison)
+        figureJSON = cachedFigureJSON("mapExport", censusFilePath, rows, (tuple(mapZoomSettings), "Value", classification, comparison, level), lambda: censusMapFigure(neighbourhoodFilePath, censusFilePath, rows, "Value", mapZoomSettings, exportMode=True, classification=classification, comparison=comparison, level=level))
+    else:
+        figureJSON = figureToJSON(censusBarStack(censusFilePath, rows))
+    jobId = exportPool.submit(figureJSON, "pdf", settings["width"], settings["height"])
+    return {"jobId": jobId, "target": target, "rows": rows, "classification": classification, "comparison": comparison, "level": level}
+
+@app.callback(
+    Output("exportJobs", "data"),
+    Output("exportPoll", "disabled"),
+    Output("exportStatus", "children"),
+    Input("exportPDFBar", "n_clicks"),
+    Input("exportPDFMap", "n_clicks"),
+    Input("exportPDFStack", "n_clicks"),
+    State("exportJobs", "data"),
+    State("rowGlobalData", "data"),
+    State("stackSession", "data"),
+    State("mapClassification", "value"),
+    State("compareRow", "value"),
+    State("comparisonMode", "value"),
+    State("mapLevel", "value"),
+    prevent_initial_call=True
+)
+
+def start_export(exportPDFBar, exportPDFMap, exportPDFStack, exportJobs, rowGlobalData, stackSession, classification, compareRow, comparisonMode, level):
+    '''
+    A function to queue a PDF export when one of the export buttons is pressed, and start polling for it.
+    ----
+    Parameters:
+        exportPDFBar, exportPDFMap, exportPDFStack - placeholder variables to execute the export of each graph (int)
+        exportJobs - client-side list of exports being waited for (dcc.Store -> Array)
+        rowGlobalData - the row shown in the map and single-bar graph (dcc.Store -> int)
+        stackSession - the id of the session holding the rows in the stacked bar graph (dcc.Store -> str)
+        classification - how the map colours neighbourhoods (dcc.RadioItems -> str)
+        compareRow, comparisonMode - the row the map is compared with and how (see update_output)
+        level - whether the map colours neighbourhoods or wards (dcc.RadioItems -> str)
+    Returns:
+        exportJobs - updated list of exports being waited for (Array)
+        pollDisabled - False to start polling (bool)
+        exportStatus - progress text (str)
+    '''
+    ctx = dash.callback_context
+    target = {"exportPDFBar": "bar", "exportPDFMap": "map", "exportPDFStack": "stack"}[ctx.triggered[0]["prop_id"].split(".")[0]]
+    rows = stackRows(stackSession) if target == "stack" else rowGlobalData
+    if rows is None or rows == []:
+        return dash.no_update, dash.no_update, dash.no_update
+    exportJobs = exportJobs + [submitExport(target, rows, classification, mapComparison(compareRow, comparisonMode), level)]
+    return exportJobs, False, f"Exporting {exportSettings[target]['fileName']}..."
+
+@app.callback(
+    Output("downloadPDFBar", "data"),
+    Output("downloadPDFMap", "data"),
+    Output("downloadPDFStack", "data"),
+    Output("exportJobs", "data", allow_duplicate=True),
+    Output("exportPoll", "disabled", allow_duplicate=True),
+    Output("exportStatus", "children", allow_duplicate=True),
+    Input("exportPoll", "n_intervals"),
+    State("exportJobs", "data"),
+    prevent_initial_call=True
+)
+
+def poll_export(_, exportJobs):
+    '''
+    A function to check on queued PDF exports and download the ones that are done.
+    ----
+    Parameters:
+        _ - an placeholder variable to execute the poll (int)
+        exportJobs - client-side list of exports being waited for (dcc.Store -> Array)
+    Returns:
+        exportFileBar, exportFileMap, exportFileStack - finished files (dcc.send_bytes), or None
+        exportJobs - the exports still being waited for (Array)
+        pollDisabled - True once nothing is left to wait for (bool)
+        exportStatus - progress text (str)
+    '''
+    downloads = {settings["download"]: None for settings in exportSettings.values()}
+    pending = []
+    messages = []
+    for job in exportJobs:
+        settings = exportSettings[job["target"]]
+        status = exportPool.status(job["jobId"])
+        if status == "unknown":
+            #The job was queued by another gunicorn worker that hasn't finished it yet, or was lost; queue it here too (identical exports are deduplicated)
+            job = submitExport(job["target"], job["rows"], job.get("classification", "none"), job.get("comparison"), job.get("level", "neighbourhood"))
+            status = exportPool.status(job["jobId"])
+        if status == "done" and downloads[settings["download"]] is None:
+            downloads[settings["download"]] = dcc.send_bytes(exportPool.result(job["jobId"]), settings["fileName"])
+        elif status == "error":
+            messages.append(f"Could not export {settings['fileName']}")
+        else:
+            pending.append(job)
+            messages.append(f"Exporting {settings['fileName']}...")
+    return downloads["downloadPDFBar"], downloads["downloadPDFMap"], downloads["downloadPDFStack"], pending, not pending, " ".join(messages)
 
 server = app.server
+#Registered before compression, so the bytes counted are the bytes sent (see metrics.py)
+instrumentServer(server, app)
+compressResponses(server)
+metrics.addCollector(cacheCollector("figure", figureCache.stats))
+metrics.addCollector(cacheCollector("compressed response", compressionStats))
+metrics.addCollector(cacheCollector("export", exportPool.results.stats))
+registerSnapshotRoutes(server, rowFigureJSON, lambda: getStore().mtimes)
+registerDataRoutes(server, getStore)
+
+#What the first page load needs (the store, the search index, and the map and bar graph of the default row 37), built ahead of the first request as STARTUP_MODE says (see startup.py)
+warmUpSteps = [
+    ("data", getStore),
+    ("search index", lambda: getSearchIndex(getStore())),
+    ("classification", lambda: getClassification(getStore())),
+    ("correlation index", lambda: getCorrelationIndex(getStore())),
+    ("spatial index", lambda: getSpatialIndex(getStore())),
+    ("first render", lambda: showRow(37, "Value", None)),
+]
+startWarmUp(warmUpSteps)
 
 if __name__ == '__main__':
     app.run_server(debug=True, port=8051)  
\ No newline at end of file
@@ -0,0 +1,269 @@
+'''
+Timing spans, payload and cache counters, and sampled request profiling, served as Prometheus text on /metrics.
+
+    with span("censusMapFigure", "colouring"):
+        ...
+
+records how long the block takes under census_stage_seconds{function="censusMapFigure",stage="colouring"}. instrumentServer() adds the time and bytes of every response (Dash callbacks by callback name, other routes by their rule) and the /metrics route. Cache counters are read when /metrics is scraped, from the collectors added with metrics.addCollector().
+
+Each gunicorn worker keeps its own numbers, so a scrape reports the worker that answered it; the worker label tells them apart.
+
+Profiling is off unless PROFILE_SAMPLE_RATE is set, e.g. 0.01 to profile one request in a hundred. Each sampled request writes one file to PROFILE_FOLDER: a .prof from cProfile (open with "python -m pstats" or snakeviz), or an .html from pyinstrument with PROFILER=pyinstrument if it is installed.
+'''
+import os
+import time
+import random
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+metricsRoute = os.environ.get("METRICS_ROUTE", "/metrics")
+profileSampleRate = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+profileFolder = os.environ.get("PROFILE_FOLDER", "profiles")
+profilerName = os.environ.get("PROFILER", "cProfile")
+#Upper bounds of the histogram buckets: seconds from a millisecond to ten seconds, and bytes from 1KB to 4MB
+secondsBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+bytesBuckets = tuple(1024 * 4 ** power for power in range(7))
+
+def _labelText (labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class MetricsRegistry:
+    '''
+    Counters and histograms kept in memory, with thread-safe updates, rendered in the Prometheus text format. Metrics are created on first use; every sample of one metric should use the same label names.
+    ----
+    Parameters:
+        constantLabels - called at each render; returns labels added to every sample, e.g. {"worker": 1234} (function -> dict)
+    '''
+    def __init__ (self, constantLabels=dict):
+        self.constantLabels = constantLabels
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe (self, name, helpText):
+        '''Sets the # HELP line of a metric'''
+        self._help[name] = helpText
+
+    def increment (self, name, labels=None, amount=1):
+        '''
+        A function to add to a counter.
+        ----
+        Parameters:
+            name - the metric, ending in _total (str)
+            labels - label names and values (dict)
+            amount - how much to add (int or float)
+        '''
+        key = tuple((labels or {}).items())
+        with self._lock:
+            values = self._counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def observe (self, name, value, labels=None, buckets=secondsBuckets):
+        '''
+        A function to record one value in a histogram.
+        ----
+        Parameters:
+            name - the metric, e.g. census_stage_seconds (str)
+            value - the value, e.g. seconds or bytes (float)
+            labels - label names and values (dict)
+            buckets - the bucket upper bounds, fixed by the first observation of the metric (tuple)
+        '''
+        key = tuple((labels or {}).items())
+        with self._lock:
+            buckets = self._buckets.setdefault(name, buckets)
+            series = self._histograms.setdefault(name, {}).get(key)
+            if series is None:
+                #One count per bucket, then the +Inf bucket, then the sum
+                series = self._histograms[name][key] = [0] * (len(buckets) + 1) + [0.0]
+            series[bisect_left(buckets, value)] += 1
+            series[-1] += value
+
+    def addCollector (self, collect):
+        '''
+        A function to add numbers that are read when the metrics are rendered rather than recorded as they happen, e.g. a cache's own counters.
+        ----
+        Parameters:
+            collect - called with no arguments; returns (name, "counter" or "gauge", labels, value) for each sample (function -> list of tuples)
+        '''
+        self._collectors.append(collect)
+
+    def render (self):
+        '''
+        A function to write every metric in the Prometheus text exposition format.
+        ----
+        Returns:
+            text - the metrics (str)
+        '''
+        lines = []
+        constantLabels = self.constantLabels()
+        def header (name, metricType):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {metricType}")
+
+        with self._lock:
+            counters = {name: dict(values) for name, values in self._counters.items()}
+            histograms = {name: {key: list(series) for key, series in values.items()} for name, values in self._histograms.items()}
+        for name, values in sorted(counters.items()):
+            header(name, "counter")
+            for key, value in values.items():
+                lines.append(f"{name}{_labelText({**constantLabels, **dict(key)})} {value}")
+        for name, values in sorted(histograms.items()):
+            header(name, "histogram")
+            buckets = self._buckets[name]
+            for key, series in values.items():
+                labels = {**constantLabels, **dict(key)}
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], series[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labelText({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"{name}_sum{_labelText(labels)} {series[-1]}")
+                lines.append(f"{name}_count{_labelText(labels)} {cumulative}")
+
+        collected = {}
+        for collect in self._collectors:
+            for name, metricType, labels, value in collect():
+                collected.setdefault((name, metricType), []).append((labels, value))
+        for (name, metricType), samples in sorted(collected.items()):
+            header(name, metricType)
+            for labels, value in samples:
+                lines.append(f"{name}{_labelText({**constantLabels, **labels})} {value}")
+        return "\n".join(lines) + "\n"
+
+#The registry shared by every module; /metrics renders it. The worker is read at each render since gunicorn imports this in the master and forks
+metrics = MetricsRegistry(lambda: {"worker": os.getpid()})
+metrics.describe("census_stage_seconds", "Time spent in each stage of building a figure or answering a callback")
+metrics.describe("census_request_seconds", "Time to answer a request, by Dash callback or route")
+metrics.describe("census_response_bytes", "Response body size as sent, by Dash callback or route and content encoding")
+metrics.describe("census_figure_bytes", "Size of each figure serialized for the figure cache, by chart")
+metrics.describe("census_export_seconds", "Time from queueing an export until its file is written or it fails, by format")
+metrics.describe("census_snapshot_requests_total", "First draws answered from a static snapshot (hit) or rendered live (miss), by chart")
+
+@contextmanager
+def span (function, stage):
+    '''Records how long the body of a with block takes in census_stage_seconds, under function and stage'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe("census_stage_seconds", time.perf_counter() - start, {"function": function, "stage": stage})
+
+def cacheCollector (name, stats):
+    '''
+    A function to report a cache's counters, read from it at each scrape: census_cache_requests_total by result, and census_cache_hit_ratio.
+    ----
+    Parameters:
+        name - the cache label, e.g. "figure" (str)
+        stats - called with no arguments; returns hits and misses, and optionally diskHits, evictions, entries and bytes (function -> dict)
+    Returns:
+        collect - a collector for metrics.addCollector (function)
+    '''
+    def collect ():
+        counts = stats()
+        hits = counts["hits"] + counts.get("diskHits", 0)
+        samples = [("census_cache_requests_total", "counter", {"cache": name, "result": "hit"}, counts["hits"])]
+        if "diskHits" in counts:
+            samples.append(("census_cache_requests_total", "counter", {"cache": name, "result": "disk hit"}, counts["diskHits"]))
+        samples.append(("census_cache_requests_total", "counter", {"cache": name, "result": "miss"}, counts["misses"]))
+        samples.append(("census_cache_hit_ratio", "gauge", {"cache": name}, hits / (hits + counts["misses"]) if hits + counts["misses"] else 0))
+        for field in ("evictions", "entries", "bytes"):
+            if field in counts:
+                metricType = "counter" if field == "evictions" else "gauge"
+                samples.append((f"census_cache_{field}" + ("_total" if metricType == "counter" else ""), metricType, {"cache": name}, counts[field]))
+        return samples
+    return collect
+
+def _startProfiler ():
+    if profilerName == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            pass
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        #Another request's profiler is running, and Python 3.12 and later allow only one at a time
+        return None
+    return profiler
+
+def _writeProfile (profiler, route, seconds):
+    #Stopped before anything else, so a failed write never leaves it running
+    if hasattr(profiler, "output_html"):
+        profiler.stop()
+    else:
+        profiler.disable()
+    os.makedirs(profileFolder, exist_ok=True)
+    name = "".join(character if character.isalnum() else "-" for character in route).strip("-") or "root"
+    path = os.path.join(profileFolder, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}-{seconds * 1000:.0f}ms")
+    if hasattr(profiler, "output_html"):
+        with open(f"{path}.html", "w") as profileFile:
+            profileFile.write(profiler.output_html())
+    else:
+        profiler.dump_stats(f"{path}.prof")
+
+def instrumentServer (server, app=None, route=metricsRoute):
+    '''
+    A function to time and measure every response of the Flask server, profile sampled requests (see PROFILE_SAMPLE_RATE), and serve the metrics. Call it before compressResponses() so the bytes counted are the bytes sent.
+    ----
+    Parameters:
+        server - the Flask app, i.e. app.server (flask.Flask)
+        app - the Dash app, to label callback requests by callback name rather than all as /_dash-update-component (dash.Dash)
+        route - where the metrics are served, or "" not to serve them (str)
+    '''
+    from flask import request, g, Response
+
+    callbackNames = {}
+    def requestName ():
+        if request.path.endswith("/_dash-update-component") and app is not None:
+            #Dash's callback keys are its outputs, which dash-renderer sends with each request
+            if not callbackNames:
+                for key, spec in app.callback_map.items():
+                    callback = spec["callback"]
+                    callbackNames[key] = getattr(callback, "__wrapped__", callback).__name__
+            body = request.get_json(silent=True) or {}
+            return callbackNames.get(body.get("output"), "unknown callback")
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    @server.before_request
+    def startRequest ():
+        g.metricsStart = time.perf_counter()
+        g.profiler = _startProfiler() if profileSampleRate and random.random() < profileSampleRate else None
+        g.profileStart = g.metricsStart
+
+    @server.after_request
+    def measureResponse (response):
+        start = g.pop("metricsStart", None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        name = requestName()
+        metrics.observe("census_request_seconds", seconds, {"route": name, "status": response.status_code})
+        if not (response.direct_passthrough or response.is_streamed):
+            size = response.content_length if response.content_length is not None else len(response.get_data())
+            metrics.observe("census_response_bytes", size, {"route": name, "encoding": response.headers.get("Content-Encoding", "identity")}, bytesBuckets)
+        return response
+
+    @server.teardown_request
+    def stopProfiler (error):
+        #A teardown runs even when the view raised, unlike after_request, so a sampled profiler is never left running on the thread
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            _writeProfile(profiler, requestName(), time.perf_counter() - g.pop("profileStart"))
+
+    if route:
+        @server.route(route)
+        def serveMetrics ():
+            return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8", headers={"Cache-Control": "no-store"})
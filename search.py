@@ -0,0 +1,188 @@
+import re
+import numpy
+import bisect
+import threading
+from collections import defaultdict
+
+_tokenPattern = re.compile(r"[a-z0-9]+")
+
+def normalize (text):
+    '''Lowercases text and splits it into alphanumeric tokens, e.g. "  Total - Age (25%)" -> ["total", "age", "25"]'''
+    return _tokenPattern.findall(text.lower())
+
+def _editDistance (first, second, limit):
+    '''Optimal string alignment distance (Levenshtein plus adjacent transpositions), or limit + 1 once it is known to exceed limit'''
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previousRow = None
+    row = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        previousRow, lastRow = row, previousRow
+        row = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            row[j] = min(previousRow[j] + 1, row[j - 1] + 1, previousRow[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], lastRow[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+def _trigrams (token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchIndex:
+    '''
+    A prebuilt index over the census row labels ("Neighbourhood Name" column) for ranked, typo-tolerant search. Each query token is matched against the label tokens exactly, as a prefix and as an infix (found through a trigram index), then, only if none of those match, by trigram similarity; matches are weighted by how rare the token is. Rows matching every query token and rows containing the whole query as a phrase rank first; ties go to shorter labels, then to lower row numbers.
+    ----
+    Parameters:
+        rowLabels - the label of every census row, in row order (sequence of str)
+    '''
+    exactWeight = 3.0
+    prefixWeight = 2.0
+    infixWeight = 1.5
+    fuzzyWeight = 1.0
+    fuzzyThreshold = 0.4
+    allTokensBonus = 10.0
+    phraseBonus = 5.0
+
+    def __init__ (self, rowLabels):
+        self.rowLabels = [str(label) for label in rowLabels]
+        self.normalizedLabels = [" ".join(normalize(label)) for label in self.rowLabels]
+        self.labelLengths = numpy.array([len(label) for label in self.normalizedLabels])
+        rowCount = len(self.rowLabels)
+
+        postings = defaultdict(set)
+        for rowIndex, label in enumerate(self.normalizedLabels):
+            for token in label.split():
+                postings[token].add(rowIndex)
+        self.postings = {token: numpy.fromiter(sorted(rows), dtype=numpy.intp) for token, rows in postings.items()}
+        self.vocabulary = sorted(self.postings)
+        self.idf = {token: numpy.log((rowCount + 1) / (len(rows) + 1)) + 1 for token, rows in self.postings.items()}
+
+        self.trigramIndex = defaultdict(list)
+        self.tokenTrigrams = {}
+        for token in self.vocabulary:
+            trigrams = _trigrams(token)
+            self.tokenTrigrams[token] = trigrams
+            for trigram in trigrams:
+                self.trigramIndex[trigram].append(token)
+
+    def _prefixTokens (self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + "\uffff")
+        return self.vocabulary[start:end]
+
+    def _infixTokens (self, queryToken):
+        if len(queryToken) < 3:
+            return []
+        candidates = None
+        for i in range(len(queryToken) - 2):
+            tokens = self.trigramIndex.get(queryToken[i:i + 3], ())
+            candidates = set(tokens) if candidates is None else candidates.intersection(tokens)
+            if not candidates:
+                return []
+        return [token for token in candidates if queryToken in token and not token.startswith(queryToken)]
+
+    def _fuzzyTokens (self, queryToken):
+        queryTrigrams = _trigrams(queryToken)
+        shared = defaultdict(int)
+        for trigram in queryTrigrams:
+            for token in self.trigramIndex.get(trigram, ()):
+                shared[token] += 1
+        #Typos allowed: one per four letters, at least one
+        limit = max(1, len(queryToken) // 4)
+        matches = []
+        for token, count in shared.items():
+            similarity = count / len(queryTrigrams | self.tokenTrigrams[token])
+            if similarity >= self.fuzzyThreshold:
+                matches.append((token, similarity))
+            elif count >= 2:
+                distance = _editDistance(queryToken, token, limit)
+                if distance <= limit:
+                    matches.append((token, 1 - distance / max(len(queryToken), len(token))))
+        return matches
+
+    def _tokenMatches (self, queryToken):
+        '''Returns (token, weight) for every label token that matches one query token'''
+        matches = []
+        if queryToken in self.postings:
+            matches.append((queryToken, self.exactWeight))
+        for token in self._prefixTokens(queryToken):
+            if token != queryToken:
+                matches.append((token, self.prefixWeight))
+        for token in self._infixTokens(queryToken):
+            matches.append((token, self.infixWeight))
+        if not matches:
+            matches = [(token, self.fuzzyWeight * similarity) for token, similarity in self._fuzzyTokens(queryToken)]
+        return matches
+
+    def search (self, query, limit=5):
+        '''
+        A function to find the census rows whose labels best match a query.
+        ----
+        Parameters:
+            query - the text typed into a search box (str)
+            limit - the most results to return (int)
+        Returns:
+            results - (row number as shown in the UI, i.e. row index + 2, label) for each match, best first (list of tuples of int, str)
+        '''
+        queryTokens = normalize(query)
+        if not queryTokens:
+            return []
+        scores = numpy.zeros(len(self.rowLabels))
+        matchedTokens = numpy.zeros(len(self.rowLabels), dtype=numpy.intp)
+        for queryToken in dict.fromkeys(queryTokens):
+            tokenScores = numpy.zeros(len(self.rowLabels))
+            for token, weight in self._tokenMatches(queryToken):
+                rows = self.postings[token]
+                tokenScores[rows] = numpy.maximum(tokenScores[rows], weight * self.idf[token])
+            scores += tokenScores
+            matchedTokens += tokenScores > 0
+
+        candidates = numpy.flatnonzero(scores)
+        if candidates.size == 0:
+            return []
+        candidateScores = scores[candidates]
+        candidateScores += self.allTokensBonus * (matchedTokens[candidates] == len(set(queryTokens)))
+        #Only candidates are checked for the whole phrase, so this stays cheap for broad queries
+        phrase = " ".join(queryTokens)
+        candidateScores += self.phraseBonus * numpy.fromiter((phrase in self.normalizedLabels[row] for row in candidates), dtype=bool, count=candidates.size)
+
+        order = numpy.lexsort((candidates, self.labelLengths[candidates], -candidateScores))[:limit]
+        return [(int(candidates[i]) + 2, self.rowLabels[candidates[i]]) for i in order]
+
+_indexes = {}
+_indexLock = threading.Lock()
+
+def getSearchIndex (store):
+    '''
+    A function to get the search index for a store, building it on first use.
+    ----
+    Parameters:
+        store - the store whose row labels are indexed (CensusStore)
+    Returns:
+        index - the shared index (SearchIndex)
+    '''
+    cached = _indexes.get(store.censusFilePath)
+    if cached is None or cached[0] is not store:
+        with _indexLock:
+            cached = _indexes.get(store.censusFilePath)
+            if cached is None or cached[0] is not store:
+                cached = (store, SearchIndex(store.rowLabels))
+                _indexes[store.censusFilePath] = cached
+    return cached[1]
+
+def searchRows (store, query, limit=5):
+    '''
+    A function to search the row labels of a store, see SearchIndex.search.
+    ----
+    Parameters:
+        store - the store to search (CensusStore)
+        query - the text typed into a search box (str)
+        limit - the most results to return (int)
+    Returns:
+        results - (row number as shown in the UI, label) for each match, best first (list of tuples of int, str)
+    '''
+    return getSearchIndex(store).search(query, limit)
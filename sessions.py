@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datastore import writeAtomically
+
+#How long a session is kept after it was last changed, in seconds
+sessionTTL = int(os.environ.get("SESSION_TTL", 6 * 3600))
+#Expired sessions are swept at most this often, as part of a write
+_purgeInterval = 60
+
+class SessionStore(ABC):
+    '''
+    Server-side state for each browser session, so the client only has to hold a session id. A session's state is a JSON-serializable dict; it expires ttl seconds after it was last changed. Subclasses decide where states are kept by implementing _load, _save and _purge; a subclass missing one cannot be created.
+    ----
+    Parameters:
+        ttl - seconds a session is kept after its last change (int)
+    '''
+    def __init__ (self, ttl=sessionTTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._lastPurge = 0
+
+    def newSessionId (self):
+        '''Returns a new, unguessable session id'''
+        return uuid.uuid4().hex
+
+    def get (self, sessionId):
+        '''
+        A function to read a session.
+        ----
+        Parameters:
+            sessionId - the id from newSessionId() (str)
+        Returns:
+            state - the session's state, or None if it does not exist or has expired (dict)
+        '''
+        if sessionId is None:
+            return None
+        return self._load(sessionId)
+
+    @contextmanager
+    def edit (self, sessionId):
+        '''
+        A context manager to change a session: yields its state (an empty dict for a new or expired session) and saves it when the with block ends without an error.
+        ----
+        Parameters:
+            sessionId - the id from newSessionId() (str)
+        '''
+        with self._lock:
+            state = self._load(sessionId)
+            state = {} if state is None else state
+            yield state
+            self._save(sessionId, state)
+            if time.time() - self._lastPurge > _purgeInterval:
+                self._lastPurge = time.time()
+                self._purge()
+
+    @abstractmethod
+    def _load (self, sessionId):
+        '''Returns a session's state, or None if it does not exist or has expired'''
+
+    @abstractmethod
+    def _save (self, sessionId, state):
+        '''Stores a session's state, restarting its ttl'''
+
+    @abstractmethod
+    def _purge (self):
+        '''Deletes every expired session'''
+
+class MemorySessionStore(SessionStore):
+    '''Keeps sessions in this process. Fastest, but every gunicorn worker has its own sessions, so use it with a single worker'''
+    def __init__ (self, ttl=sessionTTL):
+        super().__init__(ttl)
+        self._sessions = {}
+
+    def _load (self, sessionId):
+        saved = self._sessions.get(sessionId)
+        if saved is None or saved[0] < time.time():
+            return None
+        #A copy, so changes made in edit() are only kept if the block finishes
+        return json.loads(saved[1])
+
+    def _save (self, sessionId, state):
+        self._sessions[sessionId] = (time.time() + self.ttl, json.dumps(state))
+
+    def _purge (self):
+        now = time.time()
+        for sessionId, saved in list(self._sessions.items()):
+            if saved[0] < now:
+                del self._sessions[sessionId]
+
+class DiskSessionStore(SessionStore):
+    '''
+    Keeps each session as a JSON file in folder, shared by every worker on the machine. A file older than the ttl has expired.
+    ----
+    Parameters:
+        folder - where session files are written (str)
+        ttl - seconds a session is kept after its last change (int)
+    '''
+    def __init__ (self, folder, ttl=sessionTTL):
+        super().__init__(ttl)
+        self.folder = folder
+
+    def _path (self, sessionId):
+        #Session ids come from the browser, so only plain hex ids are turned into paths
+        if not sessionId.isalnum():
+            raise ValueError(f"Invalid session id {sessionId!r}")
+        return os.path.join(self.folder, f"{sessionId}.json")
+
+    def _load (self, sessionId):
+        path = self._path(sessionId)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                return None
+            with open(path) as sessionFile:
+                return json.load(sessionFile)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save (self, sessionId, state):
+        writeAtomically(self._path(sessionId), lambda sessionFile: json.dump(state, sessionFile), mode="w")
+
+    def _purge (self):
+        now = time.time()
+        for fileName in os.listdir(self.folder):
+            path = os.path.join(self.folder, fileName)
+            try:
+                if fileName.endswith(".json") and os.path.getmtime(path) + self.ttl < now:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Keeps sessions in a SQLite database, shared by every worker on the machine. Edits run in a write transaction, so two workers changing one session never lose an update.
+    ----
+    Parameters:
+        path - the database file (str)
+        ttl - seconds a session is kept after its last change (int)
+    '''
+    def __init__ (self, path, ttl=sessionTTL):
+        super().__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+
+    def _connection (self):
+        #One connection per thread (and per process, as gunicorn forks after this module is imported)
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT NOT NULL, expires REAL NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _load (self, sessionId):
+        row = self._connection().execute("SELECT state FROM sessions WHERE id = ? AND expires >= ?", (sessionId, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _save (self, sessionId, state):
+        self._connection().execute("INSERT OR REPLACE INTO sessions (id, state, expires) VALUES (?, ?, ?)", (sessionId, json.dumps(state), time.time() + self.ttl))
+
+    def _purge (self):
+        self._connection().execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+
+    @contextmanager
+    def edit (self, sessionId):
+        connection = self._connection()
+        with self._lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._load(sessionId)
+                state = {} if state is None else state
+                yield state
+                self._save(sessionId, state)
+                if time.time() - self._lastPurge > _purgeInterval:
+                    self._lastPurge = time.time()
+                    self._purge()
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+def createSessionStore (backend=None):
+    '''
+    A function to create the session store SESSION_BACKEND asks for.
+    ----
+    Parameters:
+        backend - "memory", "disk" (folder SESSION_FOLDER) or "sqlite" (database SESSION_DATABASE); defaults to SESSION_BACKEND, else "memory" (str)
+    Returns:
+        store - the session store (SessionStore)
+    '''
+    backend = backend or os.environ.get("SESSION_BACKEND", "memory")
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "disk":
+        return DiskSessionStore(os.environ.get("SESSION_FOLDER", "data/cache/sessions"))
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.environ.get("SESSION_DATABASE", "data/cache/sessions.sqlite"))
+    raise ValueError(f"Unknown SESSION_BACKEND {backend}")
+
+sessionStore = createSessionStore()
@@ -0,0 +1,277 @@
+'''
+Static snapshots: the figure JSON (and optionally a PNG thumbnail) of every row's map and bar graph as first drawn, written ahead of time so a worker, a plain static server or a CDN can serve them without running any callback, e.g.
+
+    python snapshots.py --rows all --charts map,bar --png --out snapshots
+
+Each JSON file is written alongside .gz and .br copies; /snapshots/<chart>/<row>.json serves whichever the client accepts, with an ETag, and renders live when there is no current snapshot. Snapshots older than the data files are ignored, so rebuild them after updating the data or changing how figures look.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datastore import writeAtomically, parseRows
+from compression import compressBody, chooseEncoding, encodedETag, matchesAnyEncoding
+
+snapshotFolder = os.environ.get("SNAPSHOT_FOLDER", "snapshots")
+snapshotMaxAge = int(os.environ.get("SNAPSHOT_MAX_AGE", 3600))
+snapshotCharts = ("map", "bar")
+thumbnailSettings = {
+    "map": {"width": 800, "height": 500},
+    "bar": {"width": 1200, "height": 500},
+}
+#Preferred first; "identity" is the uncompressed file
+snapshotEncodings = {"br": ".br", "gzip": ".gz", "identity": ""}
+
+class SnapshotStore:
+    '''
+    Reads the snapshots written by buildSnapshots. The manifest is re-read whenever its file changes, so a rebuild is picked up without restarting.
+    ----
+    Parameters:
+        folder - where the snapshots were written (str)
+    '''
+    def __init__ (self, folder=snapshotFolder):
+        self.folder = folder
+        self._manifest = None
+        self._manifestMtime = None
+        self._lock = threading.Lock()
+
+    def manifest (self):
+        '''Returns the current manifest, or None if no snapshots have been built (dict)'''
+        path = os.path.join(self.folder, "manifest.json")
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        if mtime != self._manifestMtime:
+            with self._lock:
+                if mtime != self._manifestMtime:
+                    with open(path) as manifestFile:
+                        self._manifest = json.load(manifestFile)
+                    self._manifestMtime = mtime
+        return self._manifest
+
+    def entry (self, chart, row, dataMtimes):
+        '''
+        A function to find the snapshot of one chart of one row.
+        ----
+        Parameters:
+            chart - "map" or "bar" (str)
+            row - the row number, as shown in the UI (int)
+            dataMtimes - when the data files were last changed (CensusStore.mtimes); snapshots built from other data are ignored (tuple)
+        Returns:
+            entry - its manifest entry (hash, bytes, and pngHash if it has a thumbnail), or None if there is no current snapshot (dict)
+        '''
+        manifest = self.manifest()
+        if manifest is None or manifest.get("data") != list(dataMtimes):
+            return None
+        return manifest["snapshots"].get(f"{chart}/{int(row)}")
+
+    def path (self, chart, row, extension):
+        '''Returns where a snapshot file is kept, e.g. extension ".json.br" or ".png" (str)'''
+        return os.path.join(self.folder, chart, f"{int(row)}{extension}")
+
+    def read (self, chart, row, dataMtimes):
+        '''Returns the figure JSON of a current snapshot, or None (bytes)'''
+        if self.entry(chart, row, dataMtimes) is None:
+            return None
+        try:
+            with open(self.path(chart, row, ".json"), "rb") as snapshotFile:
+                return snapshotFile.read()
+        except FileNotFoundError:
+            return None
+
+snapshotStore = SnapshotStore()
+
+def _cachedResponse (body, etag, contentType, encoding, varyEncoding=True):
+    from flask import Response
+    response = Response(body, content_type=contentType)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={snapshotMaxAge}"
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    if varyEncoding:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def registerSnapshotRoutes (server, liveFigureJSON, dataMtimes, store=snapshotStore):
+    '''
+    A function to serve snapshots from the Flask server behind the Dash app, at /snapshots/<chart>/<row>.json and /snapshots/<chart>/<row>.png. JSON is sent precompressed as the client accepts (brotli, then gzip), each encoding with its own ETag; both answer If-None-Match with 304 Not Modified.
+    ----
+    Parameters:
+        server - the Flask app, i.e. app.server (flask.Flask)
+        liveFigureJSON - renders a chart of a row when it has no current snapshot (function (chart, row) -> bytes)
+        dataMtimes - returns when the data files were last changed (function -> tuple)
+        store - where snapshots are read from (SnapshotStore)
+    '''
+    from flask import request, abort, Response
+
+    @server.route("/snapshots/<chart>/<int:row>.json")
+    def snapshotJSON (chart, row):
+        if chart not in snapshotCharts:
+            abort(404)
+        entry = store.entry(chart, row, dataMtimes())
+        if entry is not None:
+            etag = entry["hash"]
+        else:
+            try:
+                body = liveFigureJSON(chart, row)
+            except (IndexError, ValueError):
+                abort(404)
+            etag = hashlib.sha256(body).hexdigest()
+        encoding = chooseEncoding(request.headers.get("Accept-Encoding"))
+        if matchesAnyEncoding(request.if_none_match, etag):
+            response = Response(status=304)
+            response.set_etag(encodedETag(etag, encoding))
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
+        if entry is not None:
+            try:
+                with open(store.path(chart, row, ".json" + snapshotEncodings[encoding]), "rb") as snapshotFile:
+                    body = snapshotFile.read()
+            except FileNotFoundError:
+                body = compressBody(liveFigureJSON(chart, row), encoding, fast=True)
+        else:
+            body = compressBody(body, encoding, fast=True)
+        return _cachedResponse(body, encodedETag(etag, encoding), "application/json", encoding)
+
+    @server.route("/snapshots/<chart>/<int:row>.png")
+    def snapshotPNG (chart, row):
+        entry = store.entry(chart, row, dataMtimes()) if chart in snapshotCharts else None
+        if entry is None or "pngHash" not in entry:
+            abort(404)
+        if request.if_none_match.contains(entry["pngHash"]):
+            response = Response(status=304)
+            response.set_etag(entry["pngHash"])
+            return response
+        with open(store.path(chart, row, ".png"), "rb") as imageFile:
+            return _cachedResponse(imageFile.read(), entry["pngHash"], "image/png", "identity", varyEncoding=False)
+
+def writeSnapshot (store, chart, row, figureJSON, previous):
+    '''
+    A function to write one snapshot's JSON and its compressed copies, unless the last build already wrote the same figure.
+    ----
+    Parameters:
+        store - where snapshots are written (SnapshotStore)
+        chart - "map" or "bar" (str)
+        row - the row number, as shown in the UI (int)
+        figureJSON - the serialized figure (bytes)
+        previous - the last build's manifest entry for this snapshot, or None (dict)
+    Returns:
+        entry - the manifest entry (dict)
+        written - False if the files were already up to date (bool)
+    '''
+    contentHash = hashlib.sha256(figureJSON).hexdigest()
+    entry = {"hash": contentHash, "bytes": len(figureJSON)}
+    if previous is not None and previous["hash"] == contentHash and all(os.path.exists(store.path(chart, row, ".json" + extension)) for extension in snapshotEncodings.values()):
+        entry.update({key: value for key, value in previous.items() if key not in entry})
+        return entry, False
+    for encoding, extension in snapshotEncodings.items():
+        body = compressBody(figureJSON, encoding)
+        entry[f"{encoding}Bytes"] = len(body)
+        writeAtomically(store.path(chart, row, ".json" + extension), lambda snapshotFile: snapshotFile.write(body))
+    return entry, True
+
+def _startPNGWorker ():
+    #Kaleido is only started in workers that render thumbnails
+    from batch import _startWorker
+    _startWorker()
+
+def snapshotRow (folder, chart, row, previous, png=False):
+    '''
+    A function to snapshot one chart of one row, in a worker process: its figure JSON, compressed copies and, with png, a thumbnail.
+    ----
+    Parameters:
+        folder - where snapshots are written (str)
+        chart - "map" or "bar" (str)
+        row - the row number, as shown in the UI (int)
+        previous - the last build's manifest entry for this snapshot, or None (dict)
+        png - whether to render a PNG thumbnail too (bool)
+    Returns:
+        entry - the manifest entry (dict)
+        written - False if nothing had changed since the last build (bool)
+    '''
+    import map
+    store = SnapshotStore(folder)
+    figureJSON = map.liveFigureJSON(chart, row)
+    entry, written = writeSnapshot(store, chart, row, figureJSON, previous)
+    path = store.path(chart, row, ".png")
+    if png and (written or "pngHash" not in entry or not os.path.exists(path)):
+        import plotly.io as pio
+        settings = thumbnailSettings[chart]
+        image = pio.to_image(json.loads(figureJSON), format="png", engine="kaleido", width=settings["width"], height=settings["height"], validate=False)
+        writeAtomically(path, lambda snapshotFile: snapshotFile.write(image))
+        entry["pngHash"] = hashlib.sha256(image).hexdigest()
+        written = True
+    return entry, written
+
+def buildSnapshots (rows, charts=snapshotCharts, png=False, folder=snapshotFolder, workers=None):
+    '''
+    A function to write the snapshots of many rows in parallel, skipping those whose figure has not changed since the last build.
+    ----
+    Parameters:
+        rows - row numbers, as shown in the UI (list of ints)
+        charts - which charts to snapshot (sequence of "map" and "bar")
+        png - whether to also render PNG thumbnails (bool)
+        folder - where snapshots are written (str)
+        workers - worker processes (int, default one per CPU)
+    Returns:
+        manifest - what was built (dict)
+    '''
+    #Loaded before the pool starts so forked workers inherit the parsed data
+    import map
+    dataMtimes = list(map.getStore().mtimes)
+    manifest = SnapshotStore(folder).manifest() or {}
+    previousSnapshots = manifest.get("snapshots", {}) if manifest.get("data") == dataMtimes else {}
+    snapshots = {}
+    start = time.perf_counter()
+    written = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_startPNGWorker if png else None) as executor:
+        futures = {executor.submit(snapshotRow, folder, chart, row, previousSnapshots.get(f"{chart}/{row}"), png): f"{chart}/{row}" for chart in charts for row in rows}
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                entry, changed = future.result()
+            except Exception as error:
+                failed += 1
+                print(f"{key} failed: {error!r}", file=sys.stderr)
+                continue
+            snapshots[key] = entry
+            written += changed
+            skipped += not changed
+            if done % 100 == 0 or done == len(futures):
+                print(f"{done}/{len(futures)} snapshots, {written} written, {skipped} up to date, {failed} failed, {time.perf_counter() - start:.0f}s")
+
+    #Snapshots of rows not built this time are kept if they were built from the same data
+    manifest = {"generated": time.strftime("%Y-%m-%dT%H:%M:%S"), "data": dataMtimes, "snapshots": dict(previousSnapshots, **snapshots)}
+    writeAtomically(os.path.join(folder, "manifest.json"), lambda snapshotFile: snapshotFile.write(json.dumps(manifest, indent=1, sort_keys=True).encode()))
+    return manifest
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Write static figure snapshots for every census row")
+    parser.add_argument("--rows", default="all", help='rows as shown in the UI, e.g. "37,40-45", or "all" (default)')
+    parser.add_argument("--charts", default=",".join(snapshotCharts), help='comma-separated charts: "map", "bar" (default: both)')
+    parser.add_argument("--png", action="store_true", help="also render PNG thumbnails")
+    parser.add_argument("--out", default=snapshotFolder, help=f"output folder (default: {snapshotFolder})")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    #"lazy" keeps map.py from warming in a thread that would be running while the pool forks
+    os.environ.setdefault("STARTUP_MODE", "lazy")
+    import map
+    charts = args.charts.split(",")
+    for chart in charts:
+        if chart not in snapshotCharts:
+            parser.error(f"unknown chart {chart}")
+    try:
+        rows = parseRows(args.rows, len(map.getStore().rowLabels))
+    except ValueError as error:
+        parser.error(f"--rows: {error}")
+    manifest = buildSnapshots(rows, charts, args.png, args.out, args.workers)
+    return 0 if all(f"{chart}/{row}" in manifest["snapshots"] for chart in charts for row in rows) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,227 @@
+import os
+import numpy
+import shapely
+import threading
+from datastore import writeAtomically
+try:
+    #Optional: a compiled sparse product; without it the same product is done with numpy
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+#How the map can be drawn: per neighbourhood as in the csv, or per ward, with each neighbourhood's value shared out by how much of its area lies in each ward
+mapLevels = {
+    "neighbourhood": "Neighbourhoods",
+    "wardSum": "Wards (sum)",
+    "wardMean": "Wards (area-weighted average)",
+}
+#The ward aggregation each ward level uses (see SpatialIndex.wardValues): "sum" for counts, "mean" for averages, medians and percentages
+wardAggregations = {"wardSum": "sum", "wardMean": "mean"}
+#Areas are measured in UTM zone 17N (metres), since areas in degrees shrink with latitude
+areaCRS = "EPSG:32617"
+#Overlaps smaller than this share of a neighbourhood are slivers where the two files trace the same street slightly differently, not real overlaps
+overlapMinimumShare = 0.001
+overlapCacheFolder = "data/cache"
+
+def sparseProduct (rows, columns, weights, shape, dense):
+    '''
+    A function to multiply a sparse matrix, given as its nonzero entries, by a dense one.
+    ----
+    Parameters:
+        rows, columns, weights - the row, column and value of every nonzero entry (numpy arrays)
+        shape - the sparse matrix's (rows, columns) (tuple of int)
+        dense - the right-hand side, columns x k (numpy array)
+    Returns:
+        product - the product, rows x k (numpy float64 array)
+    '''
+    dense = numpy.asarray(dense, dtype=numpy.float64)
+    if sparse is not None:
+        return sparse.csr_matrix((weights, (rows, columns)), shape=shape) @ dense
+    product = numpy.zeros((shape[0],) + dense.shape[1:])
+    numpy.add.at(product, rows, weights.reshape((-1,) + (1,) * (dense.ndim - 1)) * dense[columns])
+    return product
+
+class OverlapTable:
+    '''
+    How neighbourhoods and wards overlap: one entry per pair that shares area, with the shared area in square metres. Neighbourhoods are numbered by census column, wards by their order in the ward geojson.
+    ----
+    Parameters:
+        wardIndexes, columnIndexes, areas - the ward, census column and shared area of every overlapping pair (numpy arrays)
+        wardCount - the number of wards (int)
+    '''
+    def __init__ (self, wardIndexes, columnIndexes, areas, wardCount):
+        self.wardIndexes = numpy.asarray(wardIndexes, dtype=numpy.intp)
+        self.columnIndexes = numpy.asarray(columnIndexes, dtype=numpy.intp)
+        self.areas = numpy.asarray(areas, dtype=numpy.float64)
+        self.wardCount = wardCount
+        #The share of each neighbourhood that lies in each ward, out of the area the table covers so slivers left out lose nothing: summing a count row with these weights splits every neighbourhood's count between its wards and keeps the city total
+        coveredAreas = numpy.bincount(self.columnIndexes, weights=self.areas)
+        self.neighbourhoodShares = self.areas / coveredAreas[self.columnIndexes]
+
+    @property
+    def arrays (self):
+        '''The table as named arrays, e.g. to save with numpy.savez (dict)'''
+        return {
+            "wardIndexes": self.wardIndexes,
+            "columnIndexes": self.columnIndexes,
+            "areas": self.areas,
+            "wardCount": numpy.array(self.wardCount),
+        }
+
+    def aggregate (self, columnValues, aggregation="sum"):
+        '''
+        A function to turn values per neighbourhood into values per ward, for one row or every row at once, as one sparse matrix product.
+        ----
+        Parameters:
+            columnValues - one value per census column, or rows x census columns (numpy array)
+            aggregation - "sum" to split each neighbourhood's value between its wards by area and add up each ward's shares, for counts; "mean" for the average over each ward's area, for averages, medians and percentages (str)
+        Returns:
+            wardValues - one value per ward, or rows x wards; NaN for a ward if any of its neighbourhoods has no number ("sum") or all of them have none ("mean") (numpy float64 array)
+        '''
+        columnValues = numpy.asarray(columnValues, dtype=numpy.float64)
+        values = columnValues.T
+        missing = numpy.isnan(values)
+        shape = (self.wardCount, values.shape[0])
+        if aggregation == "sum":
+            totals = sparseProduct(self.wardIndexes, self.columnIndexes, self.neighbourhoodShares, shape, numpy.where(missing, 0, values))
+            incomplete = sparseProduct(self.wardIndexes, self.columnIndexes, numpy.ones_like(self.areas), shape, missing) > 0
+            totals[incomplete] = numpy.nan
+            return totals.T
+        if aggregation == "mean":
+            totals = sparseProduct(self.wardIndexes, self.columnIndexes, self.areas, shape, numpy.where(missing, 0, values))
+            coveredAreas = sparseProduct(self.wardIndexes, self.columnIndexes, self.areas, shape, ~missing)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                means = totals / coveredAreas
+            means[coveredAreas == 0] = numpy.nan
+            return means.T
+        raise ValueError(f"Unknown aggregation {aggregation}")
+
+def buildOverlapTable (store):
+    '''
+    A function to measure how much of every neighbourhood lies in every ward, using a spatial index of the wards to skip pairs that cannot touch.
+    ----
+    Parameters:
+        store - the store holding both geometries (CensusStore)
+    Returns:
+        table - the overlaps (OverlapTable)
+    '''
+    neighbourhoods = shapely.make_valid(store.neighbourhoodGeo.to_crs(areaCRS).geometry.to_numpy())
+    wards = shapely.make_valid(store.wardGeo.to_crs(areaCRS).geometry.to_numpy())
+    featureIndexes, wardIndexes = shapely.STRtree(wards).query(neighbourhoods, predicate="intersects")
+    areas = shapely.area(shapely.intersection(neighbourhoods[featureIndexes], wards[wardIndexes]))
+    #Features without a census column have no values to share out
+    columnIndexes = store.geoPermutation[featureIndexes]
+    kept = (columnIndexes >= 0) & (areas >= overlapMinimumShare * shapely.area(neighbourhoods)[featureIndexes])
+    #Ordered by ward, then column, so the table reads like a sparse matrix in row order
+    order = numpy.lexsort((columnIndexes[kept], wardIndexes[kept]))
+    return OverlapTable(wardIndexes[kept][order], columnIndexes[kept][order], areas[kept][order], len(wards))
+
+def _overlapCachePath (store):
+    stem = os.path.splitext(os.path.basename(store.neighbourhoodFilePath))[0]
+    wardStem = os.path.splitext(os.path.basename(store.citywardsFilePath))[0]
+    return os.path.join(overlapCacheFolder, f"{stem}.{wardStem}.overlap.npz")
+
+class SpatialIndex:
+    '''
+    STRtrees over the neighbourhood and ward geometry of a store, for point and bounding-box lookups, and every census row aggregated to wards ahead of time (see OverlapTable), so a ward map needs no geometry work per request.
+    ----
+    Parameters:
+        store - the store to index (CensusStore)
+        overlap - the store's overlap table; measured from the geometry if None (OverlapTable)
+    '''
+    def __init__ (self, store, overlap=None):
+        self.geometries = {
+            "neighbourhood": store.neighbourhoodGeo.geometry.to_numpy(),
+            "ward": store.wardGeo.geometry.to_numpy(),
+        }
+        self.names = {
+            "neighbourhood": store.neighbourhoodGeo["AREA_NAME"].to_numpy(),
+            "ward": store.wardGeo["AREA_NAME"].to_numpy(),
+        }
+        self.trees = {layer: shapely.STRtree(geometries) for layer, geometries in self.geometries.items()}
+        for geometries in self.geometries.values():
+            shapely.prepare(geometries)
+        self.overlap = overlap if overlap is not None else buildOverlapTable(store)
+        self.wardMatrices = {aggregation: self.overlap.aggregate(store.censusMatrix, aggregation) for aggregation in ("sum", "mean")}
+        for wardMatrix in self.wardMatrices.values():
+            wardMatrix.setflags(write=False)
+
+    def locate (self, layer, lon, lat):
+        '''
+        A function to find which feature of a layer each point falls in.
+        ----
+        Parameters:
+            layer - "neighbourhood" or "ward" (str)
+            lon, lat - longitudes and latitudes (float or numpy arrays)
+        Returns:
+            featureIndexes - the feature (in geojson order) each point is in, or -1 outside every feature; a point on a shared border gets the first (numpy int array)
+        '''
+        points = shapely.points(numpy.atleast_1d(numpy.asarray(lon, dtype=numpy.float64)), numpy.atleast_1d(numpy.asarray(lat, dtype=numpy.float64)))
+        pointIndexes, featureIndexes = self.trees[layer].query(points, predicate="intersects")
+        found = numpy.full(len(points), -1, dtype=numpy.intp)
+        #Reversed so the first match of each point is the one written last
+        found[pointIndexes[::-1]] = featureIndexes[::-1]
+        return found
+
+    def lookupPoint (self, lon, lat):
+        '''
+        A function to find the neighbourhood and ward of one point.
+        ----
+        Parameters:
+            lon, lat - the point (float)
+        Returns:
+            areas - {"neighbourhood": name, "ward": name}, None where the point is outside the city (dict)
+        '''
+        areas = {}
+        for layer in ("neighbourhood", "ward"):
+            featureIndex = self.locate(layer, lon, lat)[0]
+            areas[layer] = str(self.names[layer][featureIndex]) if featureIndex >= 0 else None
+        return areas
+
+    def inBounds (self, layer, minLon, minLat, maxLon, maxLat):
+        '''
+        A function to find the features of a layer that overlap a bounding box, e.g. the part of the map on screen.
+        ----
+        Parameters:
+            layer - "neighbourhood" or "ward" (str)
+            minLon, minLat, maxLon, maxLat - the box (float)
+        Returns:
+            featureIndexes - the overlapping features, in geojson order (numpy int array)
+        '''
+        return numpy.sort(self.trees[layer].query(shapely.box(minLon, minLat, maxLon, maxLat), predicate="intersects"))
+
+    def wardValues (self, rowIndex, aggregation="sum"):
+        '''Returns one census row (0-based) aggregated to wards, in ward geojson order (numpy float64 array, see OverlapTable.aggregate)'''
+        return self.wardMatrices[aggregation][rowIndex]
+
+_indexes = {}
+_indexLock = threading.Lock()
+
+def getSpatialIndex (store):
+    '''
+    A function to get the spatial index of a store, building it on first use. The overlap table is cached in overlapCacheFolder; a cached file older than either geojson is measured again.
+    ----
+    Parameters:
+        store - the store to index (CensusStore)
+    Returns:
+        index - the shared index (SpatialIndex)
+    '''
+    key = (store.neighbourhoodFilePath, store.citywardsFilePath)
+    cached = _indexes.get(key)
+    if cached is None or cached[0] is not store:
+        with _indexLock:
+            cached = _indexes.get(key)
+            if cached is None or cached[0] is not store:
+                cachePath = _overlapCachePath(store)
+                sourceMtime = max(os.path.getmtime(store.neighbourhoodFilePath), os.path.getmtime(store.citywardsFilePath), os.path.getmtime(store.censusFilePath))
+                overlap = None
+                if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= sourceMtime:
+                    with numpy.load(cachePath) as cacheFile:
+                        arrays = dict(cacheFile)
+                    overlap = OverlapTable(arrays["wardIndexes"], arrays["columnIndexes"], arrays["areas"], int(arrays["wardCount"]))
+                index = SpatialIndex(store, overlap)
+                if overlap is None:
+                    writeAtomically(cachePath, lambda cacheFile: numpy.savez(cacheFile, **index.overlap.arrays))
+                cached = (store, index)
+                _indexes[key] = cached
+    return cached[1]
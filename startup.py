@@ -0,0 +1,115 @@
+'''
+Startup warm-up and timing. map.py no longer builds any figure while it is imported; instead it hands startWarmUp() the steps that get the first page ready (loading the data, the search index, the first map and bar graph) and STARTUP_MODE decides when they run:
+
+    "background" - import returns at once and the steps run in a daemon thread, so the worker is up while it warms (default)
+    "eager" - the steps run before the import returns; gunicorn.conf.py uses this so the preloading master warms once and every forked worker starts warm
+    "lazy" - nothing is warmed; the first request loads what it needs
+
+Run "python startup.py" for a breakdown of where a cold start spends its time (imports, data loading, first render).
+'''
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+startupMode = os.environ.get("STARTUP_MODE", "background")
+startupTimings = {}
+_timingLock = threading.Lock()
+
+@contextmanager
+def timed (stage):
+    '''Records how long the body of a with block takes in startupTimings, under stage'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _timingLock:
+            startupTimings[stage] = time.perf_counter() - start
+
+def warmUp (steps):
+    '''
+    A function to run warm-up steps in order, timing each.
+    ----
+    Parameters:
+        steps - (stage name, function taking no arguments) for each step (list of tuples)
+    Returns:
+        timings - seconds taken by each stage so far, in the order they ran (dict)
+    '''
+    for stage, function in steps:
+        with timed(stage):
+            function()
+    return dict(startupTimings)
+
+def startupReport (timings=None):
+    '''
+    A function to format stage timings as one line, e.g. "Startup 1.42s: data 0.81s, search index 0.03s, first render 0.58s".
+    ----
+    Parameters:
+        timings - seconds per stage; defaults to startupTimings (dict)
+    Returns:
+        report - the formatted timings (str)
+    '''
+    if timings is None:
+        with _timingLock:
+            timings = dict(startupTimings)
+    stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+    return f"Startup {sum(timings.values()):.2f}s: {stages}"
+
+def _warmAndReport (steps):
+    try:
+        warmUp(steps)
+    except Exception as error:
+        #A failed warm-up only costs speed: the first request builds whatever is missing and reports the error properly
+        print(f"Startup warm-up failed: {error!r}", file=sys.stderr)
+    else:
+        print(startupReport())
+
+def startWarmUp (steps, mode=None):
+    '''
+    A function to warm up the way STARTUP_MODE asks.
+    ----
+    Parameters:
+        steps - (stage name, function taking no arguments) for each step (list of tuples)
+        mode - "background", "eager" or "lazy"; defaults to startupMode (str)
+    Returns:
+        thread - the warm-up thread in "background" mode, otherwise None (threading.Thread)
+    '''
+    mode = mode or startupMode
+    if mode == "eager":
+        _warmAndReport(steps)
+    elif mode == "background":
+        thread = threading.Thread(target=_warmAndReport, args=(steps,), name="startupWarmUp", daemon=True)
+        thread.start()
+        return thread
+    elif mode != "lazy":
+        raise ValueError(f"Unknown STARTUP_MODE {mode}")
+    return None
+
+def measureStartup ():
+    '''
+    A function to time a cold start in this process, split into imports, data loading and the first render. Must run before map.py is imported.
+    ----
+    Returns:
+        timings - seconds per stage (dict)
+    '''
+    os.environ["STARTUP_MODE"] = "lazy"
+    global startupMode
+    startupMode = "lazy"
+    with timed("import dash"):
+        import dash
+    with timed("import pandas, geopandas"):
+        import pandas
+        import geopandas
+    with timed("import map"):
+        import map
+    warmUp(map.warmUpSteps)
+    with timed("cached render"):
+        map.showRow(37, "Value", None)
+    return dict(startupTimings)
+
+if __name__ == '__main__':
+    timings = measureStartup()
+    for stage, seconds in timings.items():
+        print(f"{stage:<28}{seconds * 1000:>9.1f} ms")
+    print(f"{'total':<28}{sum(timings.values()) * 1000:>9.1f} ms")
@@ -0,0 +1,45 @@
+import numpy
+import warnings
+
+#The columns of the per-row statistics table, in order (see computeRowStats)
+rowStatNames = ("median", "mean", "min", "max", "q1", "q3", "total", "count", "nanCount")
+
+def computeRowStats (censusMatrix):
+    '''
+    A function to compute summary statistics for every census row at once, ignoring cells that are not numbers. Rows without any numbers get NaN for every statistic except count and nanCount.
+    ----
+    Parameters:
+        censusMatrix - every census value, rows x neighbourhoods, NaN where a cell is not a number (numpy float64 array)
+    Returns:
+        rowStats - rows x rowStatNames: the median, mean, minimum, maximum, first and third quartile, city-wide total, and the number of numeric and of non-numeric cells (numpy float64 array)
+    '''
+    nanMask = numpy.isnan(censusMatrix)
+    count = (~nanMask).sum(axis=1)
+    with warnings.catch_warnings():
+        #All-NaN rows (e.g. TSNS designations) are expected and come out as NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1, median, q3 = numpy.nanpercentile(censusMatrix, [25, 50, 75], axis=1)
+        mean = numpy.nanmean(censusMatrix, axis=1)
+        minimum = numpy.nanmin(censusMatrix, axis=1)
+        maximum = numpy.nanmax(censusMatrix, axis=1)
+    total = numpy.where(count > 0, numpy.nansum(censusMatrix, axis=1), numpy.nan)
+    columns = {
+        "median": median,
+        "mean": mean,
+        "min": minimum,
+        "max": maximum,
+        "q1": q1,
+        "q3": q3,
+        "total": total,
+        "count": count,
+        "nanCount": nanMask.sum(axis=1),
+    }
+    return numpy.column_stack([columns[name] for name in rowStatNames]).astype(numpy.float64)
+
+def formatStat (value):
+    '''Formats a statistic for hover text: whole numbers with thousands separators, others to two decimals, NaN as "n/a"'''
+    if numpy.isnan(value):
+        return "n/a"
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
@@ -0,0 +1,8 @@
+import os
+import sys
+
+#The modules live at the top of the repository and read data/ by relative path, so tests run from there
+repositoryFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repositoryFolder)
+os.chdir(repositoryFolder)
+os.environ.setdefault("STARTUP_MODE", "lazy")
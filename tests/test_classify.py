@@ -0,0 +1,64 @@
+import itertools
+import numpy
+import pytest
+from classify import jenksBreaks, quantileBreaks, equalIntervalBreaks, classifyValues, rankValues, Classification
+
+def _deviation (groups):
+    return sum(((group - group.mean()) ** 2).sum() for group in groups)
+
+def _bruteForceJenks (values, classes):
+    '''The least total squared deviation over every split of the sorted values into classes contiguous groups'''
+    values = numpy.sort(values)
+    return min(
+        _deviation(numpy.split(values, list(cuts)))
+        for cuts in itertools.combinations(range(1, len(values)), classes - 1)
+    )
+
+@pytest.mark.parametrize("seed", range(20))
+def test_jenksMatchesBruteForce (seed):
+    generator = numpy.random.default_rng(seed)
+    classes = int(generator.integers(2, 5))
+    matrix = generator.lognormal(3, 1, size=(4, int(generator.integers(classes, 10))))
+    #NaN cells are left out, as cells that are not numbers are
+    matrix[1, ::3] = numpy.nan
+    breaks = jenksBreaks(matrix, classes)
+    rowClasses = classifyValues(matrix, breaks)
+    for row, classRow in zip(matrix, rowClasses):
+        values = row[~numpy.isnan(row)]
+        if len(values) < classes:
+            continue
+        groups = [values[classRow[~numpy.isnan(row)] == value] for value in range(classes)]
+        assert _deviation(groups) == pytest.approx(_bruteForceJenks(values, classes))
+
+def test_jenksBreaksSpanTheRow ():
+    matrix = numpy.array([[1.0, 2, 3, 10, 11, 12, 50, 51, 52], [5, 1, 4, 2, 3, numpy.nan, 9, 8, 7]])
+    breaks = jenksBreaks(matrix, 3)
+    assert breaks[0].tolist() == [1, 3, 12, 52]
+    assert breaks[1, 0] == 1 and breaks[1, -1] == 9
+
+def test_fewValuesFallBackToQuantiles ():
+    matrix = numpy.array([[1.0, 2, numpy.nan, numpy.nan, numpy.nan, numpy.nan]])
+    numpy.testing.assert_array_equal(jenksBreaks(matrix, 5), quantileBreaks(matrix, 5))
+
+def test_quantileAndEqualIntervalBreaks ():
+    matrix = numpy.array([[0.0, 1, 2, 3, 4, 5, 6, 7, 8]])
+    numpy.testing.assert_allclose(quantileBreaks(matrix, 4)[0], [0, 2, 4, 6, 8])
+    numpy.testing.assert_allclose(equalIntervalBreaks(numpy.array([[10.0, 20, numpy.nan, 30]]), 2)[0], [10, 20, 30])
+
+def test_valueOnABoundaryBelongsToTheClassBelow ():
+    matrix = numpy.array([[0.0, 2, 3, 4, numpy.nan]])
+    classes = classifyValues(matrix, numpy.array([[0.0, 2, 4]]))
+    assert classes[0].tolist() == [0, 0, 1, 1, -1]
+
+def test_ranksShareTiesAndSkipNaN ():
+    ranks, percentiles = rankValues(numpy.array([[10.0, 30, 30, numpy.nan, 5]]))
+    assert ranks[0].tolist() == [3, 1, 1, 0, 4]
+    numpy.testing.assert_allclose(percentiles[0], [50, 100, 100, numpy.nan, 25])
+
+def test_classificationCoversEveryMode ():
+    matrix = numpy.random.default_rng(0).normal(size=(3, 12))
+    classification = Classification(matrix, 4)
+    for mode in ("quantile", "jenks", "equal"):
+        assert len(classification.breaks(mode, 1)) == 5
+        assert set(classification.rowClasses(mode, 1).tolist()) <= {0, 1, 2, 3}
+    assert sorted(classification.ranks(2).tolist()) == list(range(1, 13))
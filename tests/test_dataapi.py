@@ -0,0 +1,61 @@
+import json
+import pytest
+from flask import Flask
+import dataapi
+from datastore import getStore
+
+def _strictJSON (body):
+    '''Parses body as JSON.parse would, failing on NaN and Infinity'''
+    def reject (constant):
+        raise ValueError(f"{constant} is not JSON")
+    return json.loads(body, parse_constant=reject)
+
+@pytest.fixture(scope="module")
+def client ():
+    server = Flask(__name__)
+    dataapi.registerDataRoutes(server, getStore)
+    return server.test_client()
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder (request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(dataapi, "orjson", None)
+    elif dataapi.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+def test_rowWithMissingSummaryIsStrictJSON (client, encoder):
+    #Row 3 is text in every column, so its values and summary statistics are all missing
+    response = client.get("/api/rows/3.json")
+    assert response.status_code == 200
+    row = _strictJSON(response.data)
+    assert row["row"] == 3
+    assert row["summary"]["median"] is None
+    assert all(value is None for value in row["values"])
+
+def test_rowsAreStrictJSON (client, encoder):
+    response = client.get("/api/rows.json?rows=2-5,37")
+    rows = _strictJSON(response.data)["rows"]
+    assert [row["row"] for row in rows] == [2, 3, 4, 5, 37]
+    assert rows[1]["values"][0] is None
+    assert isinstance(rows[4]["values"][0], float)
+
+def test_badRowsAreRejected (client):
+    assert client.get("/api/rows.json?rows=9-5").status_code == 400
+    assert client.get("/api/rows.json?rows=abc").status_code == 400
+    assert client.get("/api/rows/1.json").status_code == 404
+
+def test_conditionalGet (client):
+    response = client.get("/api/rows/37.csv")
+    assert client.get("/api/rows/37.csv", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/api/rows/37.csv", headers={"If-Modified-Since": response.headers["Last-Modified"]}).status_code == 304
+
+def test_eachEncodingHasItsOwnETag (client):
+    plain = client.get("/api/rows.csv?rows=2-40")
+    compressed = client.get("/api/rows.csv?rows=2-40", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert plain.headers["ETag"] != compressed.headers["ETag"]
+    #Either tag names the same content, so either revalidates
+    revalidated = client.get("/api/rows.csv?rows=2-40", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == compressed.headers["ETag"]
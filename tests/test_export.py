@@ -0,0 +1,27 @@
+import os
+from concurrent.futures import Future
+from export import ExportPool
+
+def _finished (pool, jobId, image):
+    future = Future()
+    future.set_result(image)
+    pool._finish(jobId, "pdf", 0, future)
+
+def test_exportFolderIsBounded (tmp_path):
+    pool = ExportPool(folder=str(tmp_path), folderMaxBytes=8000)
+    for job in range(40):
+        _finished(pool, f"job{job}", b"%PDF" + bytes(996))
+        #Spread the modification times so the oldest exports are the ones pruned
+        os.utime(tmp_path / f"job{job}.pdf", (job, job))
+    files = os.listdir(tmp_path)
+    assert sum(os.path.getsize(tmp_path / name) for name in files) <= 8000 * 9 // 8
+    assert "job39.pdf" in files and "job0.pdf" not in files
+
+def test_failedExportIsReported (tmp_path):
+    pool = ExportPool(folder=str(tmp_path))
+    future = Future()
+    future.set_exception(RuntimeError("kaleido failed"))
+    pool._finish("broken", "pdf", 0, future)
+    assert pool.status("broken") == "error"
+    assert "kaleido failed" in pool.error("broken")
+    assert pool.results.stats()["misses"] == 0
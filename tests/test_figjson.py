@@ -0,0 +1,22 @@
+import numpy
+import plotly.io as pio
+import plotly.graph_objects as go
+from figcache import FigureCache
+from figjson import figureFromJSON
+from export import _render
+
+def _barFigure ():
+    values = numpy.arange(40, dtype=numpy.float64) * 1250.5
+    return go.Figure(go.Bar(x=[f"Neighbourhood {index}" for index in range(40)], y=values))
+
+def test_cachedFigureHoldsTypedArrays ():
+    figureJSON = FigureCache().getOrBuild(("bar", 37), _barFigure, "bar")
+    trace = figureFromJSON(figureJSON)["data"][0]
+    assert set(trace["y"]) >= {"dtype", "bdata"}
+
+def test_cachedFigureRendersWithKaleido ():
+    #Regression: plotly.py's validators reject typed arrays, so cached figures must be rendered without validation
+    figureJSON = FigureCache().getOrBuild(("bar", 37), _barFigure, "bar")
+    image = pio.to_image(figureFromJSON(figureJSON), format="png", engine="kaleido", width=400, height=300, validate=False)
+    assert image.startswith(b"\x89PNG")
+    assert _render(figureJSON, "pdf", 400, 300).startswith(b"%PDF")
@@ -0,0 +1,39 @@
+import pytest
+import map
+from benchmarks.suite import dashRequest
+
+@pytest.fixture(scope="module")
+def client ():
+    return map.server.test_client()
+
+def _showRow (client, value, rowShown):
+    body = dashRequest(
+        map.app, "update_output",
+        [("search", "value", value), [], ("mapClassification", "value", "none"), ("compareRow", "value", ""), ("comparisonMode", "value", "ratio"), ("mapLevel", "value", "neighbourhood")],
+        [("rowGlobalData", "data", rowShown)],
+        "search.value",
+    )
+    response = client.post("/_dash-update-component", json=body)
+    assert response.status_code == 200, response.data[:500]
+    return response.get_json()["response"]
+
+def test_showRow (client):
+    outputs = _showRow(client, "37", None)
+    assert outputs["rowGlobalData"]["data"] == 37
+    assert outputs["graph"]["figure"]["data"]
+    assert outputs["graphBar"]["figure"]["data"]
+
+@pytest.mark.parametrize("value", ["1", "0", "-5", "99999"])
+@pytest.mark.parametrize("rowShown", [None, 37])
+def test_rowOutsideTheDataLeavesTheGraphs (client, value, rowShown):
+    #Regression: a number that is not a row used to fall through to the search suggestions as an int and fail
+    outputs = _showRow(client, value, rowShown)
+    assert "graph" not in outputs
+    assert "graphBar" not in outputs
+    assert outputs["rowGlobalData"]["data"] == rowShown
+    assert outputs["suggestion"]["style"]["display"] == "none"
+
+def test_textShowsSuggestions (client):
+    outputs = _showRow(client, "income", 37)
+    assert outputs["suggestion"]["style"]["display"] != "none"
+    assert "graph" not in outputs
@@ -0,0 +1,38 @@
+import os
+import pytest
+from flask import Flask
+import metrics
+
+def test_profilerStopsWhenTheViewRaises (tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "profileSampleRate", 1)
+    monkeypatch.setattr(metrics, "profileFolder", str(tmp_path))
+    server = Flask(__name__)
+    #Propagated, as under a debugger or test runner, the error skips the after_request hooks
+    server.config["PROPAGATE_EXCEPTIONS"] = True
+    metrics.instrumentServer(server, route="")
+
+    @server.route("/fails")
+    def fails ():
+        raise RuntimeError("view failed")
+
+    @server.route("/works")
+    def works ():
+        return "works"
+
+    client = server.test_client()
+    with pytest.raises(RuntimeError):
+        client.get("/fails")
+    assert client.get("/works").status_code == 200
+    #Regression: a profiler left running by the failed request kept every later request from being profiled
+    profiles = sorted(os.listdir(tmp_path))
+    assert len(profiles) == 2
+    assert any("fails" in profile for profile in profiles) and any("works" in profile for profile in profiles)
+
+def test_renderPrometheusText ():
+    registry = metrics.MetricsRegistry(lambda: {"worker": 1})
+    registry.increment("census_test_total", {"result": "hit"}, 2)
+    registry.observe("census_test_seconds", 0.003, {"stage": "build"})
+    text = registry.render()
+    assert 'census_test_total{worker="1",result="hit"} 2' in text
+    assert 'census_test_seconds_bucket{worker="1",stage="build",le="0.005"} 1' in text
+    assert 'census_test_seconds_count{worker="1",stage="build"} 1' in text
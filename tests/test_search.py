@@ -0,0 +1,52 @@
+import pytest
+from search import SearchIndex, normalize, _editDistance, searchRows
+from datastore import getStore
+
+labels = [
+    "Total - Age groups of the population - 25% sample data",
+    "Median total income in 2020 among recipients ($)",
+    "Average total income in 2020 among recipients ($)",
+    "Total income",
+    "Population density per square kilometre",
+    "Neighbourhood Number",
+    "Average household size",
+]
+
+@pytest.fixture(scope="module")
+def index ():
+    return SearchIndex(labels)
+
+def _rows (results):
+    return [row for row, _ in results]
+
+def test_normalize ():
+    assert normalize("  Total - Age (25%)") == ["total", "age", "25"]
+
+def test_editDistanceCountsTranspositions ():
+    assert _editDistance("income", "incmoe", 2) == 1
+    assert _editDistance("income", "outcome", 1) == 2
+
+def test_exactMatchesRankShorterLabelsFirst (index):
+    #Every label with "total income" as a phrase matches every token; the shortest wins the tie
+    assert _rows(index.search("total income", 3)) == [5, 3, 4]
+
+def test_rarerTokensWeighMore (index):
+    assert _rows(index.search("median income", 1)) == [3]
+
+def test_prefixAndInfixMatches (index):
+    assert _rows(index.search("popul", 2)) == [6, 2]
+    assert _rows(index.search("hood", 1)) == [7]
+
+@pytest.mark.parametrize("typo, expected", [("incmoe", "income"), ("imcome", "income"), ("densty", "density"), ("housheold", "household")])
+def test_typosStillMatch (index, typo, expected):
+    results = index.search(typo, 3)
+    assert results and all(expected in label.lower() for _, label in results)
+
+def test_nothingMatches (index):
+    assert index.search("zzzzqqq") == []
+    assert index.search("  - ") == []
+
+def test_searchCensusLabels ():
+    #The default row of the page
+    results = searchRows(getStore(), "persons in private households", 5)
+    assert 37 in _rows(results)
@@ -0,0 +1,105 @@
+import os
+import time
+import pytest
+import sessions
+from sessions import SessionStore, MemorySessionStore, DiskSessionStore, SQLiteSessionStore, createSessionStore
+
+@pytest.fixture
+def clock (monkeypatch):
+    '''Pins time.time() to a value the test can move; now[0] is the current time. Session files are stamped with it too, as DiskSessionStore reads a session's age from its file'''
+    now = [time.time()]
+    monkeypatch.setattr(sessions.time, "time", lambda: now[0])
+    writeAtomically = sessions.writeAtomically
+    def stampedWrite (path, write, mode="wb"):
+        writeAtomically(path, write, mode)
+        os.utime(path, (now[0], now[0]))
+    monkeypatch.setattr(sessions, "writeAtomically", stampedWrite)
+    return now
+
+@pytest.fixture(params=["memory", "disk", "sqlite"])
+def store (request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore(ttl=60)
+    if request.param == "disk":
+        return DiskSessionStore(str(tmp_path / "sessions"), ttl=60)
+    return SQLiteSessionStore(str(tmp_path / "sessions.sqlite"), ttl=60)
+
+def test_editThenGet (store):
+    sessionId = store.newSessionId()
+    with store.edit(sessionId) as state:
+        assert state == {}
+        state["row"] = 37
+        state["shown"] = ["map", "bar"]
+    assert store.get(sessionId) == {"row": 37, "shown": ["map", "bar"]}
+    with store.edit(sessionId) as state:
+        state["row"] += 1
+    assert store.get(sessionId)["row"] == 38
+
+def test_unknownSessions (store):
+    assert store.get(None) is None
+    assert store.get(store.newSessionId()) is None
+    assert store.newSessionId() != store.newSessionId()
+
+def test_failedEditIsNotSaved (store):
+    sessionId = store.newSessionId()
+    with store.edit(sessionId) as state:
+        state["row"] = 37
+    with pytest.raises(RuntimeError):
+        with store.edit(sessionId) as state:
+            state["row"] = 99
+            raise RuntimeError("callback failed")
+    assert store.get(sessionId) == {"row": 37}
+
+def test_sessionsExpire (store, clock):
+    sessionId = store.newSessionId()
+    with store.edit(sessionId) as state:
+        state["row"] = 37
+    clock[0] += 30
+    assert store.get(sessionId) == {"row": 37}
+    #Changing a session restarts its ttl
+    with store.edit(sessionId) as state:
+        state["row"] = 38
+    clock[0] += 59
+    assert store.get(sessionId) == {"row": 38}
+    clock[0] += 2
+    assert store.get(sessionId) is None
+    with store.edit(sessionId) as state:
+        assert state == {}
+
+def test_purgeDeletesExpiredSessions (store, clock):
+    expiredId, keptId = store.newSessionId(), store.newSessionId()
+    with store.edit(expiredId) as state:
+        state["row"] = 37
+    clock[0] += 45
+    with store.edit(keptId) as state:
+        state["row"] = 38
+    clock[0] += 30
+    store._purge()
+    #Moving the clock back shows whether each session was deleted or only expired
+    clock[0] -= 75
+    assert store.get(expiredId) is None
+    assert store.get(keptId) == {"row": 38}
+
+def test_diskRejectsPathsAsIds (tmp_path):
+    store = DiskSessionStore(str(tmp_path), ttl=60)
+    with pytest.raises(ValueError):
+        store.get("../secrets")
+
+def test_backendsMustImplementEveryMethod ():
+    class NoPurgeStore(SessionStore):
+        def _load (self, sessionId):
+            return None
+
+        def _save (self, sessionId, state):
+            pass
+    with pytest.raises(TypeError):
+        NoPurgeStore()
+
+def test_createSessionStore (monkeypatch, tmp_path):
+    monkeypatch.setenv("SESSION_DATABASE", str(tmp_path / "sessions.sqlite"))
+    assert isinstance(createSessionStore("memory"), MemorySessionStore)
+    assert isinstance(createSessionStore("sqlite"), SQLiteSessionStore)
+    monkeypatch.setenv("SESSION_BACKEND", "disk")
+    assert isinstance(createSessionStore(), DiskSessionStore)
+    with pytest.raises(ValueError):
+        createSessionStore("redis")
@@ -0,0 +1,60 @@
+import numpy
+import pytest
+from datastore import getStore
+from spatial import OverlapTable, getSpatialIndex
+
+@pytest.fixture
+def table ():
+    #Two wards, three neighbourhoods: the first lies in ward 0, the second is split 1:3 between the wards, the third lies in ward 1
+    return OverlapTable([0, 0, 1, 1], [0, 1, 1, 2], [2.0, 1.0, 3.0, 4.0], 2)
+
+@pytest.fixture(scope="module")
+def index ():
+    return getSpatialIndex(getStore())
+
+def test_sumSplitsByArea (table):
+    wardValues = table.aggregate([10, 20, 30], "sum")
+    numpy.testing.assert_allclose(wardValues, [10 + 20 * 0.25, 20 * 0.75 + 30])
+    assert wardValues.sum() == pytest.approx(60)
+
+def test_meanIsAreaWeighted (table):
+    numpy.testing.assert_allclose(table.aggregate([10, 20, 30], "mean"), [(10 * 2 + 20 * 1) / 3, (20 * 3 + 30 * 4) / 7])
+
+def test_missingValues (table):
+    #A sum is only known if every neighbourhood in the ward is; a mean is taken over the neighbourhoods that are
+    values = [10, numpy.nan, 30]
+    assert numpy.isnan(table.aggregate(values, "sum")).all()
+    numpy.testing.assert_allclose(table.aggregate(values, "mean"), [10, 30])
+    numpy.testing.assert_allclose(table.aggregate([numpy.nan, numpy.nan, 30], "mean"), [numpy.nan, 30])
+
+def test_rowsAtOnceMatchOneRow (table):
+    matrix = numpy.array([[10, 20, 30], [1, numpy.nan, 3], [5, 5, 5]])
+    for aggregation in ("sum", "mean"):
+        wardMatrix = table.aggregate(matrix, aggregation)
+        assert wardMatrix.shape == (3, 2)
+        for row, wardRow in zip(matrix, wardMatrix):
+            numpy.testing.assert_allclose(wardRow, table.aggregate(row, aggregation))
+
+def test_unknownAggregation (table):
+    with pytest.raises(ValueError):
+        table.aggregate([10, 20, 30], "median")
+
+def test_wardSumsMatchNeighbourhoodTotals (index):
+    censusMatrix = getStore().censusMatrix
+    wardMatrix = index.wardMatrices["sum"]
+    assert wardMatrix.shape == (censusMatrix.shape[0], 25)
+    complete = ~numpy.isnan(censusMatrix).any(axis=1)
+    assert complete.sum() > 2000
+    numpy.testing.assert_allclose(wardMatrix[complete].sum(axis=1), censusMatrix[complete].sum(axis=1))
+    #Every neighbourhood is shared out to at least one ward
+    assert set(index.overlap.columnIndexes) == set(range(censusMatrix.shape[1]))
+
+def test_lookupPoint (index):
+    assert index.lookupPoint(-79.40, 43.67) == {"neighbourhood": "Annex", "ward": "University-Rosedale"}
+    assert index.lookupPoint(-80.5, 43.0) == {"neighbourhood": None, "ward": None}
+
+def test_inBounds (index):
+    wards = index.inBounds("ward", -79.41, 43.665, -79.39, 43.675)
+    assert "University-Rosedale" in index.names["ward"][wards]
+    assert (numpy.diff(wards) > 0).all()
+    assert len(index.inBounds("ward", -80.6, 43.0, -80.5, 43.1)) == 0